@@ -1,54 +1,158 @@
 from libs.Utils.Connection import COLLS, get_coll
 from libs.Utils.Exception import Http_Exception
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymongo import UpdateOne
 from dotenv import load_dotenv
-import google.generativeai as genai
+import threading
+import time
 import os
 
+load_dotenv()
 
-def criar_embedding():
+# Constantes ---------------------------------------------
+# Escolha o modelo de embedding — o mais recente é o 'text-embedding-004'
+MODELO = "text-embedding-004"
 
-    # Carrega a chave do arquivo .env
-    load_dotenv()
+# Quantidade de nomes enviados em cada requisição de embedding (a API aceita até 100)
+TAMANHO_LOTE = int(os.getenv("EMBEDDING_LOTE", 100))
+
+# Quantidade de lotes sendo processados ao mesmo tempo
+CONCORRENCIA = int(os.getenv("EMBEDDING_CONCORRENCIA", 4))
+
+# Limite de requisições por minuto enviadas para a API do Gemini
+REQUISICOES_POR_MINUTO = float(os.getenv("EMBEDDING_RPM", 600))
+
+# Collections que recebem o embedding e o campo de texto usado em cada uma
+FONTES = {
+    "produto": {"coll":COLLS["produto"], "campo":"cNmProduto"},
+    "ingrediente": {"coll":COLLS["ingrediente"], "campo":"cNmIngrediente"},
+}
+
+
+class _LimitadorTaxa:
+    """
+    Garante um intervalo mínimo entre as requisições feitas por todas as threads
+    """
+    def __init__(self, por_minuto:float):
+        self.intervalo = 60/por_minuto if por_minuto > 0 else 0
+        self._proximo = 0.0
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        with self._lock:
+            agora = time.monotonic()
+            espera = self._proximo - agora
+            self._proximo = max(agora, self._proximo) + self.intervalo
+
+        if (espera > 0):
+            time.sleep(espera)
+
+
+def _lotes(cursor, campo:str, tamanho:int, progresso_fonte:dict):
+    # Percorre o cursor sem carregar a collection inteira na memória
+    lote = []
+    for doc in cursor:
+        nome = doc.get(campo)
+
+        # Documentos sem nome não têm o que ser enviado para o embedding. São pulados (e contados) ao invés de
+        # interromper a collection inteira, o que faria toda nova execução parar no mesmo documento
+        if (not isinstance(nome, str) or nome.strip() == ""):
+            progresso_fonte["iSemNome"] += 1
+            continue
+
+        lote.append((doc["_id"], nome))
+        if (len(lote) == tamanho):
+            yield lote
+            lote = []
+    if (len(lote) > 0):
+        yield lote
+
+def _processar_lote(genai, coll, lote:list[tuple], limitador:_LimitadorTaxa) -> int:
+    limitador.esperar()
+
+    embeddings = genai.embed_content(
+        model=MODELO,
+        content=[nome for _, nome in lote]
+    )["embedding"]
+
+    result = coll.bulk_write([UpdateOne({"_id":_id}, {"$set":{"cEmbedding":embedding}}) for (_id, _), embedding in zip(lote, embeddings)], ordered=False)
+    return result.modified_count
+
+def _backfill_fonte(genai, nome:str, fonte:dict, limitador:_LimitadorTaxa, executor:ThreadPoolExecutor, progresso:dict, reportar):
+    coll = get_coll(fonte["coll"])
+    filtro = {"cEmbedding":{"$exists":False}}
+
+    progresso[nome] = {"iTotal":coll.count_documents(filtro), "iProcessados":0, "iErros":0, "iSemNome":0}
+    reportar(progresso)
+
+    cursor = coll.find(filtro, {fonte["campo"]:1}).sort("_id", 1).batch_size(TAMANHO_LOTE)
+
+    pendentes = {}
+    erros = []
+
+    def coletar(concluidos):
+        for futuro in concluidos:
+            lote = pendentes.pop(futuro)
+            try:
+                futuro.result()
+                progresso[nome]["iProcessados"] += len(lote)
+            except Exception as e:
+                progresso[nome]["iErros"] += len(lote)
+                erros.append(str(e))
+        reportar(progresso)
+
+    for lote in _lotes(cursor, fonte["campo"], TAMANHO_LOTE, progresso[nome]):
+        # Mantendo no máximo o dobro da concorrência em memória, o resto continua no cursor
+        if (len(pendentes) >= CONCORRENCIA*2):
+            concluidos, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+            coletar(concluidos)
+
+        pendentes[executor.submit(_processar_lote, genai, coll, lote, limitador)] = lote
+
+    concluidos, _ = wait(pendentes)
+    coletar(concluidos)
+
+    return erros
+
+def criar_embedding(progresso_callback=None) -> dict:
+    """
+    # Embedding em massa
+    Gera o embedding de todos os produtos e ingredientes que ainda não possuem o campo ``cEmbedding``.
+
+    Os documentos são lidos em lotes a partir do cursor, cada lote é enviado em uma única requisição de embedding
+    (com concorrência e taxa limitadas) e gravado com ``bulk_write``. Como apenas os documentos sem embedding são
+    buscados, basta executar novamente após uma falha para continuar de onde parou.
+
+    ## Parâmetros:
+    - ``progresso_callback``: Função opcional chamada a cada lote com o progresso de cada collection
+
+    ## Retorna
+    O progresso final de cada collection (``iTotal``, ``iProcessados``, ``iErros`` e ``iSemNome``, os documentos pulados por não terem nome)
+    """
+    # Importado apenas no uso para não pesar a inicialização da API
+    import google.generativeai as genai
     genai.configure(api_key=os.getenv("GOOGLE_GEMINI_API"))
-    
-    # Escolha o modelo de embedding — o mais recente é o 'text-embedding-004'
-    model = "text-embedding-004"
-
-    # Produtos
-    try:
-        cursor = get_coll(COLLS["produto"])
-
-        sem_embedding = cursor.find({"cEmbedding":{"$exists":False}}).to_list()
-
-        if (len(sem_embedding) > 0):
-            for prd in sem_embedding:
-                nome_produto = prd["cNmProduto"]
-                id_produto = prd["_id"]
-                embedding = genai.embed_content(
-                    model=model,
-                    content=nome_produto
-                )["embedding"]
-
-                cursor.update_one({"_id":id_produto}, {"$set":{"cEmbedding":embedding}})
-
-    except Exception as ex:
-        raise Http_Exception(500, f"Ocorreu um erro ao realizar o embedding dos produtos.\nErro:{ex}")
-    
-    # Ingredientes
-    try:
-        cursor = get_coll(COLLS["produto"])
-
-        sem_embedding = cursor.find({"cEmbedding":{"$exists":False}}).to_list()
-
-        if (len(sem_embedding) > 0):
-            for prd in sem_embedding:
-                nome_produto = prd["cNmProduto"]
-                id_produto = prd["_id"]
-                embedding = genai.embed_content(
-                    model=model,
-                    content=nome_produto
-                )["embedding"]
-                cursor.update_one({"_id":id_produto}, {"$set":{"cEmbedding":embedding}})
-
-    except Exception as ex:
-        raise Http_Exception(500, f"Ocorreu um erro ao realizar o embedding dos produtos.\nErro:{ex}")
\ No newline at end of file
+
+    limitador = _LimitadorTaxa(REQUISICOES_POR_MINUTO)
+    progresso = {}
+
+    def reportar(p):
+        if (progresso_callback is not None):
+            progresso_callback(p)
+
+    erros = {}
+    with ThreadPoolExecutor(max_workers=CONCORRENCIA, thread_name_prefix="embedding") as executor:
+        for nome, fonte in FONTES.items():
+            try:
+                erros_fonte = _backfill_fonte(genai, nome, fonte, limitador, executor, progresso, reportar)
+            except Exception as ex:
+                erros_fonte = [str(ex)]
+
+            if (len(erros_fonte) > 0):
+                erros[nome] = erros_fonte
+
+    if (len(erros) > 0):
+        resumo = "; ".join(f"{nome}: {len(lista)} lote(s) com erro, ex: {lista[0]}" for nome, lista in erros.items())
+        raise Http_Exception(500, f"Ocorreu um erro ao realizar o embedding, execute novamente para continuar de onde parou.\nErro:{resumo}")
+
+    return progresso
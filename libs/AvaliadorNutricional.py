@@ -1,118 +1,178 @@
-import pandas as pd
-
-def get_total_by_ingrediente(i:dict) -> float:
-    # --------- Pontos negativos ---------
-    pontos_negativos = 0
-
-    # Caloria
-    nutriente = i["nCaloria"]
-    metrica = 80
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 10 else 10
-    pontos_negativos += nutriente
-
-    # Açucares Totais
-    nutriente = i["nAcucar"]
-    metrica = 4.5
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 10 else 10
-    pontos_negativos += nutriente
-
-    # Gordura Saturada
-    nutriente = i["nGorduraSaturada"]
-    metrica = 1
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 10 else 10
-    pontos_negativos += nutriente
-
-    # Sódio
-    nutriente = i["nSodio"]
-    metrica = 90
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 10 else 10
-    pontos_negativos += nutriente
-
-
-    # --------- Pontos Positivos ---------
-    pontos_positivos = 0
-
-    # Fibras
-    nutriente = i["nFibra"]
-    metrica = 0.7
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 5 else 5
-    pontos_positivos += nutriente
-
-    # Proteina
-    nutriente = i["nProteina"]
-    metrica = 1.6
-    nutriente = nutriente//metrica
-    nutriente = nutriente if nutriente < 5 else 5
-    pontos_positivos += nutriente
-
-
-    # --------- Score Final ---------
-    score_final = pontos_negativos - pontos_positivos
-
-    return score_final
-
-def pegar_ingredientes_formatados(tabela_mongo:dict) -> dict:
-    
-    tabela = tabela_mongo.copy()
-
-    model = {
-        "nCaloria":0, 
-        "nProteina":0, 
-        "nAcucar":0, 
-        "nFibra":0, 
-        "nGorduraSaturada":0, 
-        "nSodio":0
-    }
-
-    nutrientes_usados = ["Valor Calórico (kcal)", "Proteína (g)", "Açúcar Total (g)", "Fibra Alimentar (g)", "Gordura Saturada (g)", "Sódio (mg)"]
-
-    transform_colunas = {
-        "Valor Calórico (kcal)":"nCaloria",
-        "Proteína (g)":"nProteina", 
-        "Açúcar Total (g)":"nAcucar", 
-        "Fibra Alimentar (g)":"nFibra", 
-        "Gordura Saturada (g)":"nGorduraSaturada", 
-        "Sódio (mg)":"nSodio"
-    }
-
-    total = tabela.pop("nTotal")
-    valores_inuteis = tabela.pop("_id"), tabela.pop("nCdProduto"), tabela.pop("cNmTabela"), tabela.pop("nPorcao"), tabela.pop("cUnidadeMedida"), tabela.pop("lIngredientes")
-    
-
-    df = pd.DataFrame(tabela)
-
-    df = df[df["lNutrientes"].isin(nutrientes_usados)]
-
-    tabela = df.to_dict("split")["data"]
-
-    for i in tabela:
-        chave, valor = i[0], i[1]
-        valor = valor/total*100 # Deixando nos 100g
-        model[transform_colunas[chave]] = valor
-    
-    return model
+from libs.Utils.Connection import COLLS
+from libs.Utils.AsyncConnection import get_coll
+from libs.Utils.Nutrientes import nome_ptbr, NUTRIENTES
+from pymongo import UpdateOne
+import numpy as np
+import os
+
+# Constantes ---------------------------------------------
+# Critérios do Nutri-Score: (chave do nutriente, métrica de cada ponto, máximo de pontos, sinal)
+# Os pontos negativos somam ao score e os positivos subtraem
+CRITERIOS = [
+    ("nCaloria(kcal)", 80, 10, 1),
+    ("nAcucar(g)", 4.5, 10, 1),
+    ("nGorduraSaturada(g)", 1, 10, 1),
+    ("nSodio(mg)", 90, 10, 1),
+    ("nFibra(g)", 0.7, 5, -1),
+    ("nProteina(g)", 1.6, 5, -1),
+]
+
+# Nome de cada nutriente do score como aparece no lNutrientes da tabela
+NUTRIENTES_SCORE = [nome_ptbr[chave] for chave, _, _, _ in CRITERIOS]
+
+# Coluna de cada nutriente do score na ordem de NUTRIENTES (a mesma da matriz de nutrientes)
+COLUNAS_SCORE = np.array([NUTRIENTES.index(chave) for chave, _, _, _ in CRITERIOS], dtype=np.intp)
+
+METRICAS = np.array([metrica for _, metrica, _, _ in CRITERIOS], dtype=np.float64)
+MAXIMOS = np.array([maximo for _, _, maximo, _ in CRITERIOS], dtype=np.float64)
+SINAIS = np.array([sinal for _, _, _, sinal in CRITERIOS], dtype=np.float64)
+
+# Score mínimo de cada classificação: abaixo de 0 é A, de 0 a 2 é B, de 3 a 10 é C, de 11 a 18 é D e a partir de 19 é E
+LIMITES_CLASSIFICACAO = np.array([0, 3, 11, 19], dtype=np.float64)
+CLASSIFICACOES = np.array(["A", "B", "C", "D", "E"])
+
+# Quantidade de tabelas lidas e atualizadas de cada vez na reclassificação
+RECLASSIFICACAO_LOTE = int(os.getenv("RECLASSIFICACAO_LOTE", 1000))
+
+
+def perfil_100g(tabela_mongo:dict) -> np.ndarray:
+    """
+    Retorna os nutrientes do score (na ordem de ``CRITERIOS``) a cada 100g da tabela, a partir do ``lNutrientes`` e ``lTotal``
+    """
+    posicoes = {nome:i for i, nome in enumerate(tabela_mongo["lNutrientes"])}
+    total = tabela_mongo["lTotal"]
+
+    # Nutrientes ausentes ou null contam como zero
+    valores = np.array([total[posicoes[nome]] if nome in posicoes and total[posicoes[nome]] is not None else 0 for nome in NUTRIENTES_SCORE], dtype=np.float64)
+
+    return valores/float(tabela_mongo["nTotal"])*100 # Deixando nos 100g
+
+def perfis_100g(totais:np.ndarray, totais_receita:np.ndarray) -> np.ndarray:
+    """
+    Versão em lote do ``perfil_100g`` para totais que já estão na ordem de ``NUTRIENTES`` (receitas x nutrientes),
+    como os calculados pela matriz de nutrientes
+    """
+    return totais[:, COLUNAS_SCORE]/np.asarray(totais_receita, dtype=np.float64)[:, None]*100
+
+def classificar_lote(perfis:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    # Nutri-Score em lote
+    Calcula o score e a classificação de várias tabelas de uma vez
+
+    ## Parâmetros:
+    - ``perfis``: Matriz (tabelas x nutrientes do score) com os valores a cada 100g, na ordem de ``CRITERIOS``
+
+    ## Retorna
+    Dois ``ndarray``: as classificações (A a E) e os scores de cada tabela
+    """
+    perfis = np.nan_to_num(np.atleast_2d(np.asarray(perfis, dtype=np.float64)))
+
+    pontos = np.minimum(np.floor_divide(perfis, METRICAS), MAXIMOS)
+    scores = (pontos @ SINAIS).astype(np.int64)
+
+    classificacoes = CLASSIFICACOES[np.digitize(scores, LIMITES_CLASSIFICACAO)]
+
+    return classificacoes, scores
 
 def classificar(tabela_nutricional:dict):
 
-    ingrediente = pegar_ingredientes_formatados(tabela_nutricional)
-
-    score = get_total_by_ingrediente(ingrediente)
-    
-    if (score >= 19):
-        classificacao = "E"
-    elif (score >= 11):
-        classificacao = "D"
-    elif (score >= 3):
-        classificacao = "C"
-    elif (score >= 0):
-        classificacao = "B"
-    else:
-        classificacao = "A"
-
-    return classificacao,score
-
+    classificacoes, scores = classificar_lote(perfil_100g(tabela_nutricional))
+
+    return str(classificacoes[0]), int(scores[0])
+
+
+def _massa_valida(tabela_mongo:dict):
+    """
+    Retorna o ``nTotal`` da tabela quando ela pode ser classificada, ``0`` quando ela não tem massa e ``None`` quando o
+    documento está incompleto (sem ``lNutrientes``, ``lTotal`` ou ``nTotal`` numérico)
+    """
+    if (not isinstance(tabela_mongo.get("lNutrientes"), list) or not isinstance(tabela_mongo.get("lTotal"), list)):
+        return None
+    if (len(tabela_mongo["lNutrientes"]) != len(tabela_mongo["lTotal"])):
+        return None
+
+    try:
+        total = float(tabela_mongo.get("nTotal"))
+    except (TypeError, ValueError):
+        return None
+
+    return total if np.isfinite(total) and total > 0 else 0
+
+async def reclassificar_tabelas(progresso_callback=None) -> dict:
+    """
+    # Reclassificação
+    Recalcula a classificação e o score de todas as tabelas da collection, usado quando os critérios do Nutri-Score mudam.
+
+    As tabelas são lidas do cursor em lotes de ``RECLASSIFICACAO_LOTE``, classificadas com ``classificar_lote`` e apenas as
+    que mudaram são gravadas, com um ``bulk_write`` por lote. Documentos incompletos são ignorados (``iIgnorados``) e tabelas
+    sem massa (``nTotal`` zero) ficam sem classificação (``iSemMassa``), ao invés de receberem a pior nota.
+
+    ## Parâmetros:
+    - ``progresso_callback``: Corrotina opcional chamada a cada lote com o progresso
+
+    ## Retorna
+    O progresso final (``iTotal``, ``iProcessados``, ``iAtualizados``, ``iIgnorados`` e ``iSemMassa``)
+    """
+    coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+
+    progresso = {"iTotal":await coll_tabela.estimated_document_count(), "iProcessados":0, "iAtualizados":0, "iIgnorados":0, "iSemMassa":0}
+
+    cursor = coll_tabela.find(
+        {},
+        {"lNutrientes":1, "lTotal":1, "nTotal":1, "jAvaliacao.cClassificacao":1, "jAvaliacao.iScore":1}
+    ).batch_size(RECLASSIFICACAO_LOTE)
+
+    async def processar(lote:list[dict]):
+        operacoes = []
+        validas = []
+        perfis = []
+
+        for tabela in lote:
+            massa = _massa_valida(tabela)
+
+            if (massa is None):
+                progresso["iIgnorados"] += 1
+            elif (massa == 0):
+                # Sem massa não existe perfil a cada 100g, a tabela fica sem classificação
+                progresso["iSemMassa"] += 1
+                avaliacao = tabela.get("jAvaliacao") or {}
+                if (avaliacao.get("cClassificacao") is not None or avaliacao.get("iScore") is not None):
+                    operacoes.append(UpdateOne({"_id":tabela["_id"]}, {"$set":{"jAvaliacao.cClassificacao":None, "jAvaliacao.iScore":None}}))
+            else:
+                try:
+                    perfis.append(perfil_100g(tabela))
+                    validas.append(tabela)
+                except (TypeError, ValueError):
+                    # Algum valor do lTotal não é numérico
+                    progresso["iIgnorados"] += 1
+
+        if (len(validas) > 0):
+            classificacoes, scores = classificar_lote(np.array(perfis, dtype=np.float64))
+        else:
+            classificacoes, scores = np.array([]), np.array([])
+
+        for tabela, classificacao, score in zip(validas, classificacoes.tolist(), scores.tolist()):
+            avaliacao = tabela.get("jAvaliacao") or {}
+            if (avaliacao.get("cClassificacao") != classificacao or avaliacao.get("iScore") != score):
+                operacoes.append(UpdateOne({"_id":tabela["_id"]}, {"$set":{"jAvaliacao.cClassificacao":classificacao, "jAvaliacao.iScore":score}}))
+
+        if (len(operacoes) > 0):
+            await coll_tabela.bulk_write(operacoes, ordered=False)
+
+        progresso["iProcessados"] += len(lote)
+        progresso["iAtualizados"] += len(operacoes)
+
+        if (progresso_callback is not None):
+            await progresso_callback(dict(progresso))
+
+    lote = []
+    async for tabela in cursor:
+        lote.append(tabela)
+        if (len(lote) == RECLASSIFICACAO_LOTE):
+            await processar(lote)
+            lote = []
+
+    if (len(lote) > 0):
+        await processar(lote)
+
+    return progresso
@@ -1,24 +1,48 @@
 from dotenv import load_dotenv
 import os
-import google.generativeai as genai
 from libs.Utils.Exception import Http_Exception
+from libs.Utils.AsyncConnection import get_redis
 from pathlib import Path
+import hashlib
 import json
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_GEMINI_API")) 
 
-modelo_tabela = ""
+MODELO = "gemini-2.0-flash"
+
+# Deve ser incrementada sempre que o prompt de sistema mudar, para não reaproveitar comentários do prompt antigo
+VERSAO_PROMPT = 1
+
+# Cache dos comentários no Redis ---------------------------
+prefixo_comentario = "comentario_avaliacao:"
+chave_stats_cache = "stats:comentario_avaliacao"
+
+# Casas decimais dos nutrientes a cada 100g usados na chave, tabelas com perfis quase iguais compartilham o comentário
+PRECISAO_CACHE = int(os.getenv("COMENTARIO_CACHE_PRECISAO", 1))
+
+# Tempo (em segundos) que o comentário fica salvo no Redis
+TTL_CACHE = int(os.getenv("COMENTARIO_CACHE_TTL", 60*60*24*30))
+
 caminho_modelo = Path(__file__).resolve().parent.parent / "docs" / "Models" / "Mongo" / "Tabela.json"
 
+# O modelo só é criado no primeiro uso, evitando importar o SDK do Gemini e ler o arquivo no import do módulo
+llm = None
 
-with(open(caminho_modelo, "r", encoding="utf-8")) as arquivo:
-    modelo_tabela = arquivo.read()
+def get_llm():
+    global llm
 
+    if (llm is not None):
+        return llm
 
-llm = genai.GenerativeModel(
-    model_name="gemini-2.0-flash",
-    system_instruction=f"""
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_GEMINI_API"))
+
+    with(open(caminho_modelo, "r", encoding="utf-8")) as arquivo:
+        modelo_tabela = arquivo.read()
+
+    llm = genai.GenerativeModel(
+        model_name=MODELO,
+        system_instruction=f"""
 # Contexto
 Você é um especialista em engenharia de alimentos e irá receber um dicionario contendo informações sobre uma tabela nutricional, essas informações devem ser processadas uma por uma e analisadas para gerar uma descrição sobre a qualidade nutricional da tabela.
 
@@ -45,19 +69,75 @@ Você deve citar os pontos bons, ruins e recomendações do que deve ser melhora
 - Mantenha respostas curtas e utilizáveis.
 
 """,
-    generation_config=genai.types.GenerationConfig(
-        temperature=0.7,
-        top_p=0.95,
-        # max_output_tokens=5,
-        # stop_sequences=["\n\n"]
+        generation_config=genai.types.GenerationConfig(
+            temperature=0.7,
+            top_p=0.95,
+            # max_output_tokens=5,
+            # stop_sequences=["\n\n"]
+        )
     )
-)
 
+    return llm
+
+
+def chave_cache(tabela:dict) -> str:
+    """
+    Chave do comentário no Redis: hash do perfil nutricional a cada 100g (arredondado em ``PRECISAO_CACHE`` casas) junto
+    da classificação, do modelo e da versão do prompt. Receitas iguais com outra porção ou outro nome caem na mesma chave
+    """
+    total = tabela["nTotal"]
+    perfil = {
+        nome:round(valor/total*100, PRECISAO_CACHE) if valor is not None and total else None
+        for nome, valor in zip(tabela["lNutrientes"], tabela["lTotal"])
+    }
+
+    conteudo = json.dumps({"perfil":perfil, "classificacao":tabela.get("jAvaliacao", {}).get("cClassificacao")}, sort_keys=True)
+
+    return prefixo_comentario + MODELO + ":v" + str(VERSAO_PROMPT) + ":" + hashlib.sha1(conteudo.encode("utf-8")).hexdigest()
+
+async def __somar_stats(redis, campo:str):
+    # Os contadores ficam no Redis porque os comentários são gerados pelos workers, não pela API
+    try:
+        await redis.hincrby(chave_stats_cache, campo, 1)
+    except Exception:
+        pass
+
+async def descrever_avaliacao(tabela:dict):
+    chave = chave_cache(tabela)
+
+    try:
+        redis = await get_redis()
+        salvo = await redis.get(chave)
+    except Exception:
+        redis, salvo = None, None
+
+    if (salvo is not None):
+        await __somar_stats(redis, "iHits")
+        return salvo
 
-def descrever_avaliacao(tabela:dict):
     try:
-        response = llm.generate_content(json.dumps(tabela))
-        return response.text
+        response = await get_llm().generate_content_async(json.dumps(tabela))
+        comentario = response.text
         
     except Exception as e:
-        raise Http_Exception(400, f"Erro ao consumir a API para avaliar a tabela nutricional. Erro: {e}")
\ No newline at end of file
+        raise Http_Exception(400, f"Erro ao consumir a API para avaliar a tabela nutricional. Erro: {e}")
+
+    if (redis is not None):
+        await __somar_stats(redis, "iMisses")
+        try:
+            await redis.set(chave, comentario, ex=TTL_CACHE)
+        except Exception:
+            pass
+
+    return comentario
+
+async def get_stats_cache() -> dict:
+    redis = await get_redis()
+    stats = {campo:int(valor) for campo, valor in (await redis.hgetall(chave_stats_cache)).items()}
+
+    hits, misses = stats.get("iHits", 0), stats.get("iMisses", 0)
+    return {
+        "iHits":hits,
+        "iMisses":misses,
+        "nTaxaAcerto":hits/(hits+misses) if hits+misses > 0 else 0.0,
+    }
\ No newline at end of file
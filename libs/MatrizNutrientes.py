@@ -0,0 +1,212 @@
+"""
+Matriz de nutrientes do catálogo de ingredientes, mantida em memória.
+
+Cada linha é um ingrediente e cada coluna um nutriente (na ordem de ``NUTRIENTES``), com os valores a cada 100g.
+Com ela a tabela nutricional de uma receita é calculada com uma única soma ponderada das linhas, sem ir ao MongoDB.
+O peso de cada ingrediente na soma é definido por quem chama (ver ``TableCreator``). A matriz é recarregada inteira depois de ``MATRIZ_NUTRIENTES_TTL`` segundos, e ingredientes novos entram
+de forma incremental (pelo scanner ou quando uma receita usa um código que ainda não está na matriz).
+"""
+from libs.Utils.Connection import COLLS
+from libs.Utils.AsyncConnection import get_coll
+from libs.Utils.Exception import Http_Exception
+from libs.Utils.Nutrientes import NUTRIENTES
+import numpy as np
+import asyncio
+import time
+import sys
+import os
+
+# Tempo (em segundos) até a matriz ser recarregada inteira do MongoDB
+MATRIZ_TTL = float(os.getenv("MATRIZ_NUTRIENTES_TTL", 60*60))
+
+
+class MatrizNutrientes:
+    def __init__(self, ttl:float = MATRIZ_TTL):
+        self.ttl = ttl
+        self.matriz = np.zeros((0, len(NUTRIENTES)), dtype=np.float64)
+        self.indice: dict[int, int] = {}
+        self.carregada_em = None
+        self._lock = None
+
+    @staticmethod
+    def _valor(doc:dict, key:str) -> float:
+        valor = doc.get(key)
+
+        # Nutrientes ausentes ou null (comum em ingredientes scanneados) contam como zero
+        if (valor is None):
+            return 0.0
+
+        try:
+            return float(valor)
+        except (TypeError, ValueError):
+            # Ingredientes scanneados podem ter textos como "traços" ou "12 mg", que não podem quebrar a carga da matriz inteira
+            print(f"Valor inválido no nutriente {key} do ingrediente {doc.get('_id')}: {valor!r}, considerado como zero")
+            return 0.0
+
+    @staticmethod
+    def _linha(doc:dict) -> list[float]:
+        return [MatrizNutrientes._valor(doc, key) for key in NUTRIENTES]
+
+    def _get_lock(self) -> asyncio.Lock:
+        if (self._lock is None):
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def carregar(self):
+        """
+        Carrega (ou recarrega) a matriz inteira a partir da collection de ingredientes
+        """
+        coll = await get_coll(COLLS["ingrediente"])
+        docs = await coll.find({}, {key:1 for key in NUTRIENTES}).to_list(length=None)
+
+        matriz = np.array([self._linha(doc) for doc in docs], dtype=np.float64).reshape(len(docs), len(NUTRIENTES))
+        indice = {int(doc["_id"]):linha for linha, doc in enumerate(docs)}
+
+        # Trocando as referências de uma vez, quem estiver calculando continua com a matriz antiga
+        self.matriz, self.indice = matriz, indice
+        self.carregada_em = time.monotonic()
+
+    async def garantir_atualizada(self):
+        if (self.carregada_em is not None and time.monotonic() - self.carregada_em < self.ttl):
+            return
+
+        async with self._get_lock():
+            # Outra corrotina pode ter recarregado enquanto esperava o lock
+            if (self.carregada_em is None or time.monotonic() - self.carregada_em >= self.ttl):
+                await self.carregar()
+
+    def atualizar_ingrediente(self, ingrediente:dict):
+        """
+        Atualização incremental: adiciona (ou substitui) um ingrediente na matriz sem recarregar o catálogo
+        """
+        self.atualizar_ingredientes([ingrediente])
+
+    def atualizar_ingredientes(self, ingredientes:list[dict]):
+        matriz, indice = self.matriz, dict(self.indice)
+        novas_linhas = []
+
+        for doc in ingredientes:
+            codigo = int(doc["_id"])
+            linha = self._linha(doc)
+
+            if (codigo in indice):
+                if (matriz is self.matriz):
+                    matriz = matriz.copy()
+                matriz[indice[codigo]] = linha
+            else:
+                indice[codigo] = len(matriz) + len(novas_linhas)
+                novas_linhas.append(linha)
+
+        if (len(novas_linhas) > 0):
+            matriz = np.vstack([matriz, np.array(novas_linhas, dtype=np.float64)])
+
+        self.matriz, self.indice = matriz, indice
+
+    async def _buscar_faltantes(self, codigos:list[int]):
+        coll = await get_coll(COLLS["ingrediente"])
+        docs = await coll.find({"_id":{"$in":codigos}}, {key:1 for key in NUTRIENTES}).to_list(length=None)
+        self.atualizar_ingredientes(docs)
+
+    async def garantir_ingredientes(self, codigos) -> list[int]:
+        """
+        Garante que os ingredientes estão na matriz, buscando no MongoDB os que ainda não estão.
+        Retorna os códigos que não existem no banco de dados
+        """
+        await self.garantir_atualizada()
+
+        faltantes = [codigo for codigo in codigos if codigo not in self.indice]
+        if (len(faltantes) > 0):
+            # Podem ter sido inseridos por outro processo depois da última carga
+            await self._buscar_faltantes(faltantes)
+            faltantes = [codigo for codigo in faltantes if codigo not in self.indice]
+
+        return faltantes
+
+    async def _verificar_ingredientes(self, codigos):
+        faltantes = await self.garantir_ingredientes(codigos)
+        if (len(faltantes) > 0):
+            raise Http_Exception(400, f"Os ingredientes com os códigos {faltantes} não foram encontrados no banco de dados")
+
+    async def calcular(self, pesos:dict[int, float]) -> np.ndarray:
+        """
+        # Cálculo da receita
+        Calcula o total de cada nutriente da receita como uma soma ponderada das linhas da matriz
+
+        ## Parâmetros:
+        - ``pesos``: Dicionário ``{nCdIngrediente: peso}`` com o peso de cada ingrediente na soma
+
+        ## Retorna
+        Um ``ndarray`` com o total de cada nutriente, na ordem de ``NUTRIENTES``
+        """
+        await self._verificar_ingredientes(pesos.keys())
+
+        matriz, indice = self.matriz, self.indice
+        linhas = np.fromiter((indice[codigo] for codigo in pesos.keys()), dtype=np.intp, count=len(pesos))
+        valores_pesos = np.fromiter(pesos.values(), dtype=np.float64, count=len(pesos))
+
+        return valores_pesos @ matriz[linhas]
+
+    async def contribuicoes(self, pesos:dict[int, float]) -> np.ndarray:
+        """
+        # Contribuição de cada ingrediente
+        Calcula quanto cada ingrediente da receita contribui para cada nutriente, a soma das linhas é o total da receita
+
+        ## Retorna
+        Um ``ndarray`` (ingredientes x nutrientes), na ordem das chaves de ``pesos``
+        """
+        await self._verificar_ingredientes(pesos.keys())
+
+        return self.contribuicoes_lote([pesos])[0]
+
+    def calcular_lote(self, receitas:list[dict[int, float]]) -> np.ndarray:
+        """
+        # Cálculo em lote
+        Calcula várias receitas com um único produto de matrizes (receitas x ingredientes) @ (ingredientes x nutrientes).
+        Cada receita é um dicionário ``{nCdIngrediente: peso}``, os ingredientes já devem estar na matriz (ver ``garantir_ingredientes``)
+
+        ## Retorna
+        Um ``ndarray`` (receitas x nutrientes) com o total de cada nutriente de cada receita
+        """
+        matriz, indice = self.matriz, self.indice
+
+        # Colunas da matriz de pesos: apenas os ingredientes usados em alguma das receitas
+        codigos = list({codigo for receita in receitas for codigo in receita.keys()})
+        coluna = {codigo:i for i, codigo in enumerate(codigos)}
+
+        pesos = np.zeros((len(receitas), len(codigos)), dtype=np.float64)
+        for i, receita in enumerate(receitas):
+            for codigo, peso in receita.items():
+                pesos[i, coluna[codigo]] += peso
+
+        linhas = np.fromiter((indice[codigo] for codigo in codigos), dtype=np.intp, count=len(codigos))
+
+        return pesos @ matriz[linhas]
+
+    def contribuicoes_lote(self, receitas:list[dict[int, float]]) -> list[np.ndarray]:
+        """
+        Versão em lote do ``contribuicoes``, os ingredientes já devem estar na matriz (ver ``garantir_ingredientes``)
+        """
+        matriz, indice = self.matriz, self.indice
+        resultado = []
+
+        for receita in receitas:
+            linhas = np.fromiter((indice[codigo] for codigo in receita.keys()), dtype=np.intp, count=len(receita))
+            pesos = np.fromiter(receita.values(), dtype=np.float64, count=len(receita))
+            resultado.append(pesos[:, None] * matriz[linhas])
+
+        return resultado
+
+    def memoria_bytes(self) -> int:
+        # Tamanho da matriz mais o índice (dicionário e os ints das chaves e valores)
+        return int(self.matriz.nbytes + sys.getsizeof(self.indice) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.indice.items()))
+
+    def stats(self) -> dict:
+        return {
+            "iIngredientes": len(self.indice),
+            "iNutrientes": len(NUTRIENTES),
+            "iMemoria(bytes)": self.memoria_bytes(),
+            "nIdade(s)": time.monotonic() - self.carregada_em if self.carregada_em is not None else None,
+        }
+
+
+matriz_nutrientes = MatrizNutrientes()
@@ -1,100 +1,81 @@
 # Importações necessárias
-import pandas as pd
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import numpy as np
 import json
-from libs.AvaliadorNutricional import classificar
+from libs.AvaliadorNutricional import classificar, classificar_lote, perfis_100g
 from libs.DescreveAvaliacaoTabela import descrever_avaliacao
 from libs.Utils.Exception import Http_Exception
-from libs.Utils.Connection import get_coll, COLLS, get_redis, get_highest_id
-
-# Conexões
-coll_tabela = get_coll(COLLS["tabela_nutricional"])
-coll_ingrediente = get_coll(COLLS["ingrediente"])
+from libs.Utils.FilaJobs import enfileirar_jobs
+from libs.Utils.Connection import COLLS
+from libs.Utils.AsyncConnection import get_coll, get_redis, get_next_id, reservar_ids
+from libs.Utils.Nutrientes import nome_ptbr, vd_referencia, NUTRIENTES
+from libs.MatrizNutrientes import matriz_nutrientes
 
 # Redis
-redis = get_redis()
 prefixo_requisicao_user = "requisicao_user:"
 
 # Constantes
-nome_ptbr = {
-    "nCaloria(kcal)":"Valor Calórico (kcal)",
-    "nProteina(g)":"Proteína (g)",
-    "nCarboidrato(g)":"Carboidrato (g)",
-    "nAcucar(g)":"Açúcar Total (g)",
-    "nFibra(g)":"Fibra Alimentar (g)",
-    "nGorduraTotal(g)":"Gordura Total (g)",
-    "nGorduraSaturada(g)":"Gordura Saturada (g)",
-    "nGorduraMonoinsaturada(g)":"Gordura Monoinsaturada (g)",
-    "nGorduraPoliinsaturada(g)":"Gordura Poli-Insaturada (g)",
-    "nColesterol(mg)":"Colesterol (mg)",
-    "nRetinol(mcg)":"Retinol/Vitamina A (μg)",
-    "nTiamina(mg)":"Tiamina (mg)",
-    "nRiboflavina(mg)":"Riboflavina (mg)",
-    "nNiacina(mg)":"Niacina (mg)",
-    "nVitB6(mg)":"Vitamina B-6 (mg)",
-    "nFolato(mcg)":"Ácido Fólico (μg)",
-    "nColina(mg)":"Colina (mg)",
-    "nVitB12(mcg)":"Vitamina B-12 (μg)",
-    "nVitC(mg)":"Vitamina C (mg)",
-    "nVitD(mcg)":"Vitamina D (μg)",
-    "nVitE(mg)":"Vitamina E (mg)",
-    "nVitK(mcg)":"Vitamina K (μg)",
-    "nCalcio(mg)":"Cálcio (mg)",
-    "nFosforo(mg)":"Fósforo (mg)",
-    "nMagnesio(mg)":"Magnésio (mg)",
-    "nFerro(mg)":"Ferro (mg)",
-    "nZinco(mg)":"Zinco (mg)",
-    "nCobre(mg)":"Cobre (mg)",
-    "nSelenio(mcg)":"Selênio (μg)",
-    "nPotassio(mg)":"Potássio (mg)",
-    "nSodio(mg)":"Sódio (mg)",
-    "nCafeina(mg)":"Cafeína (mg)",
-    "nTeobromina(mg)":"Teobromina (mg)",
-    "nAlcool(g)":"Álcool (g)",
-    "nAgua(g)":"Água (g)",
-}
-
-vd_referencia = {
-    "nCaloria(kcal)":2000,
-    "nProteina(g)":50,
-    "nCarboidrato(g)":300,
-    "nAcucar(g)":50,
-    "nFibra(g)":25,
-    "nGorduraTotal(g)":65,
-    "nGorduraSaturada(g)":20,
-    "nGorduraMonoinsaturada(g)":20,
-    "nGorduraPoliinsaturada(g)":20,
-    "nColesterol(mg)":300,
-    "nRetinol(mcg)":800,
-    "nTiamina(mg)":1.2,
-    "nRiboflavina(mg)":1.2,
-    "nNiacina(mg)":15,
-    "nVitB6(mg)":1.3,
-    "nFolato(mcg)":400,
-    "nColina(mg)":550,
-    "nVitB12(mcg)":2.4,
-    "nVitC(mg)":100,
-    "nVitD(mcg)":15,
-    "nVitE(mg)":15,
-    "nVitK(mcg)":120,
-    "nCalcio(mg)":1000,
-    "nFosforo(mg)":700,
-    "nMagnesio(mg)":120,
-    "nFerro(mg)":14,
-    "nZinco(mg)":11,
-    "nCobre(mg)":0.9,
-    "nSelenio(mcg)":60,
-    "nPotassio(mg)":3500,
-    "nSodio(mg)":2000,
-    "nCafeina(mg)":0,
-    "nTeobromina(mg)":0,
-    "nAlcool(g)":0,
-    "nAgua(g)":0,
-}
+# Listas fixas na ordem de NUTRIENTES, calculadas uma única vez para montar as tabelas
+NOMES_NUTRIENTES = [nome_ptbr[key] for key in NUTRIENTES]
+VD_REFERENCIA = np.array([vd_referencia[key] for key in NUTRIENTES], dtype=np.float64)
+POSSUI_VD = VD_REFERENCIA != 0
+POSSUI_VD_LISTA = POSSUI_VD.tolist()
 
+# Status do comentário da IA (jAvaliacao.cStatusComentario), que é gerado pelo worker depois da tabela ser inserida
+COMENTARIO_PENDENTE = "pendente"
+COMENTARIO_CONCLUIDO = "concluido"
+COMENTARIO_ERRO = "erro"
 
 # Funções ---------------------------------
 
-def __gerar_tabela_nutricional(ingredientes:list[dict], porcao:float):
+def __montar_tabela(totais:np.ndarray, total_amount:float, porcao:float) -> dict:
+    """
+    # Montagem da tabela
+    Monta as listas da tabela nutricional a partir do total de cada nutriente (na ordem de ``NUTRIENTES``)
+
+    ## Retorna
+    Um dicionário com as listas ``lNutrientes``, ``lTotal``, ``lPorcao`` e ``lVd``, no formato que é salvo no MongoDB.
+    O ``lVd`` é ``None`` nos nutrientes que não possuem valor diário de referência
+    """
+    por_porcao = totais/total_amount*porcao
+
+    vd = np.zeros_like(por_porcao)
+    np.divide(por_porcao*100, VD_REFERENCIA, out=vd, where=POSSUI_VD)
+
+    return {
+        "lNutrientes":list(NOMES_NUTRIENTES),
+        "lTotal":totais.tolist(),
+        "lPorcao":por_porcao.tolist(),
+        "lVd":[valor if possui else None for valor, possui in zip(vd.tolist(), POSSUI_VD_LISTA)],
+    }
+
+def __somar_quantidades(ingredientes:list[dict]) -> dict[int, float]:
+    # Somando as quantidades por código, caso o mesmo ingrediente apareça mais de uma vez na receita
+    quantidades = {}
+    for ingrediente in ingredientes:
+        ingrediente_code = int(ingrediente["nCdIngrediente"])
+        quantidades[ingrediente_code] = quantidades.get(ingrediente_code, 0) + float(ingrediente["iQuantidade"])
+
+    return quantidades
+
+def __pesos_receita(ingredientes:list[dict]) -> dict[int, float]:
+    # A tabela soma os valores a cada 100g de cada ingrediente da receita, sem ponderar pela quantidade, e um ingrediente
+    # listado mais de uma vez entra uma vez por ocorrência (é assim que as tabelas salvas foram calculadas, mudar o peso
+    # exige recalcular as tabelas, as classificações e as contribuições já salvas).
+    # Percorre os ingredientes na mesma ordem do __somar_quantidades, para as chaves dos dois ficarem alinhadas
+    pesos = {}
+    for ingrediente in ingredientes:
+        ingrediente_code = int(ingrediente["nCdIngrediente"])
+        pesos[ingrediente_code] = pesos.get(ingrediente_code, 0) + 1.0
+
+    return pesos
+
+def __formatar_contribuicoes(quantidades:dict[int, float], contribuicoes:np.ndarray) -> dict[str, list[float]]:
+    # As chaves de um documento do MongoDB precisam ser strings
+    return {str(codigo):linha for codigo, linha in zip(quantidades.keys(), contribuicoes.tolist())}
+
+async def __gerar_tabela_nutricional(ingredientes:list[dict], porcao:float):
     """
     # Criador de tabela nutricional
     Método privado responsável por criar a tabela nutricional com todos os nutrientes e seus valores já calculados
@@ -104,83 +85,90 @@ def __gerar_tabela_nutricional(ingredientes:list[dict], porcao:float):
     Uma lista de dicinários com esse formato, onde nCdIngrediente é o código do ingrediente especificado na tabela principal, e iQuantidade é a quantidade desse ingrediente por porção
 
     ## Retorna uma lista com um:
-    ### ``DataFrame`` com as informações da tabela nutricional
-    Uma tabela com as colunas:
-    - ``Nutriente``: Nome da nutriente (seja ele caloria ou vitamina) em PT-BR
-    - ``100g``: Quantidade daquela nutriente em 100g
-    - ``200g``: Quantidade daquela nutriente em 200g
-    - ``VD`` : Porcentagem daquela nutriente no contexto geral da tabela
+    ### Dicionário com as informações da tabela nutricional
+    Contendo as listas (na mesma ordem):
+    - ``lNutrientes``: Nome da nutriente (seja ele caloria ou vitamina) em PT-BR
+    - ``lTotal``: Quantidade daquela nutriente na receita inteira
+    - ``lPorcao``: Quantidade daquela nutriente em uma porção
+    - ``lVd`` : Porcentagem do valor diário daquela nutriente em uma porção
+
+    E o ``jContribuicoes``, com quanto cada ingrediente contribui em cada nutriente (usado na atualização incremental)
 
     ### E o `total` que contém a quantidade total de volume/peso que a tabela contém    
     """
-    
-    # Informações da tabela
-    table_info = {
-        "nCaloria(kcal)":0,
-        "nProteina(g)":0,
-        "nCarboidrato(g)":0,
-        "nAcucar(g)":0,
-        "nFibra(g)":0,
-        "nGorduraTotal(g)":0,
-        "nGorduraSaturada(g)":0,
-        "nGorduraMonoinsaturada(g)":0,
-        "nGorduraPoliinsaturada(g)":0,
-        "nColesterol(mg)":0,
-        "nRetinol(mcg)":0,
-        "nTiamina(mg)":0,
-        "nRiboflavina(mg)":0,
-        "nNiacina(mg)":0,
-        "nVitB6(mg)":0,
-        "nFolato(mcg)":0,
-        "nColina(mg)":0,
-        "nVitB12(mcg)":0,
-        "nVitC(mg)":0,
-        "nVitD(mcg)":0,
-        "nVitE(mg)":0,
-        "nVitK(mcg)":0,
-        "nCalcio(mg)":0,
-        "nFosforo(mg)":0,
-        "nMagnesio(mg)":0,
-        "nFerro(mg)":0,
-        "nZinco(mg)":0,
-        "nCobre(mg)":0,
-        "nSelenio(mcg)":0,
-        "nPotassio(mg)":0,
-        "nSodio(mg)":0,
-        "nCafeina(mg)":0,
-        "nTeobromina(mg)":0,
-        "nAlcool(g)":0,
-        "nAgua(g)":0,
-    }
+    quantidades = __somar_quantidades(ingredientes)
+    total_amount = sum(quantidades.values())
 
-    total_amount = 0
+    # Sem ingredientes (ou com a soma das quantidades zerada) a porção e o VD seriam divisões por zero
+    if (len(quantidades) == 0 or total_amount <= 0):
+        raise Http_Exception(400, "A receita precisa ter ao menos um ingrediente com quantidade maior que zero")
 
-    # Percorrendo os ingredientes para adicionar as informações
-    for ingrediente in ingredientes:
-        total_amount += float(ingrediente["iQuantidade"])
-        ingrediente_code = int(ingrediente["nCdIngrediente"])
+    # Calculando a contribuição de cada ingrediente pela matriz de nutrientes em memória, a soma delas é o total da receita
+    contribuicoes = await matriz_nutrientes.contribuicoes(__pesos_receita(ingredientes))
+    totais = contribuicoes.sum(axis=0)
 
-        row = coll_ingrediente.aggregate([{"$match":{"_id":ingrediente_code}},
-                                         {"$project":{"_id":0, "cEmbedding":0,"cNmIngrediente":0, "cCategoria":0}}]).to_list()[0]
+    tabela = __montar_tabela(totais, total_amount, porcao)
+    tabela["jContribuicoes"] = __formatar_contribuicoes(quantidades, contribuicoes)
 
-        for key, value in row.items():
-            table_info[key] += value
+    return tabela, total_amount
 
-    nutrientes_info = {
-        "cNutriente":[nome_ptbr[key] for key in table_info.keys()], 
-        "nTotal":[value for value in table_info.values()],
-        "nPorcao":[value/total_amount*porcao for value in table_info.values()],
-        "nVD":[value/total_amount*porcao/vd_referencia[key]*100 if vd_referencia[key] != 0 else None for key, value in table_info.items()]
-        }
-    
-    df_final = pd.DataFrame(nutrientes_info)
+def __montar_documento(next_id:int, cod_produto:int, nome_tabela:str, total_tabela:float, porcao:float, unidade_de_medida:str, ingredientes:list[dict], tabela:dict) -> dict:
+    """
+    Cria o documento da tabela nutricional no formato da collection ``tabela``, ainda sem a avaliação
+    """
+    return {
+        "_id":next_id,
+        "nCdProduto":cod_produto,
+        "cNmTabela":nome_tabela,
+        "nTotal":total_tabela,
+        "nPorcao":porcao,
+        "cUnidadeMedida":unidade_de_medida,
+        "lIngredientes":ingredientes,
+        "lNutrientes":tabela["lNutrientes"],
+        "lTotal":tabela["lTotal"],
+        "lPorcao":tabela["lPorcao"],
+        "lVd":tabela["lVd"],
+        "jContribuicoes":tabela["jContribuicoes"],
+        # Incrementado a cada atualização, para que duas edições ao mesmo tempo não sobrescrevam uma a outra
+        "iVersao":1,
+    }
+
+def __montar_avaliacao(classificacao:str, score:int) -> dict:
+    # O comentário da IA começa pendente e é preenchido pelo job de comentário
+    return {
+        "cClassificacao":classificacao,
+        "iScore":score,
+        "cComentarios":"",
+        "cStatusComentario":COMENTARIO_PENDENTE,
+    }
+
+async def __enfileirar_comentarios(coll_tabela, codigos_tabela:list[int]):
+    """
+    Coloca na fila a geração do comentário de cada tabela e salva o id do job na tabela, para ser consultado em ``GET /jobs/{id}``
+    """
+    if (len(codigos_tabela) == 0):
+        return
+
+    try:
+        # Todos os jobs entram na fila com uma única ida ao Redis
+        jobs_ids = await enfileirar_jobs("comentario", [{"nCdTabela":cod_tabela} for cod_tabela in codigos_tabela])
+    except Exception as e:
+        # As tabelas já foram inseridas, então a fila cheia (429) ou o Redis fora do ar não podem falhar a criação (o cliente
+        # tentaria de novo e duplicaria a tabela). Sem o job o comentário nunca sairia de pendente, então ele fica como erro
+        print(f"Não foi possível enfileirar o comentário das tabelas {codigos_tabela}: {e}")
+        await coll_tabela.update_many({"_id":{"$in":codigos_tabela}}, {"$set":{"jAvaliacao.cStatusComentario":COMENTARIO_ERRO}})
+        return
+
+    operacoes = [UpdateOne({"_id":cod_tabela}, {"$set":{"jAvaliacao.cJobComentario":job_id}}) for cod_tabela, job_id in zip(codigos_tabela, jobs_ids)]
 
-    return df_final,total_amount
+    if (len(operacoes) > 0):
+        await coll_tabela.bulk_write(operacoes, ordered=False)
 
-def __inserir_tabela_bd(cod_produto:int, nome_tabela:str, total_tabela:float, porcao:float, unidade_de_medida:str,ingredientes:list[dict], tabela:dict):
+async def __inserir_tabela_bd(cod_produto:int, nome_tabela:str, total_tabela:float, porcao:float, unidade_de_medida:str,ingredientes:list[dict], tabela:dict) -> int:
     """
     # MongoDB ``insert``
-     Método responsável por inserir a tabela nutricional no formato correto dentro do MongoDB
+     Método responsável por inserir a tabela nutricional no formato correto dentro do MongoDB.
+     A tabela é inserida já com a classificação, e o comentário da IA é gerado depois pelo worker
 
     ## Parâmetros:
     - ``cod_produto``: Código do produto ao qual a tabela pertence
@@ -190,41 +178,26 @@ def __inserir_tabela_bd(cod_produto:int, nome_tabela:str, total_tabela:float, po
     - ``unidade_de_medida``: Unidade de medida da tabela (g, ml, kg, etc)
     - ``ingredientes``: Uma lista de dicionários contendo os ingredientes usados para criar a tabela, usado para criar a receita
     - ``tabela``: A tabela nutricional contendo todos os nutrientes e seus valores
+
+    ## Retorna
+    O código da tabela inserida
     """
     
     try:
+        coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+
         # Adquirindo o próximo ID que vai ser inserido
-        next_id = get_highest_id(coll_tabela)
+        next_id = await get_next_id(coll_tabela)
 
         # Criação do objeto base que vai ser inserido
-        tabela_banco = {
-        "_id":next_id,
-        "nCdProduto":cod_produto,
-        "cNmTabela":nome_tabela,
-        "nTotal":total_tabela,
-        "nPorcao":porcao,
-        "cUnidadeMedida":unidade_de_medida,
-        "lIngredientes":ingredientes,
-        "lNutrientes":tabela["cNutriente"],
-        "lTotal":tabela["nTotal"],
-        "lPorcao":tabela["nPorcao"],
-        "lVd":tabela["nVD"],
-        }
+        tabela_banco = __montar_documento(next_id, cod_produto, nome_tabela, total_tabela, porcao, unidade_de_medida, ingredientes, tabela)
 
         # Obtendo a classificação da tabela e seu score obtido pelo Nutri-Score
         classificacao, score = classificar(tabela_banco)
-
-        tabela_banco["jAvaliacao"] = {
-            "cClassificacao":classificacao,
-            "iScore":score,
-            "cComentarios":""
-        }
-
-        # Pegando a descrição/comentários da avaliação da tabela, gerado por IA
-        tabela_banco["jAvaliacao"]["cComentarios"] = descrever_avaliacao(tabela_banco)
+        tabela_banco["jAvaliacao"] = __montar_avaliacao(classificacao, score)
 
         # Inserindo a tabela no banco
-        coll_tabela.insert_one(tabela_banco)
+        await coll_tabela.insert_one(tabela_banco)
 
         print(f"A tabela {nome_tabela} foi inserida com sucesso")
 
@@ -232,54 +205,98 @@ def __inserir_tabela_bd(cod_produto:int, nome_tabela:str, total_tabela:float, po
         excecao = "Ocorreu um erro ao inserir no banco de dados. Erro: \n"+str(e)
         raise Exception(excecao)
 
+    # A descrição/comentários da avaliação, gerado por IA, não atrasa a criação da tabela
+    await __enfileirar_comentarios(coll_tabela, [next_id])
+
+    return next_id
+
 
 # ----------------------------------------
 # Obtendo informações do Redis
 # ----------------------------------------
 
-def criar_tabela_nutricional(cod_user:int):
+def __formatar_requisicao(cod_user:int, requisicao:dict) -> dict:
     """
-    # TableCreator
-    Função que cria automaticamente a tabela nutricional que o usuário pediu, e já insere dentro do MongoDB, recebendo apenas o código do usuário, as demais informações são recebidas a partir do Redis.
+    Converte o hash ``requisicao_user:<cod_user>`` do Redis (já decodificado em ``str``) para os tipos usados na criação da tabela
     """
-    try:
-        # Pegando parâmetros passados pelo Redis
-        nome_tabela = str(redis.hget(prefixo_requisicao_user+str(cod_user), "nome_tabela"))
-        nome_tabela = nome_tabela.removeprefix("b'").removesuffix("'")
-        
-        porcao = float(redis.hget(prefixo_requisicao_user+str(cod_user), "porcao_tabela"))
+    if (len(requisicao) == 0):
+        raise Exception(f"Não existe requisição no Redis para o usuário {cod_user}")
+
+    return {
+        "nome_tabela":requisicao["nome_tabela"],
+        "porcao":float(requisicao["porcao_tabela"]),
+        "ingredientes":json.loads(requisicao["ingredientes"]),
+        "unidade_de_medida":requisicao["unidade_medida"],
+        "cod_produto":float(requisicao["cod_produto"]),
+    }
 
-        ingredientes_redis = redis.hget(prefixo_requisicao_user+str(cod_user), "ingredientes")
+async def obter_requisicao_usuario(cod_user:int) -> dict:
+    """
+    Busca todos os parâmetros da requisição do usuário no Redis com um único ``HGETALL``
+    """
+    redis = await get_redis()
+    requisicao = await redis.hgetall(prefixo_requisicao_user+str(cod_user))
 
-        ingredientes = json.loads(ingredientes_redis.decode("utf-8"))
+    return __formatar_requisicao(cod_user, requisicao)
 
-        unidade_de_medida = str(redis.hget(prefixo_requisicao_user+str(cod_user), "unidade_medida"))
-        unidade_de_medida = unidade_de_medida.removeprefix("b'").removesuffix("'")
+async def obter_requisicoes_usuarios(cods_user:list[int]) -> dict[int, dict]:
+    """
+    # Busca em lote
+    Busca as requisições de vários usuários no Redis em uma única ida ao servidor (pipeline de ``HGETALL``), usado na geração de tabelas por fila
 
-        cod_produto = float(redis.hget(prefixo_requisicao_user+str(cod_user), "cod_produto"))
+    ## Retorna
+    Um dicionário ``{cod_user: requisicao}``, quando a requisição de um usuário não existe ou é inválida o valor é a ``Exception``
+    """
+    redis = await get_redis()
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for cod_user in cods_user:
+            pipe.hgetall(prefixo_requisicao_user+str(cod_user))
+        resultados = await pipe.execute()
+
+    requisicoes = {}
+    for cod_user, requisicao in zip(cods_user, resultados):
+        try:
+            requisicoes[cod_user] = __formatar_requisicao(cod_user, requisicao)
+        except Exception as e:
+            requisicoes[cod_user] = e
+
+    return requisicoes
+
+async def criar_tabela_nutricional(cod_user:int):
+    """
+    # TableCreator
+    Função que cria automaticamente a tabela nutricional que o usuário pediu, e já insere dentro do MongoDB, recebendo apenas o código do usuário, as demais informações são recebidas a partir do Redis.
+    """
+    try:
+        # Pegando parâmetros passados pelo Redis
+        requisicao = await obter_requisicao_usuario(cod_user)
 
+        nome_tabela = requisicao["nome_tabela"]
+        porcao = requisicao["porcao"]
+        ingredientes = requisicao["ingredientes"]
+        unidade_de_medida = requisicao["unidade_de_medida"]
+        cod_produto = requisicao["cod_produto"]
 
     except Exception as e:
         retorno = f"Ocorreu um erro ao tentar pegar os parâmetros para inserir a tabela nutricional do usuário {cod_user} \n Erro: {e}"
         raise Http_Exception(400, retorno)
     
     # Gerando a tabela nutricional
-    tabela, total_tabela = __gerar_tabela_nutricional(ingredientes, porcao)
-
-    tabela = tabela.to_dict('list')
+    tabela, total_tabela = await __gerar_tabela_nutricional(ingredientes, porcao)
 
     try:
         # Inserindo ela no MongoDB
-        __inserir_tabela_bd(cod_produto, nome_tabela, total_tabela, porcao, unidade_de_medida, ingredientes, tabela)
+        cod_tabela = await __inserir_tabela_bd(cod_produto, nome_tabela, total_tabela, porcao, unidade_de_medida, ingredientes, tabela)
 
-        retorno = f"Tabela nutricional do usuário {cod_user} foi inserida no MongoDB"
+        retorno = {"message":f"Tabela nutricional do usuário {cod_user} foi inserida no MongoDB", "nCdTabela":cod_tabela}
         return retorno
     
     except Exception as e:
         raise Http_Exception(400, e)
 
 
-def criar_tabela_nutricional_IA(
+async def criar_tabela_nutricional_IA(
         nome_tabela:str,
         porcao:float,
         ingredientes:list[dict],
@@ -291,15 +308,293 @@ def criar_tabela_nutricional_IA(
     Função que cria automaticamente a tabela nutricional que o usuário pediu, e já insere dentro do MongoDB, recebendo todas as informações necessarias para criar tabela
     """
     # Gerando a tabela nutricional
-    tabela, total_tabela = __gerar_tabela_nutricional(ingredientes, porcao)
-
-    tabela = tabela.to_dict('list')
+    tabela, total_tabela = await __gerar_tabela_nutricional(ingredientes, porcao)
 
     # Inserindo ela no MongoDB
-    __inserir_tabela_bd(cod_produto, nome_tabela, total_tabela, porcao, unidade_de_medida, ingredientes, tabela)
+    cod_tabela = await __inserir_tabela_bd(cod_produto, nome_tabela, total_tabela, porcao, unidade_de_medida, ingredientes, tabela)
 
-    retorno = f"Tabela nutricional {nome_tabela} foi inserida no MongoDB"
+    retorno = f"Tabela nutricional {nome_tabela} foi inserida no MongoDB com o código {cod_tabela}, o comentário da avaliação ainda está sendo gerado"
     return retorno
-    
 
-    
\ No newline at end of file
+
+# ----------------------------------------
+# Criação em lote
+# ----------------------------------------
+
+def __validar_receita(receita:dict) -> dict[int, float]:
+    """
+    Valida os campos de uma receita do lote e retorna as quantidades somadas por código de ingrediente
+    """
+    for campo in ("cNmTabela", "nPorcao", "cUnidadeMedida", "nCdProduto", "lIngredientes"):
+        if (receita.get(campo) is None):
+            raise Exception(f"O campo {campo} é obrigatório")
+
+    if (float(receita["nPorcao"]) <= 0):
+        raise Exception("O campo nPorcao deve ser maior que zero")
+
+    quantidades = __somar_quantidades(receita["lIngredientes"])
+
+    if (sum(quantidades.values()) <= 0):
+        raise Exception("A receita precisa ter ao menos um ingrediente com quantidade maior que zero")
+
+    return quantidades
+
+async def criar_tabelas_nutricionais_lote(receitas:list[dict]) -> list[dict]:
+    """
+    # TableCreator em lote
+    Cria várias tabelas nutricionais de uma vez: todas as receitas são calculadas com um único produto de matrizes,
+    classificadas em lote e inseridas no MongoDB com um único ``insert_many``
+
+    ## Parâmetros:
+    - ``receitas``: Lista de receitas no formato ``{cNmTabela, nPorcao, cUnidadeMedida, nCdProduto, lIngredientes}``,
+    onde ``lIngredientes`` é uma lista de ``{nCdIngrediente, iQuantidade}``
+
+    ## Retorna
+    Uma lista com o resultado de cada receita, na mesma ordem: ``{iIndice, cStatus: "ok", nCdTabela}`` ou ``{iIndice, cStatus: "erro", cErro}``
+    """
+    resultados = [None]*len(receitas)
+    validas = {}
+
+    for i, receita in enumerate(receitas):
+        try:
+            validas[i] = __validar_receita(receita)
+        except Exception as e:
+            resultados[i] = {"iIndice":i, "cStatus":"erro", "cErro":f"Receita inválida: {e}"}
+
+    # Verificando os ingredientes de todas as receitas de uma vez
+    codigos = {codigo for quantidades in validas.values() for codigo in quantidades.keys()}
+    faltantes = set(await matriz_nutrientes.garantir_ingredientes(codigos))
+
+    for i in list(validas.keys()):
+        faltantes_receita = [codigo for codigo in validas[i].keys() if codigo in faltantes]
+        if (len(faltantes_receita) > 0):
+            resultados[i] = {"iIndice":i, "cStatus":"erro", "cErro":f"Os ingredientes com os códigos {faltantes_receita} não foram encontrados no banco de dados"}
+            del validas[i]
+
+    if (len(validas) == 0):
+        return resultados
+
+    indices = list(validas.keys())
+
+    # Calculando todas as receitas com um único produto de matrizes
+    pesos = [__pesos_receita(receitas[i]["lIngredientes"]) for i in indices]
+    totais = matriz_nutrientes.calcular_lote(pesos)
+    contribuicoes = matriz_nutrientes.contribuicoes_lote(pesos)
+    totais_receita = np.array([sum(validas[i].values()) for i in indices], dtype=np.float64)
+
+    # Classificando todas as tabelas de uma vez pelo Nutri-Score
+    classificacoes, scores = classificar_lote(perfis_100g(totais, totais_receita))
+
+    coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+    ids = await reservar_ids(coll_tabela, len(indices))
+
+    documentos = []
+    for linha, (i, next_id) in enumerate(zip(indices, ids)):
+        receita = receitas[i]
+        total_tabela = float(totais_receita[linha])
+        porcao = float(receita["nPorcao"])
+
+        tabela = __montar_tabela(totais[linha], total_tabela, porcao)
+        tabela["jContribuicoes"] = __formatar_contribuicoes(validas[i], contribuicoes[linha])
+        documento = __montar_documento(next_id, receita["nCdProduto"], receita["cNmTabela"], total_tabela, porcao, receita["cUnidadeMedida"], receita["lIngredientes"], tabela)
+
+        documento["jAvaliacao"] = __montar_avaliacao(str(classificacoes[linha]), int(scores[linha]))
+
+        documentos.append((i, documento))
+
+    try:
+        await coll_tabela.insert_many([documento for _, documento in documentos], ordered=False)
+        erros = {}
+
+    except BulkWriteError as bwe:
+        # Com ordered=False os demais documentos são inseridos mesmo quando algum falha
+        erros = {erro["index"]:erro["errmsg"] for erro in bwe.details.get("writeErrors", [])}
+
+    inseridas = []
+    for posicao, (i, documento) in enumerate(documentos):
+        if (posicao in erros):
+            resultados[i] = {"iIndice":i, "cStatus":"erro", "cErro":f"Ocorreu um erro ao inserir no banco de dados. Erro: {erros[posicao]}"}
+        else:
+            resultados[i] = {"iIndice":i, "cStatus":"ok", "nCdTabela":documento["_id"]}
+            inseridas.append(documento["_id"])
+
+    # Os comentários da IA são gerados depois pelo worker, um job por tabela
+    await __enfileirar_comentarios(coll_tabela, inseridas)
+
+    return resultados
+
+
+# ----------------------------------------
+# Comentário da avaliação
+# ----------------------------------------
+
+async def gerar_comentario_tabela(cod_tabela:int) -> str:
+    """
+    # Comentário da avaliação
+    Gera o comentário da IA sobre a avaliação de uma tabela já inserida e salva ele no campo ``jAvaliacao.cComentarios``.
+    Executado pelo worker no job ``comentario``
+
+    ## Parâmetros:
+    - ``cod_tabela``: Código da tabela nutricional
+    """
+    coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+
+    tabela = await coll_tabela.find_one({"_id":cod_tabela}, {"jContribuicoes":0, "iVersao":0})
+    if (tabela is None):
+        raise Http_Exception(404, f"A tabela nutricional {cod_tabela} não existe")
+
+    # Enviando para a IA no mesmo formato de quando o comentário era gerado antes do insert
+    tabela["jAvaliacao"] = {
+        "cClassificacao":tabela["jAvaliacao"]["cClassificacao"],
+        "iScore":tabela["jAvaliacao"]["iScore"],
+        "cComentarios":"",
+    }
+
+    try:
+        comentario = await descrever_avaliacao(tabela)
+    except Exception:
+        await coll_tabela.update_one({"_id":cod_tabela}, {"$set":{"jAvaliacao.cStatusComentario":COMENTARIO_ERRO}})
+        raise
+
+    await coll_tabela.update_one(
+        {"_id":cod_tabela},
+        {"$set":{"jAvaliacao.cComentarios":comentario, "jAvaliacao.cStatusComentario":COMENTARIO_CONCLUIDO}}
+    )
+
+    return comentario
+
+async def obter_comentario_tabela(cod_tabela:int) -> dict:
+    """
+    Retorna o status do comentário da avaliação de uma tabela, junto com o comentário quando ele já foi gerado
+    """
+    coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+
+    tabela = await coll_tabela.find_one({"_id":cod_tabela}, {"jAvaliacao":1})
+    if (tabela is None):
+        raise Http_Exception(404, f"A tabela nutricional {cod_tabela} não existe")
+
+    avaliacao = tabela.get("jAvaliacao", {})
+
+    return {
+        "nCdTabela":cod_tabela,
+        "cClassificacao":avaliacao.get("cClassificacao"),
+        "iScore":avaliacao.get("iScore"),
+        # Tabelas criadas antes do comentário assíncrono não possuem o status
+        "cStatusComentario":avaliacao.get("cStatusComentario", COMENTARIO_CONCLUIDO),
+        "cJobComentario":avaliacao.get("cJobComentario"),
+        "cComentarios":avaliacao.get("cComentarios", ""),
+    }
+
+
+# ----------------------------------------
+# Atualização incremental
+# ----------------------------------------
+
+async def atualizar_tabela_nutricional(cod_tabela:int, ingredientes:list[dict], porcao:float = None) -> dict:
+    """
+    # Atualização da tabela
+    Altera a receita de uma tabela já existente sem recriar ela: apenas os ingredientes alterados são recalculados e a
+    diferença da contribuição deles é aplicada no ``lTotal`` (o ``lPorcao`` e o ``lVd`` são derivados dele).
+    O comentário da IA só é gerado novamente quando a classificação muda
+
+    ## Parâmetros:
+    - ``cod_tabela``: Código da tabela nutricional
+    - ``ingredientes``: Lista de ``{nCdIngrediente, iQuantidade}`` com a nova quantidade de cada ingrediente alterado,
+    ingredientes novos são adicionados e quantidade 0 remove o ingrediente da receita
+    - ``porcao``: Nova porção da tabela (opcional)
+    """
+    alteracoes = {}
+    for ingrediente in ingredientes:
+        alteracoes[int(ingrediente["nCdIngrediente"])] = float(ingrediente["iQuantidade"])
+
+    if (any(quantidade < 0 for quantidade in alteracoes.values())):
+        raise Http_Exception(400, "A quantidade de um ingrediente não pode ser negativa")
+    if (porcao is not None and porcao <= 0):
+        raise Http_Exception(400, "A porção deve ser maior que zero")
+
+    coll_tabela = await get_coll(COLLS["tabela_nutricional"])
+
+    tabela = await coll_tabela.find_one({"_id":cod_tabela}, {"lIngredientes":1, "lTotal":1, "nPorcao":1, "jContribuicoes":1, "jAvaliacao":1, "iVersao":1})
+    if (tabela is None):
+        raise Http_Exception(404, f"A tabela nutricional {cod_tabela} não existe")
+
+    quantidades = __somar_quantidades(tabela["lIngredientes"])
+    contribuicoes = tabela.get("jContribuicoes")
+
+    if (contribuicoes is None):
+        # Tabelas criadas antes das contribuições: calculando elas (e o total) uma única vez a partir da receita atual
+        calculadas = await matriz_nutrientes.contribuicoes(__pesos_receita(tabela["lIngredientes"]))
+        contribuicoes = __formatar_contribuicoes(quantidades, calculadas)
+        totais = calculadas.sum(axis=0)
+    else:
+        totais = np.array(tabela["lTotal"], dtype=np.float64)
+
+    novas = {codigo:quantidade for codigo, quantidade in alteracoes.items() if quantidade > 0}
+    removidas = [codigo for codigo, quantidade in alteracoes.items() if quantidade == 0 and str(codigo) in contribuicoes]
+
+    # Contribuição nova dos ingredientes adicionados ou alterados, cada um passa a aparecer uma única vez na receita
+    ingredientes_novos = [{"nCdIngrediente":codigo, "iQuantidade":quantidade} for codigo, quantidade in novas.items()]
+    novas_contribuicoes = __formatar_contribuicoes(novas, await matriz_nutrientes.contribuicoes(__pesos_receita(ingredientes_novos))) if len(novas) > 0 else {}
+
+    # Aplicando apenas a diferença de cada ingrediente alterado no total
+    zeros = np.zeros(len(NUTRIENTES), dtype=np.float64)
+    for codigo in list(novas.keys()) + removidas:
+        antiga = np.array(contribuicoes.get(str(codigo), zeros), dtype=np.float64)
+        nova = np.array(novas_contribuicoes.get(str(codigo), zeros), dtype=np.float64)
+        totais += nova - antiga
+
+    for codigo in removidas:
+        del contribuicoes[str(codigo)]
+        del quantidades[codigo]
+    contribuicoes.update(novas_contribuicoes)
+    quantidades.update(novas)
+
+    total_tabela = sum(quantidades.values())
+    if (total_tabela <= 0):
+        raise Http_Exception(400, "A receita precisa ter ao menos um ingrediente com quantidade maior que zero")
+
+    porcao = float(porcao) if porcao is not None else tabela["nPorcao"]
+
+    # Erros de arredondamento acumulados nas diferenças não podem deixar um nutriente negativo
+    totais = np.maximum(totais, 0)
+
+    tabela_nova = __montar_tabela(totais, total_tabela, porcao)
+    classificacoes, scores = classificar_lote(perfis_100g(totais[None, :], [total_tabela]))
+    classificacao, score = str(classificacoes[0]), int(scores[0])
+
+    avaliacao = tabela.get("jAvaliacao", {})
+    regerar_comentario = avaliacao.get("cClassificacao") != classificacao
+
+    atualizacao = {
+        "nTotal":total_tabela,
+        "nPorcao":porcao,
+        # Os ingredientes não alterados continuam como estavam (inclusive os repetidos), para a receita salva continuar
+        # batendo com as contribuições
+        "lIngredientes":[ingrediente for ingrediente in tabela["lIngredientes"] if int(ingrediente["nCdIngrediente"]) not in alteracoes] + ingredientes_novos,
+        "lTotal":tabela_nova["lTotal"],
+        "lPorcao":tabela_nova["lPorcao"],
+        "lVd":tabela_nova["lVd"],
+        "jContribuicoes":contribuicoes,
+        "jAvaliacao.cClassificacao":classificacao,
+        "jAvaliacao.iScore":score,
+    }
+    if (regerar_comentario):
+        atualizacao["jAvaliacao.cStatusComentario"] = COMENTARIO_PENDENTE
+
+    # A atualização só é aplicada se ninguém alterou a tabela desde a leitura
+    versao = tabela.get("iVersao")
+    resultado = await coll_tabela.update_one({"_id":cod_tabela, "iVersao":versao}, {"$set":atualizacao, "$inc":{"iVersao":1}})
+
+    if (resultado.matched_count == 0):
+        raise Http_Exception(409, f"A tabela nutricional {cod_tabela} foi alterada por outra requisição, tente novamente")
+
+    if (regerar_comentario):
+        await __enfileirar_comentarios(coll_tabela, [cod_tabela])
+
+    return {
+        "nCdTabela":cod_tabela,
+        "cClassificacao":classificacao,
+        "iScore":score,
+        "bComentarioRegerado":regerar_comentario,
+    }
+
@@ -8,11 +8,12 @@ Descrição do modelo: Utilizando uma chave do Gemini, a imagem é processada e
 
 # Modelo
 import os
-import google.generativeai as genai
 from pathlib import Path
 from PIL import Image
 from dotenv import load_dotenv
-from libs.Utils.Connection import get_coll, COLLS,get_highest_id
+from libs.Utils.Connection import COLLS
+from libs.Utils.AsyncConnection import get_coll, get_next_id
+from libs.MatrizNutrientes import matriz_nutrientes
 import json
 # from dotenv import load_dotenv
 
@@ -21,10 +22,12 @@ import json
 # Configuração básica do Gemini
 load_dotenv()
 api_key = os.getenv("GOOGLE_GEMINI_API")
-genai.configure(api_key=api_key)
 
 # Inicialize o modelo Gemini Pro Vision
-def processar_imagem(imagem, nome_ingrediente):
+async def processar_imagem(imagem, nome_ingrediente):
+    # Importado apenas no uso para não pesar a inicialização da API
+    import google.generativeai as genai
+
     model = genai.GenerativeModel("gemini-2.0-flash")
 
     caminho_modelo = Path(__file__).resolve().parent.parent / "docs" / "Models" / "Mongo" / "Ingrediente.json"
@@ -57,7 +60,7 @@ def processar_imagem(imagem, nome_ingrediente):
 
     # Gere a resposta
     genai.configure(api_key=api_key)
-    response = model.generate_content([prompt, imagem])
+    response = await model.generate_content_async([prompt, imagem])
     ingrediente = response.text    
 
     ingrediente = ingrediente.removeprefix("```json\n").removesuffix("```")
@@ -65,11 +68,18 @@ def processar_imagem(imagem, nome_ingrediente):
     ingrediente = list(json.loads(ingrediente))[0]
 
     # Realizando as modificações necessárias e inserindo no banco
-    cursor = get_coll(COLLS["ingrediente"])
+    cursor = await get_coll(COLLS["ingrediente"])
     
-    ingrediente["_id"] = get_highest_id(cursor)
+    ingrediente["_id"] = await get_next_id(cursor)
     ingrediente["cNmIngrediente"]= nome_ingrediente
 
-    cursor.insert_one(ingrediente)
+    await cursor.insert_one(ingrediente)
+
+    # Adicionando o novo ingrediente na matriz de nutrientes em memória, sem esperar a próxima recarga.
+    # O ingrediente já foi salvo, então um erro aqui não pode falhar o scanner (ele entra na matriz na próxima recarga)
+    try:
+        matriz_nutrientes.atualizar_ingrediente(ingrediente)
+    except Exception as e:
+        print(f"Não foi possível adicionar o ingrediente {ingrediente['_id']} na matriz de nutrientes: {e}")
 
     return ingrediente["_id"]
@@ -4,18 +4,19 @@ from pydantic import BaseModel, Field
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.schema import HumanMessage
 from libs.Utils.Exception import Http_Exception
-from libs.Utils.Connection import get_coll, COLLS, get_highest_id, get_api_key
+from libs.Utils.Connection import get_coll, COLLS, get_api_key
+from libs.Utils import AsyncConnection
+from libs.Utils.CacheEmbedding import obter_embedding, obter_embedding_async
+from libs.Utils.JanelaHistorico import texto_visivel
+from pymongo.errors import OperationFailure
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from pathlib import Path
-import google.generativeai as genai
 from dotenv import load_dotenv
-import os
-import json
+import time
 
 # Carrega a chave do arquivo .env
 load_dotenv()
-my_api_key = os.getenv("GOOGLE_GEMINI_API")
 
 
 # Escolha do modelo de embedding — o mais recente é o 'text-embedding-004'
@@ -23,10 +24,19 @@ model = "text-embedding-004"
 
 # ============================ Memória =========================== 
 
+class HistoricoChat(ChatMessageHistory):
+    # Resumo das mensagens mais antigas e quantas mensagens do histórico ele já cobre
+    cResumo: str = ""
+    iResumidas: int = 0
+
+    # Quantas mensagens já estão salvas no MongoDB, apenas as seguintes são enviadas no próximo set_history
+    iPersistidas: int = 0
+    bExiste: bool = False
+
 # Função que cria o objeto de memória da IA
-def create_ChatMessageHistory(messages_json:list[dict]) -> ChatMessageHistory:
+def create_ChatMessageHistory(messages_json:list[dict], cResumo:str = "", iResumidas:int = 0) -> HistoricoChat:
     # Objeto de memória da IA
-    history = ChatMessageHistory()
+    history = HistoricoChat(cResumo=cResumo, iResumidas=iResumidas, bExiste=True)
 
     # Passando por cada uma das mensagens e adicionando no objeto ChatMessageHistory
     for m in messages_json:
@@ -36,85 +46,153 @@ def create_ChatMessageHistory(messages_json:list[dict]) -> ChatMessageHistory:
             history.add_ai_message(m["content"])
         elif m["type"] == "system":
             history.add_system_message(m["content"])
-   
+
+    # O set_history usa o iPersistidas como posição em history.messages, então ele conta as mensagens que foram de fato
+    # adicionadas (mensagens de outros tipos são ignoradas acima), e não o tamanho do lMemoria salvo
+    history.iPersistidas = len(history.messages)
+
     return history
 
+# Índice usado pela busca e pelo upsert da memória, criado uma única vez por processo
+_indice_memoria_criado = False
+
+# Momento da última tentativa de criar o índice que falhou, para tentar de novo só depois de INTERVALO_INDICE_MEMORIA
+_indice_memoria_falha = None
+INTERVALO_INDICE_MEMORIA = 60*10
+
+async def mesclar_chats_duplicados(cursor) -> int:
+    """
+    # Migração dos chats duplicados
+    A busca seguida de inserção antiga podia criar mais de um documento para o mesmo ``nCdUsuario`` + ``iChat``, o que
+    impede a criação do índice único. As mensagens dos duplicados são juntadas no documento mais antigo (em ordem de
+    ``_id``) e os demais são apagados. O resumo é descartado, pois as posições das mensagens mudam, e é gerado de novo pela TrIA
+
+    ## Retorna
+    A quantidade de documentos apagados
+    """
+    grupos = cursor.aggregate([
+        {"$group":{"_id":{"nCdUsuario":"$nCdUsuario", "iChat":"$iChat"}, "lIds":{"$push":"$_id"}, "iQtd":{"$sum":1}}},
+        {"$match":{"iQtd":{"$gt":1}}},
+    ])
+
+    apagados = 0
+    async for grupo in grupos:
+        documentos = await cursor.find({"_id":{"$in":grupo["lIds"]}}).sort("_id", 1).to_list(length=None)
+        principal, duplicados = documentos[0], documentos[1:]
+
+        await cursor.update_one({"_id":principal["_id"]}, {"$set":{
+            "lMemoria":[mensagem for documento in documentos for mensagem in documento.get("lMemoria", [])],
+            "lUser":[mensagem for documento in documentos for mensagem in documento.get("lUser", [])],
+            "lBot":[mensagem for documento in documentos for mensagem in documento.get("lBot", [])],
+            "cResumo":"",
+            "iResumidas":0,
+        }})
+        resultado = await cursor.delete_many({"_id":{"$in":[documento["_id"] for documento in duplicados]}})
+        apagados += resultado.deleted_count
+
+    return apagados
+
+async def _garantir_indice_memoria(cursor):
+    global _indice_memoria_criado, _indice_memoria_falha
+
+    if (_indice_memoria_criado):
+        return
+    if (_indice_memoria_falha is not None and time.monotonic() - _indice_memoria_falha < INTERVALO_INDICE_MEMORIA):
+        return
+
+    try:
+        try:
+            await cursor.create_index([("nCdUsuario", 1), ("iChat", 1)], unique=True, name="nCdUsuario_iChat")
+        except OperationFailure as e:
+            # Código 11000: já existem chats duplicados, que são mesclados antes de criar o índice de novo
+            if (e.code != 11000):
+                raise
+            apagados = await mesclar_chats_duplicados(cursor)
+            print(f"{apagados} documentos de chat duplicados foram mesclados antes de criar o índice único")
+            await cursor.create_index([("nCdUsuario", 1), ("iChat", 1)], unique=True, name="nCdUsuario_iChat")
+
+        _indice_memoria_criado = True
+    except Exception as e:
+        # Sem o índice a escrita ainda funciona, apenas sem a garantia de unicidade
+        _indice_memoria_falha = time.monotonic()
+        print(f"Não foi possível criar o índice único da memória do chat: {e}")
+
 # Função que busca a memória da IA
-def get_history(nCdUser:int, iChat:int = 1) -> ChatMessageHistory:
+async def get_history(nCdUser:int, iChat:int = 1) -> HistoricoChat:
     try:
         # Obtendo cursor que interage com o banco de dados
-        cursor = get_coll(COLLS["memoria"])
-
-        # Criando a agregação e filtros
-        agg = [{"$match": {"nCdUsuario": nCdUser, "iChat":iChat}}, {"$project":{"_id":0, "lMemoria":1}}]
+        cursor = await AsyncConnection.get_coll(COLLS["memoria"])
 
-        result = cursor.aggregate(agg).to_list()
+        # Buscando pelo índice nCdUsuario + iChat
+        result = await cursor.find_one({"nCdUsuario": nCdUser, "iChat":iChat}, {"_id":0, "lMemoria":1, "cResumo":1, "iResumidas":1})
 
         # Caso possua memória
-        if (len(result) > 0):
-            memoria = create_ChatMessageHistory(result[0]["lMemoria"])
+        if (result is not None):
+            memoria = create_ChatMessageHistory(result.get("lMemoria", []), result.get("cResumo", ""), result.get("iResumidas", 0))
             return memoria
         
         # Caso não possua vai retornar apenas um objeto de memória novo
-        return ChatMessageHistory()
+        return HistoricoChat()
 
     except Exception as ex:
         erro = f"Não foi possível obter a memória do chat do usuário {nCdUser}.\nErro: {ex}"
         raise Http_Exception(500, erro)
 
 # Função que insere a memória da IA dentro do MongoDB
-def set_history(nCdUsuario:int, history:ChatMessageHistory, iChat:int=1 ):
-    # Obtendo cursor que interage com o banco de dados
-    cursor = get_coll(COLLS["memoria"])
+async def set_history(nCdUsuario:int, history:ChatMessageHistory, iChat:int=1 ):
+    """
+    # Memória ``append-only``
+    Envia para o MongoDB apenas as mensagens criadas desde o último ``set_history`` (``$push`` com ``$each``), com upsert
+    pelo índice ``nCdUsuario`` + ``iChat``. O documento do chat nunca é reescrito inteiro.
 
-    # Tornando a memória em objetos que poderão ser colocados dentro do banco
-    lMemoria = [msg.model_dump() if not isinstance(msg, str) else HumanMessage(msg).model_dump() for msg in history.messages]
+    As mensagens novas são lidas antes do primeiro ``await``, então o histórico pode continuar recebendo mensagens
+    enquanto a escrita acontece, elas entram no próximo ``set_history``
+    """
+    # Tornando apenas as mensagens novas em objetos que poderão ser colocados dentro do banco
+    inicio = getattr(history, "iPersistidas", 0)
+    novas = list(history.messages[inicio:])
+
+    lMemoria = [msg.model_dump() if not isinstance(msg, str) else HumanMessage(msg).model_dump() for msg in novas]
     lUser = []
     lBot = []
 
     for memo in lMemoria:
-        # print(f"\n\nMemo: {memo}")
-        conteudo = str(memo["content"])
+        # Ignorando as memórias das conversas entre os agentes
+        conteudo = texto_visivel(memo["type"], memo["content"])
+        if (conteudo is None):
+            continue
+
         if (memo["type"] == "human"):
-            # Regra para adicionar quando for apenas texto
-            if ((not conteudo.startswith("{\"route\":")) and (not "\"dominio\":" in conteudo) and (not conteudo.startswith("{\"legal\":")) and (not conteudo.startswith("{\"pergunta_original\":"))):
-                lUser.append(conteudo)
-        elif (memo["type"] == "ai"):
-            # Regra para evitar as memórias das conversas entre os agentes
-            if (not "\"dominio\":" in conteudo and (not "\"resposta_small_talk\":null" in conteudo) and (not conteudo.startswith("{\"legal\":")) and (not "\"resposta_final\":" in conteudo)):
-                # Verificando se é small talk ou orquestrador
-                if ("\"resposta_small_talk\":" in conteudo):
-                    resposta_json = json.loads(conteudo)
-                    lBot.append(resposta_json.get("resposta_small_talk", ""))
-                else:
-                    lBot.append(conteudo)
-                    
-    
-    # Verificando pré-existência da memória no banco
-    memoria = cursor.find({"nCdUsuario":nCdUsuario, "iChat":iChat}).to_list()
-
-    if (len(memoria) > 0):
-        # Já existe
-        memoria = memoria[0]
-        cursor.update_one({"_id":memoria["_id"]}, {"$set": {"lBot": lBot, "lUser": lUser, "lMemoria": lMemoria}})
-
-    else:
-        # Não existe ainda
-
-        # Adquirindo o próximo ID que vai ser inserido
-        next_id = get_highest_id(cursor)
-
-        # Criando objeto novo que vai ser inserido e inserindo ele dentro da collection
-        memoria = {
-            "_id":next_id,
-            "nCdUsuario":nCdUsuario,
-            "iChat":iChat,
-            "lUser":lUser,
-            "lBot": lBot,
-            "lMemoria":lMemoria
-        }
-
-        cursor.insert_one(memoria)
+            lUser.append(conteudo)
+        else:
+            lBot.append(conteudo)
+
+    # Resumo das mensagens antigas, gerado pela TrIA
+    atualizacao = {
+        "$push": {
+            "lMemoria": {"$each": lMemoria},
+            "lUser": {"$each": lUser},
+            "lBot": {"$each": lBot},
+        },
+        "$set": {
+            "cResumo": getattr(history, "cResumo", ""),
+            "iResumidas": getattr(history, "iResumidas", 0),
+        },
+    }
+
+    # Obtendo cursor que interage com o banco de dados
+    cursor = await AsyncConnection.get_coll(COLLS["memoria"])
+    await _garantir_indice_memoria(cursor)
+
+    if (not getattr(history, "bExiste", False)):
+        # O _id só é reservado quando o chat ainda não existe, e só é usado se o upsert inserir o documento
+        atualizacao["$setOnInsert"] = {"_id": await AsyncConnection.get_next_id(cursor)}
+
+    await cursor.update_one({"nCdUsuario":nCdUsuario, "iChat":iChat}, atualizacao, upsert=True)
+
+    if (isinstance(history, HistoricoChat)):
+        history.iPersistidas = inicio + len(novas)
+        history.bExiste = True
 
 
 # ========================= Funções Extras ======================== 
@@ -151,13 +229,8 @@ def ingredient_find(
         # Criando a agregação e filtros
         agg = []
         if (cNmIngrediente):
-            genai.configure(api_key=my_api_key)
-            
-            # Gerando o embedding
-            query_emb = genai.embed_content(
-                    model=model,
-                    content=cNmIngrediente
-                )["embedding"]
+            # Gerando o embedding (ou pegando do cache)
+            query_emb = obter_embedding(cNmIngrediente, model)
                         
             agg.extend([{"$vectorSearch": {
                         "index": "vector_index",
@@ -198,11 +271,7 @@ def product_find(
         
         agg = []
         if (cNmProduto):
-            genai.configure(api_key=my_api_key)
-            query_emb = genai.embed_content(
-                    model=model,
-                    content=cNmProduto
-             )["embedding"]
+            query_emb = obter_embedding(cNmProduto, model)
             
             agg = [
                 {
@@ -290,7 +359,7 @@ class NutricionalTableInsertArgs(NutricionalTableFindArgs):
     lIngredientes: list[dict] = Field(default=..., description="Lista de dicionários que contém as chaves [cNmIngrediente, iQuantidade]")
 
 @tool("table_insert", args_schema=NutricionalTableInsertArgs)
-def table_insert(
+async def table_insert(
     nPorcao: float,
     lIngredientes: list[dict],
     nCdProduto: Optional[int] = None,
@@ -306,15 +375,11 @@ def table_insert(
         from libs.TableCreator import criar_tabela_nutricional_IA
 
         # Obtendo cursor que interage com o banco de dados para pegar os códigos dos ingredientes
-        cursor = get_coll(COLLS["ingrediente"])
+        cursor = await AsyncConnection.get_coll(COLLS["ingrediente"])
 
         for i in lIngredientes:
             nome_ingrediente = i.pop("cNmIngrediente")
-            genai.configure(api_key=my_api_key)
-            query_emb = genai.embed_content(
-                    model=model,
-                    content=nome_ingrediente
-                )["embedding"]
+            query_emb = await obter_embedding_async(nome_ingrediente, model)
             agg = [
                 {
                     "$vectorSearch": {
@@ -328,7 +393,7 @@ def table_insert(
                 {"$set": {"score": {"$meta": "vectorSearchScore"}}}
             ]
 
-            result = cursor.aggregate(agg).to_list()[0]
+            result = (await cursor.aggregate(agg).to_list(length=1))[0]
 
             if (result):
                 i["nCdIngrediente"] = int(result["_id"])
@@ -338,13 +403,9 @@ def table_insert(
             
         if (not nCdProduto):
             # Mudando o cursor para conectar na collection de produtos e buscar o código do produto
-            cursor = get_coll(COLLS["produto"])
+            cursor = await AsyncConnection.get_coll(COLLS["produto"])
             
-            genai.configure(api_key=my_api_key)
-            query_emb = genai.embed_content(
-                    model=model,
-                    content=cNmProduto
-             )["embedding"]
+            query_emb = await obter_embedding_async(cNmProduto, model)
             
             agg = [
                 {
@@ -359,7 +420,7 @@ def table_insert(
                 {"$set": {"score": {"$meta": "vectorSearchScore"}}}
             ]
 
-            result = cursor.aggregate(agg).to_list()[0]
+            result = (await cursor.aggregate(agg).to_list(length=1))[0]
 
             if (result):
                 nCdProduto = int(result["_id"])
@@ -368,7 +429,7 @@ def table_insert(
             
 
         # Criando tabela nutricional e colocando no banco
-        result = criar_tabela_nutricional_IA(cNmTabela, nPorcao, lIngredientes, cUnidadeMedida, nCdProduto)
+        result = await criar_tabela_nutricional_IA(cNmTabela, nPorcao, lIngredientes, cUnidadeMedida, nCdProduto)
 
         return {"status":"ok", "mesage":result}
 
@@ -10,49 +10,147 @@ from langchain_core.prompts import (
     FewShotChatMessagePromptTemplate, MessagesPlaceholder)
 
 from pydantic import BaseModel, Field
-from typing import Optional # padrao do python
+from typing import Optional, Union # padrao do python
 
-import os
 import json
+import asyncio
+import threading
 from dotenv import load_dotenv
 from libs.ToolsNutr_IA import TOOLS_BD, TOOLS_RAG, get_history, set_history, get_datetime, get_api_key
-
-today_local = get_datetime()
+from libs.Utils.ChavesApi import pool_chaves
+from libs.Utils.CacheSessoes import CacheSessoes
+from libs.Utils.JanelaHistorico import HistoricoJanela, ContadorTokens, RESUMO_ATIVO, mensagens_para_resumir
+from libs.Utils.PreClassificador import PreClassificador, exemplos_dos_shots, PRECLASSIFICADOR_ATIVO
 
 # Memória -------------------------------------------------
-store = {}
+# Sessões de cada usuário em memória (LRU com TTL), salvas no MongoDB em segundo plano
+sessoes = CacheSessoes(
+    carregar=get_history,
+    salvar=set_history
+)
  
 def get_session_history(session_id) -> ChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = get_history(session_id)
-    return store[session_id]
+    # A sessão é carregada de forma assíncrona no início do processa_pergunta_eventos, aqui apenas é lida
+    return sessoes.historico(session_id)
+
+def historico_do_papel(papel:str):
+    # Cada agente recebe apenas a janela do histórico definida para o seu papel (ver JanelaHistorico)
+    return lambda session_id: HistoricoJanela(sessoes.historico(session_id), papel)
+
+def _config(cod_usuario, etapa:str, contador:ContadorTokens = None) -> dict:
+    # O único estado de cada requisição: a sessão, a etapa e o contador de tokens
+    return {
+        "configurable":{"session_id":cod_usuario},
+        "metadata":{"etapa":etapa},
+        "callbacks":[contador] if contador is not None else [],
+    }
+
+# Tokens de entrada acumulados por etapa desde o início do processo
+tokens_por_etapa: dict[str, dict[str, int]] = {}
+
+def registrar_tokens(contador:ContadorTokens):
+    for etapa, tokens in contador.tokens.items():
+        total = tokens_por_etapa.setdefault(etapa, {"iPerguntas":0, "iTokens":0})
+        total["iPerguntas"] += 1
+        total["iTokens"] += tokens
+
+def get_stats_tokens() -> dict:
+    return {
+        etapa: {**total, "nMediaTokens":total["iTokens"]/total["iPerguntas"]}
+        for etapa, total in tokens_por_etapa.items()
+    }
+
+# Resumo das mensagens antigas, gerado em segundo plano depois da resposta
+_tarefas_resumo: dict[object, asyncio.Task] = {}
+
+async def atualizar_resumo(cod_usuario):
+    # O resumo é gerado depois da resposta, então a sessão é obtida de novo para não sair da memória enquanto isso
+    sessao = await sessoes.obter(cod_usuario)
+    try:
+        await _resumir_sessao(cod_usuario, sessao.historico)
+    finally:
+        sessoes.liberar(sessao)
+
+async def _resumir_sessao(cod_usuario, historico):
+    mensagens, resumidas = mensagens_para_resumir(historico)
+
+    if (len(mensagens) == 0):
+        return
+
+    conversa = "\n".join(f"{'Usuário' if mensagem.type == 'human' else 'Tria'}: {mensagem.content}" for mensagem in mensagens)
+
+    resposta = await get_llm_fast().ainvoke(
+        "Atualize o resumo de uma conversa entre um usuário e a Tria, assistente do app Nutria. "
+        "Mantenha em poucas frases os dados citados (ingredientes, produtos, tabelas, valores) e o que o usuário quer, sem inventar nada.\n\n"
+        f"Resumo atual: {historico.cResumo or '(vazio)'}\n\n"
+        f"Novas mensagens:\n{conversa}"
+    )
+
+    historico.cResumo = resposta.content
+    historico.iResumidas = resumidas
+    sessoes.marcar_alterada(cod_usuario)
+
+def _agendar_resumo(cod_usuario):
+    if (not RESUMO_ATIVO or cod_usuario in _tarefas_resumo):
+        return
+
+    async def resumir():
+        try:
+            await atualizar_resumo(cod_usuario)
+        except Exception as e:
+            print(f"Não foi possível atualizar o resumo do chat do usuário {cod_usuario}: {e}")
+        finally:
+            _tarefas_resumo.pop(cod_usuario, None)
+
+    _tarefas_resumo[cod_usuario] = asyncio.create_task(resumir())
+
+def _finalizar_turno(cod_usuario):
+    # A memória do chat é salva no MongoDB em segundo plano, assim como o resumo das mensagens antigas
+    sessoes.marcar_alterada(cod_usuario)
+    _agendar_resumo(cod_usuario)
 
 
 # LLMs ----------------------------------------------------
 load_dotenv() # Pegando as variáveis seguras
 
-api_key = get_api_key()
- 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash",
-    temperature=0.7,
-    top_p=0.95,
-    google_api_key=api_key
-)
+# As LLMs só são criadas no primeiro uso, evitando a ida ao MongoDB para buscar a chave da API no import do módulo
+api_key = None
+llm = None
+llm_fast = None
 
-llm_fast = ChatGoogleGenerativeAI( 
-    model="gemini-2.0-flash", # Modelo baseado em performance
-    temperature=0.2, # Modelo deterministico, não vai ser criativo. Vai ser direto para o usuário evitando modificar qualquer coisa
-    google_api_key=api_key
-)
+def get_llm() -> ChatGoogleGenerativeAI:
+    global api_key, llm
 
+    if (llm is None):
+        if (api_key is None):
+            api_key = get_api_key()
 
-# ===================== PROMPTS ===========================
+        llm = ChatGoogleGenerativeAI(
+            model="gemini-2.5-flash",
+            temperature=0.7,
+            top_p=0.95,
+            google_api_key=api_key
+        )
+
+    return llm
 
-example_prompt_base = ChatPromptTemplate.from_messages([
-    HumanMessagePromptTemplate.from_template("{human}"),
-    AIMessagePromptTemplate.from_template("{ai}"),
-])
+def get_llm_fast() -> ChatGoogleGenerativeAI:
+    global api_key, llm_fast
+
+    if (llm_fast is None):
+        if (api_key is None):
+            api_key = get_api_key()
+
+        llm_fast = ChatGoogleGenerativeAI( 
+            model="gemini-2.0-flash", # Modelo baseado em performance
+            temperature=0.2, # Modelo deterministico, não vai ser criativo. Vai ser direto para o usuário evitando modificar qualquer coisa
+            google_api_key=api_key
+        )
+
+    return llm_fast
+
+
+# ===================== PROMPTS ===========================
 
 # ---------------------- Guardrail ------------------------
 guardrail_system_prompt = ("system",
@@ -129,11 +227,6 @@ guardrail_shots = [
     }
 ]
 
-guardrail_few_shots = FewShotChatMessagePromptTemplate(
-    examples=guardrail_shots,
-    example_prompt=example_prompt_base
-)
-
 
 # ---------------------- Roteador -------------------------
 roteador_sytem_prompt = ("system",
@@ -155,6 +248,7 @@ roteador_sytem_prompt = ("system",
     ### PAPEL
     - Seu foco é acolher o usuário e manter o foco em ENGENHARIA DE ALIMENTOS E SUA LEGISLAÇÃO ou SOBRE O APP ou AÇÕES QUE AFETEM O BANCO DE DADOS
     - Decidir as rotas: {{engenharia | app | dados | analise_completa | small_talk}}.
+    - Quando a pergunta precisar de mais de um especialista, retorne uma lista com todas as rotas necessárias (ex.: ["dados", "app"]).
     - Responder diretamente (small_talk,) em:
     (a) saudações/small talk, ou 
     (b) fora de escopo (redirecionando para rotas pré-estabelecidas anteriormente).
@@ -188,7 +282,7 @@ roteador_sytem_prompt = ("system",
         SEMPRE RETORNE NESSE FORMATO
         Campos mínimos para enviar (ou não) para os especialistas:
         # Obrigatórios:
-        - route : "engenharia" | "app" | "dados" | "analise_completa" |"small_talk"
+        - route : "engenharia" | "app" | "dados" | "analise_completa" |"small_talk" ou uma lista de especialistas, ex: ["dados", "app"]
         
         # Quando for "small_talk":
         - resposta_small_talk : Resposta simples
@@ -206,7 +300,7 @@ roteador_sytem_prompt = ("system",
 
 # Formato de saída
 class RoteadorResposta(BaseModel):
-    route: str = Field(..., description="Uma rota que o fluxo vai seguir, caso seja 'small_talk' preencha o campo 'resposta_small_talk'")
+    route: Union[str, list[str]] = Field(..., description="Uma rota que o fluxo vai seguir, ou uma lista de rotas de especialistas quando a pergunta precisa de mais de um. Caso seja 'small_talk' preencha o campo 'resposta_small_talk'")
     resposta_small_talk: Optional[str] = Field(default=None, description="Preenchido apenas quando a rota for 'small_talk', contendo respostas simples e pequenas como saudações, clarificações ou redirecionando perguntas para o contexto correto")
     pergunta_original: Optional[str] = Field(default=None, description="Mensagem completa do usuário, sem edições")
     persona: Optional[str] = Field(default=None, description="Copie o bloco '{PERSONA SISTEMA}' daqui")
@@ -276,10 +370,10 @@ roteador_shots = [
     },
 ]
 
-roteador_fewshots = FewShotChatMessagePromptTemplate(
-    examples=roteador_shots,
-    example_prompt=example_prompt_base
-)
+
+# ------------------- Pré-classificador -------------------
+# Saudações, ofensas e pedidos fora do escopo com alta confiança são respondidos sem chamar o guardrail e o roteador
+preclassificador = PreClassificador(exemplos_dos_shots(guardrail_shots, roteador_shots))
 
 
 # Agentes especialistas -----------------------------------
@@ -466,11 +560,6 @@ bd_shots = [
     },
 ]
 
-bd_fewshots = FewShotChatMessagePromptTemplate(
-    examples=bd_shots,
-    example_prompt=example_prompt_base
-)
-
 # --------------------- Engenharia ------------------------
 engenharia_system_prompt = ("system",
     """                    
@@ -677,11 +766,6 @@ engenharia_shots = [
     },
 ]
 
-engenharia_fewshots = FewShotChatMessagePromptTemplate(
-    examples=engenharia_shots,
-    example_prompt=example_prompt_base
-)
-
 # ------------------------- App ---------------------------
 app_system_prompt = ("system", 
     """
@@ -777,11 +861,6 @@ app_shots = [
     },
 ]
 
-app_fewshots = FewShotChatMessagePromptTemplate(
-    examples=app_shots,
-    example_prompt=example_prompt_base
-)
-
 # -------------------- Orquestrador -----------------------
 orquestrador_system_prompt = ("system",
     """
@@ -852,11 +931,6 @@ orquestrador_shots = [
     }
 ]
 
-orquestrador_fewshots = FewShotChatMessagePromptTemplate(
-    examples=orquestrador_shots,
-    example_prompt=example_prompt_base
-)
-
 # ------------------------ Juiz ---------------------------
 juiz_system_prompt = ("system",
 """
@@ -924,67 +998,85 @@ juiz_shots = [
     }
 ]
 
-juiz_few_shots = FewShotChatMessagePromptTemplate(
-    examples=juiz_shots,
-    example_prompt=example_prompt_base
-)
+# Criando objeto de prompts, montado apenas no primeiro uso
+prompts = None
 
-# Criando objeto de prompts
-prompts = {
-    "guardrail": ChatPromptTemplate.from_messages([
-        guardrail_system_prompt,
-        guardrail_few_shots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]),
-    "roteador": ChatPromptTemplate.from_messages([
-        roteador_sytem_prompt,
-        roteador_fewshots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]).partial(today_local = today_local),
-    "dados": ChatPromptTemplate.from_messages([
-        bd_system_prompt,
-        bd_fewshots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-        MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
-    ]).partial(today_local = today_local),
-    "engenharia": ChatPromptTemplate.from_messages([
-        engenharia_system_prompt,
-        engenharia_fewshots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-        MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
-    ]).partial(today_local = today_local),
-    "app": ChatPromptTemplate.from_messages([
-        app_system_prompt,
-        app_fewshots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-        MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
-    ]).partial(today_local = today_local),
-    "orquestrador": ChatPromptTemplate.from_messages([
-        orquestrador_system_prompt,
-        orquestrador_fewshots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]).partial(today_local = today_local),
-    "juiz": ChatPromptTemplate.from_messages([
-        juiz_system_prompt,
-        juiz_few_shots,
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]),
-}
+def _few_shots(shots:list[dict]) -> FewShotChatMessagePromptTemplate:
+    example_prompt_base = ChatPromptTemplate.from_messages([
+        HumanMessagePromptTemplate.from_template("{human}"),
+        AIMessagePromptTemplate.from_template("{ai}"),
+    ])
+
+    return FewShotChatMessagePromptTemplate(
+        examples=shots,
+        example_prompt=example_prompt_base
+    )
+
+def get_prompts() -> dict[str, ChatPromptTemplate]:
+    global prompts
+
+    if (prompts is not None):
+        return prompts
+
+    today_local = get_datetime()
+
+    prompts = {
+        "guardrail": ChatPromptTemplate.from_messages([
+            guardrail_system_prompt,
+            _few_shots(guardrail_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]),
+        "roteador": ChatPromptTemplate.from_messages([
+            roteador_sytem_prompt,
+            _few_shots(roteador_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]).partial(today_local = today_local),
+        "dados": ChatPromptTemplate.from_messages([
+            bd_system_prompt,
+            _few_shots(bd_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
+        ]).partial(today_local = today_local),
+        "engenharia": ChatPromptTemplate.from_messages([
+            engenharia_system_prompt,
+            _few_shots(engenharia_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
+        ]).partial(today_local = today_local),
+        "app": ChatPromptTemplate.from_messages([
+            app_system_prompt,
+            _few_shots(app_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad") # llm fazendo um bloco de anotações, dando total liberdade para o agente mudar o promptm, para implementação de tools
+        ]).partial(today_local = today_local),
+        "orquestrador": ChatPromptTemplate.from_messages([
+            orquestrador_system_prompt,
+            _few_shots(orquestrador_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]).partial(today_local = today_local),
+        "juiz": ChatPromptTemplate.from_messages([
+            juiz_system_prompt,
+            _few_shots(juiz_shots),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]),
+    }
+
+    return prompts
 
 
 # =========================================================
 # Criação dos agentes
 def criar_guardrail():
     guardrail_pipeline = (
-        prompts["guardrail"]
-        | llm
+        get_prompts()["guardrail"]
+        | get_llm()
         | PydanticOutputParser(pydantic_object=GuardRailResposta)
     )
 
@@ -994,7 +1086,7 @@ def criar_guardrail():
 
     return RunnableWithMessageHistory( 
         guardrail_json_string, # Usa o Runnable que retorna a string JSON 
-        get_session_history=get_session_history, 
+        get_session_history=historico_do_papel("guardrail"), 
         history_messages_key="chat_history", 
         input_messages_key="input", 
         handle_parsing_errors=False)
@@ -1002,8 +1094,8 @@ def criar_guardrail():
 def criar_roteador():
     # 1. Cria a pipeline do roteador que retorna o OBJETO Pydantic (um RunnableSequence)
     roteador_pipeline = (
-        prompts["roteador"] 
-        | llm_fast 
+        get_prompts()["roteador"] 
+        | get_llm_fast() 
         | PydanticOutputParser(pydantic_object=RoteadorResposta)
     )
     
@@ -1014,15 +1106,15 @@ def criar_roteador():
     # 3. Encapsula o novo runnable com o histórico
     return RunnableWithMessageHistory(
         roteador_json_string, # Usa o Runnable que retorna a string JSON
-        get_session_history=get_session_history,
+        get_session_history=historico_do_papel("roteador"),
         history_messages_key="chat_history",
         input_messages_key="input", handle_parsing_errors=False)
 
 def criar_bd_agent():
     bd_agent = create_tool_calling_agent(
-        llm=llm,
+        llm=get_llm(),
         tools=TOOLS_BD,
-        prompt=prompts["dados"]
+        prompt=get_prompts()["dados"]
     )
     bd_executor_base = AgentExecutor(
         agent=bd_agent,
@@ -1033,7 +1125,7 @@ def criar_bd_agent():
     )
     bd_executor = RunnableWithMessageHistory(
         bd_executor_base,
-        get_session_history=get_session_history,
+        get_session_history=historico_do_papel("especialista"),
         input_messages_key='input',
         history_messages_key='chat_history'
     )
@@ -1042,9 +1134,9 @@ def criar_bd_agent():
 
 def criar_engenharia_agent():
     engenharia_agent = create_tool_calling_agent(
-        llm=llm,
+        llm=get_llm(),
         tools=[],
-        prompt=prompts["engenharia"]
+        prompt=get_prompts()["engenharia"]
     )
     engenharia_executor_base = AgentExecutor(
         agent=engenharia_agent,
@@ -1055,7 +1147,7 @@ def criar_engenharia_agent():
     )
     engenharia_executor = RunnableWithMessageHistory(
         engenharia_executor_base,
-        get_session_history=get_session_history,
+        get_session_history=historico_do_papel("especialista"),
         input_messages_key='input',
         history_messages_key='chat_history'
     )
@@ -1063,9 +1155,9 @@ def criar_engenharia_agent():
 
 def criar_app_agent():
     app_agent = create_tool_calling_agent(
-        llm=llm,
+        llm=get_llm(),
         tools=TOOLS_RAG,
-        prompt=prompts["app"]
+        prompt=get_prompts()["app"]
     )
     app_executor_base = AgentExecutor(
         agent=app_agent,
@@ -1076,7 +1168,7 @@ def criar_app_agent():
     )
     app_executor = RunnableWithMessageHistory(
         app_executor_base,
-        get_session_history=get_session_history,
+        get_session_history=historico_do_papel("especialista"),
         input_messages_key='input',
         history_messages_key='chat_history'
     )
@@ -1085,8 +1177,8 @@ def criar_app_agent():
 
 def criar_orquestrador():
     orquestrador_pipeline = (
-        prompts["orquestrador"]
-        | llm_fast
+        get_prompts()["orquestrador"]
+        | get_llm_fast()
         | PydanticOutputParser(pydantic_object=OrquestradorResposta)
     )
 
@@ -1096,21 +1188,21 @@ def criar_orquestrador():
 
     return RunnableWithMessageHistory( 
         orquestrador_json_string, # Usa o Runnable que retorna a string JSON 
-        get_session_history=get_session_history, 
+        get_session_history=historico_do_papel("orquestrador"), 
         history_messages_key="chat_history", 
         input_messages_key="input", 
         handle_parsing_errors=False)
 
 def criar_juiz():
     juiz_pipeline = (
-        prompts["juiz"]
-        | llm
+        get_prompts()["juiz"]
+        | get_llm()
         | StrOutputParser()
     )
 
     return RunnableWithMessageHistory( 
         juiz_pipeline, # Usa o Runnable que retorna a string JSON 
-        get_session_history=get_session_history, 
+        get_session_history=historico_do_papel("juiz"), 
         history_messages_key="chat_history", 
         input_messages_key="input", 
         handle_parsing_errors=False)
@@ -1123,55 +1215,187 @@ def criar_especialista(especialista:str):
     else:
         return criar_engenharia_agent()
 
-def fluxo_analise_completa(usuario, nCdUsuario):
-    analise_completa = []
-    bd = criar_bd_agent()
+# Agentes montados uma única vez por processo ------------
+# Os runnables não guardam estado da conversa (a sessão vem do config de cada chamada), então são compartilhados
+# entre as requisições. Eles só são recriados quando a chave da API é trocada, pois guardam a LLM
+CONSTRUTORES = {
+    "guardrail": criar_guardrail,
+    "roteador": criar_roteador,
+    "dados": criar_bd_agent,
+    "app": criar_app_agent,
+    "engenharia": criar_engenharia_agent,
+    "orquestrador": criar_orquestrador,
+    "juiz": criar_juiz,
+}
 
-    resposta_bd = bd.invoke(
-        {"input":usuario},
-        config={"configurable":{"session_id":nCdUsuario}} 
-    )["output"]
+agentes = {}
+_lock_agentes = threading.Lock()
 
-    analise_completa.append(resposta_bd)
+def get_agente(nome:str):
+    agente = agentes.get(nome)
 
-    engenharia = criar_engenharia_agent()
+    if (agente is None):
+        # O aquecimento roda em uma thread, então a montagem é protegida para não criar o mesmo agente duas vezes
+        with _lock_agentes:
+            agente = agentes.get(nome)
+            if (agente is None):
+                agente = CONSTRUTORES[nome]()
+                agentes[nome] = agente
 
-    entrada_engenharia = usuario + f"\n Resposta Banco de dados: {resposta_bd}"
-    resposta_engenharia = engenharia.invoke(
-        {"input":entrada_engenharia},
-        config={"configurable":{"session_id":nCdUsuario}} 
-    )["output"]
+    return agente
 
-    analise_completa.append(resposta_engenharia)
+def aquecer_agentes():
+    for nome in CONSTRUTORES.keys():
+        get_agente(nome)
 
-    return analise_completa
 
+# Especialistas que o roteador pode escolher, e os que precisam da resposta de outro para começar.
+# Os independentes rodam ao mesmo tempo, a engenharia espera os dados quando os dois foram escolhidos
+ESPECIALISTAS = ["dados", "app", "engenharia"]
+DEPENDENCIAS = {
+    "engenharia": ["dados"],
+}
+ROTULOS = {
+    "dados": "Banco de dados",
+    "app": "App",
+    "engenharia": "Engenharia",
+}
+
+def normalizar_rotas(route) -> list[str]:
+    """
+    Converte a rota do roteador (uma rota ou uma lista) na lista de especialistas que vão ser executados,
+    ``analise_completa`` equivale a ``["dados", "engenharia"]`` e ``small_talk`` retorna uma lista vazia
+    """
+    rotas = [route] if isinstance(route, str) else list(route)
+
+    if ("small_talk" in rotas):
+        return []
+
+    especialistas = []
+    for rota in rotas:
+        for especialista in (["dados", "engenharia"] if rota == "analise_completa" else [rota]):
+            if (especialista in ESPECIALISTAS and especialista not in especialistas):
+                especialistas.append(especialista)
+
+    # Rota desconhecida segue para a engenharia, assim como no criar_especialista
+    return especialistas if len(especialistas) > 0 else ["engenharia"]
+
+async def executar_especialistas(rotas:list[str], entrada:str, nCdUsuario, contador:ContadorTokens = None) -> list:
+    """
+    # Execução dos especialistas
+    Executa os especialistas escolhidos em ondas: cada onda roda ao mesmo tempo todos os especialistas cujas dependências
+    (entre os escolhidos) já responderam, repassando a resposta delas na entrada
+
+    ## Retorna
+    As respostas dos especialistas na ordem de ``rotas``
+    """
+    respostas = {}
+    pendentes = list(rotas)
+
+    async def executar(especialista:str):
+        entrada_especialista = entrada
+        for dependencia in DEPENDENCIAS.get(especialista, []):
+            if (dependencia in respostas):
+                entrada_especialista += f"\n Resposta {ROTULOS[dependencia]}: {respostas[dependencia]}"
+
+        resposta = await get_agente(especialista).ainvoke(
+            {"input":entrada_especialista},
+            config=_config(nCdUsuario, f"especialista_{especialista}", contador)
+        )
+
+        return resposta["output"] if "output" in resposta else resposta
+
+    while (len(pendentes) > 0):
+        onda = [especialista for especialista in pendentes if all(dependencia in respostas or dependencia not in rotas for dependencia in DEPENDENCIAS.get(especialista, []))]
+
+        if (len(onda) == 0):
+            raise Exception(f"Dependência circular entre os especialistas: {pendentes}")
+
+        resultados = await asyncio.gather(*[executar(especialista) for especialista in onda])
+
+        for especialista, resposta in zip(onda, resultados):
+            respostas[especialista] = resposta
+            pendentes.remove(especialista)
+
+    return [respostas[especialista] for especialista in rotas]
+
+async def fluxo_analise_completa(usuario, nCdUsuario):
+    return await executar_especialistas(["dados", "engenharia"], usuario, nCdUsuario)
+
+
+def _evento_etapa(etapa:str, **dados) -> dict:
+    return {"cTipo":"etapa", "cEtapa":etapa, **dados}
+
+async def processa_pergunta_eventos(pergunta_usuario, cod_usuario):
+    """
+    # Pipeline da TrIA em eventos
+    Executa pré-classificador → guardrail → roteador → especialistas → orquestrador → juiz, gerando um evento quando cada etapa termina.
+    Quando o pré-classificador responde, as demais etapas não são executadas.
+    A resposta do juiz é gerada em streaming, com um evento ``token`` a cada pedaço de texto
+
+    ## Eventos
+    - ``{cTipo: "etapa", cEtapa, ...}``: Uma etapa do pipeline terminou
+    - ``{cTipo: "token", cTexto}``: Pedaço da resposta final
+    - ``{cTipo: "resposta", cResposta, jTokens}``: Resposta final completa com os tokens de entrada de cada etapa, sempre o último evento
+    """
+    # Carregando a memória do chat, só vai ao MongoDB quando a sessão não está em memória
+    sessao = await sessoes.obter(cod_usuario)
+
+    try:
+        # Mensagens do mesmo usuário são respondidas uma de cada vez, para não misturar o histórico
+        async with sessao.lock:
+            async for evento in _pipeline_pergunta(pergunta_usuario, cod_usuario, ContadorTokens()):
+                yield evento
+    finally:
+        # A sessão só pode sair da memória depois que a resposta terminou
+        sessoes.liberar(sessao)
+
+async def _pipeline_pergunta(pergunta_usuario, cod_usuario, contador:ContadorTokens):
+    # Tentando responder localmente antes das chamadas do guardrail e do roteador
+    pre_classificacao = await preclassificador.classificar(pergunta_usuario) if PRECLASSIFICADOR_ATIVO else None
+
+    if (pre_classificacao is not None):
+        yield _evento_etapa("preclassificador", cRotulo=pre_classificacao["cRotulo"], cMetodo=pre_classificacao["cMetodo"])
+
+        # Salvando a troca no histórico como o guardrail/roteador salvariam (a recusa fica fora da janela dos agentes)
+        historico = sessoes.historico(cod_usuario)
+        historico.add_user_message(pergunta_usuario)
+        if (pre_classificacao["cRotulo"] == "ofensa"):
+            historico.add_ai_message(GuardRailResposta(legal=False, pergunta_original=pergunta_usuario, resposta=pre_classificacao["cResposta"]).model_dump_json())
+        else:
+            historico.add_ai_message(pre_classificacao["cResposta"])
+
+        _finalizar_turno(cod_usuario)
+        registrar_tokens(contador)
+        yield {"cTipo":"resposta", "cResposta":pre_classificacao["cResposta"], "jTokens":contador.tokens}
+        return
 
-def processa_pergunta(pergunta_usuario, cod_usuario):
     # Aplicando o guardrail para a IA
-    guardrail = criar_guardrail()
+    guardrail = get_agente("guardrail")
 
-    resposta_guardrail_json = guardrail.invoke(
+    resposta_guardrail_json = await guardrail.ainvoke(
         {"input":pergunta_usuario}, 
-        config={"configurable": {"session_id": cod_usuario}}
+        config=_config(cod_usuario, "guardrail", contador)
     )
     
     resposta_guardrail = GuardRailResposta.model_validate_json(resposta_guardrail_json)
+    yield _evento_etapa("guardrail", bLegal=resposta_guardrail.legal)
 
     if (not resposta_guardrail.legal):
-        # Salvando a memória do chat no MongoDB
-        set_history(cod_usuario, store[cod_usuario])
-        return resposta_guardrail.resposta
+        _finalizar_turno(cod_usuario)
+        registrar_tokens(contador)
+        yield {"cTipo":"resposta", "cResposta":resposta_guardrail.resposta, "jTokens":contador.tokens}
+        return
 
     # Criando o agente roteador que irá dizer qual fluxo a conversa deverá seguir
-    roteador = criar_roteador()
+    roteador = get_agente("roteador")
 
     guardrail_saida_json = str(resposta_guardrail.model_dump_json())
 
     # Obtendo a resposta do roteador
-    resposta_roteador_json = roteador.invoke(
+    resposta_roteador_json = await roteador.ainvoke(
         {"input":guardrail_saida_json}, 
-        config={"configurable": {"session_id": cod_usuario}}
+        config=_config(cod_usuario, "roteador", contador)
     )
 
     # Transformando a resposta do roteador de volta no objeto da classe RoteadorResposta
@@ -1179,43 +1403,33 @@ def processa_pergunta(pergunta_usuario, cod_usuario):
 
     # Adquirindo todas as rotas que o roteador quer que siga
     rota = resposta_roteador.route
+    rotas = normalizar_rotas(rota)
+    yield _evento_etapa("roteador", lRotas=rotas if len(rotas) > 0 else ["small_talk"])
     
     # Caso seja small_talk, vai retornar somente a resposta small_talk sem nem criar os outros agentes
-    if "small_talk" == rota:
-        # Salvando a memória do chat no MongoDB
-        set_history(cod_usuario, store[cod_usuario])
-        return resposta_roteador.resposta_small_talk
+    if (len(rotas) == 0):
+        _finalizar_turno(cod_usuario)
+        registrar_tokens(contador)
+        yield {"cTipo":"resposta", "cResposta":resposta_roteador.resposta_small_talk, "jTokens":contador.tokens}
+        return
     
-    # Pegando as respostas dos especialistas
-    respostas_especialistas = []
-
+    # Pegando as respostas dos especialistas, os independentes são executados ao mesmo tempo
     entrada_json = str(resposta_roteador.model_dump_json())
-    
-    if rota == "analise_completa":
-        respostas_especialistas = fluxo_analise_completa(entrada_json, cod_usuario)
-    else:
-        especialista = criar_especialista(rota)
+    respostas_especialistas = await executar_especialistas(rotas, entrada_json, cod_usuario, contador)
 
-        resposta_especialista = especialista.invoke(
-            {"input":entrada_json},
-            config={"configurable":{"session_id":cod_usuario}}
-        )
-
-        if "output" in resposta_especialista:
-            respostas_especialistas.append(resposta_especialista["output"])
-        else:
-            respostas_especialistas.append(resposta_especialista)
+    yield _evento_etapa("especialistas")
 
     # Criando o orquestrador para gerar a resposta final
-    orquestrador = criar_orquestrador()
+    orquestrador = get_agente("orquestrador")
 
     # Gerando a resposta final com todas as respostas dos especialistas e retornando
-    resposta_final_json = orquestrador.invoke(
+    resposta_final_json = await orquestrador.ainvoke(
         {"input":respostas_especialistas},
-        config={"configurable":{"session_id":cod_usuario}}
+        config=_config(cod_usuario, "orquestrador", contador)
     )
 
     resposta_final = OrquestradorResposta.model_validate_json(resposta_final_json)
+    yield _evento_etapa("orquestrador")
 
     # Realizando verificação com juiz
     juiz_entrada = {
@@ -1225,52 +1439,104 @@ def processa_pergunta(pergunta_usuario, cod_usuario):
 
     juiz_entrada = json.dumps(juiz_entrada) # Transformando em um JSON string
 
-    juiz = criar_juiz()
+    juiz = get_agente("juiz")
 
-    resposta_juiz = juiz.invoke(
+    # A resposta do juiz é a resposta final, então ela é enviada em pedaços conforme é gerada
+    pedacos = []
+    async for pedaco in juiz.astream(
         {"input":juiz_entrada}, 
-        config={"configurable": {"session_id": cod_usuario}}
-    )
+        config=_config(cod_usuario, "juiz", contador)
+    ):
+        pedacos.append(pedaco)
+        yield {"cTipo":"token", "cTexto":pedaco}
+
+    resposta_final = "".join(pedacos)
+
+    _finalizar_turno(cod_usuario)
+
+    # Tokens de entrada enviados em cada etapa, para acompanhar o tamanho dos prompts
+    registrar_tokens(contador)
+    yield {"cTipo":"resposta", "cResposta":resposta_final, "jTokens":contador.tokens}
 
-    resposta_final = resposta_juiz
+async def processa_pergunta(pergunta_usuario, cod_usuario):
+    resposta_final = None
 
-    # Salvando a memória do chat no MongoDB
-    set_history(cod_usuario, store[cod_usuario])
+    async for evento in processa_pergunta_eventos(pergunta_usuario, cod_usuario):
+        if (evento["cTipo"] == "resposta"):
+            resposta_final = evento["cResposta"]
 
     return resposta_final
 
 
-def Tria(pergunta_usuario, cod_usuario):
-    try:
-        resposta = processa_pergunta(pergunta_usuario, cod_usuario)
-        store.clear()
-        return resposta
-    except Exception as e:
-        print("Ocorreu um erro ao consumir a API: ", e)
-
-        if ("quota" in str(e)):
-            # Quando ocorrer um erro, vai tentar pegar a outra api caso tenha ultrapassado o limite diário
-            api_key = os.getenv("GOOGLE_GEMINI_API_RESERVA")
-
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-2.5-flash",
-                temperature=0.7,
-                top_p=0.95,
-                google_api_key=api_key
-            )
-
-            llm_fast = ChatGoogleGenerativeAI( 
-                model="gemini-2.0-flash", # Modelo baseado em performance
-                temperature=0.2, # Modelo deterministico, não vai ser criativo. Vai ser direto para o usuário evitando modificar qualquer coisa
-                google_api_key=api_key
-            )
-        else:
-            raise Exception(f"Ocorreu um erro ao consumir a API: {e}")
+def trocar_chave_api(chave_com_erro:str):
+    """
+    Tira a chave que estourou a quota do rodízio e recria as LLMs com a próxima chave disponível do pool
+    """
+    global api_key, llm, llm_fast
+
+    pool_chaves.registrar_erro_quota(chave_com_erro)
+    api_key = get_api_key()
+
+    # As LLMs e os agentes serão recriados com a nova chave no próximo get_llm/get_llm_fast/get_agente
+    llm = None
+    llm_fast = None
+    with _lock_agentes:
+        agentes.clear()
+
+
+async def Tria(pergunta_usuario, cod_usuario):
+    # Cada chave do pool tem uma chance antes de desistir
+    tentativas = max(pool_chaves.quantidade(), 1)
+
+    for tentativa in range(tentativas):
+        try:
+            resposta = await processa_pergunta(pergunta_usuario, cod_usuario)
+            return resposta
+        except Exception as e:
+            print("Ocorreu um erro ao consumir a API: ", e)
+
+            if ("quota" not in str(e)):
+                raise Exception(f"Ocorreu um erro ao consumir a API: {e}")
+
+            if (tentativa == tentativas-1):
+                raise Exception(f"O limite diário da API do gemini foi ultrapassado ou ocorreu outro erro: {e}")
+
+            # Quando ocorrer um erro de quota, vai tentar com a próxima chave do pool
+            trocar_chave_api(api_key)
+
+
+async def Tria_stream(pergunta_usuario, cod_usuario):
+    """
+    Versão em streaming do ``Tria``, gerando os eventos do ``processa_pergunta_eventos``.
+    Como a resposta já começou a ser enviada, os erros viram um evento ``{cTipo: "erro", cMensagem}`` ao invés de exceção
+    """
+    tentativas = max(pool_chaves.quantidade(), 1)
+
+    for tentativa in range(tentativas):
+        # Depois que parte da resposta foi enviada não é possível tentar de novo com outra chave
+        enviou_texto = False
+
+        try:
+            async for evento in processa_pergunta_eventos(pergunta_usuario, cod_usuario):
+                if (evento["cTipo"] == "token"):
+                    enviou_texto = True
+                yield evento
+
+            return
+        except Exception as e:
+            print("Ocorreu um erro ao consumir a API: ", e)
+
+            if ("quota" not in str(e)):
+                yield {"cTipo":"erro", "cMensagem":f"Ocorreu um erro ao consumir a API: {e}"}
+                return
+
+            if (enviou_texto or tentativa == tentativas-1):
+                yield {"cTipo":"erro", "cMensagem":f"O limite diário da API do gemini foi ultrapassado ou ocorreu outro erro: {e}"}
+                return
 
-        try: 
-            return processa_pergunta(pergunta_usuario, cod_usuario)
-        except Exception as ex:
-            raise Exception(f"O limite diário da API do gemini foi ultrapassado ou ocorreu outro erro: {ex}")
+            # Quando ocorrer um erro de quota, vai tentar com a próxima chave do pool
+            trocar_chave_api(api_key)
+            yield _evento_etapa("nova_tentativa")
 
 
 
@@ -1281,6 +1547,6 @@ def Tria(pergunta_usuario, cod_usuario):
 #     if usuario in  ("sair", "tchau", "bye"):
 #         break
 
-#     resposta = Tria(usuario, 2)
+#     resposta = asyncio.run(Tria(usuario, 2))
 
 #     print(f"\nIA: {resposta}")
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""
+Versão assíncrona do módulo Connection, utilizando o Motor (driver assíncrono do MongoDB) e o cliente asyncio do valkey.
+
+Deve ser utilizada dentro dos handlers ``async`` da FastAPI, para que o I/O com o banco não bloqueie o event loop.
+"""
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.server_api import ServerApi
+import valkey.asyncio as avalkey
+import asyncio
+import os
+from libs.Utils.Connection import DB_URI, DB_NAME, COLLS, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, ID_TAMANHO_BLOCO, REDIS_MAX_CONNECTIONS, _monitor_pool
+
+
+# Funções de conexão basica com MongoDB ------------------------
+
+# O client do Motor fica preso ao event loop em que foi criado, por isso o registro é feito por URI e por loop
+_clients: dict[tuple[str, int], AsyncIOMotorClient] = {}
+
+def _get_connection(uri:str = DB_URI) -> AsyncIOMotorClient:
+    chave = (uri, id(asyncio.get_running_loop()))
+    client = _clients.get(chave)
+
+    if (client is None):
+        client = AsyncIOMotorClient(
+            uri,
+            server_api=ServerApi('1'),
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            event_listeners=[_monitor_pool]
+        )
+        _clients[chave] = client
+
+    return client
+
+async def get_coll(coll):
+    client = _get_connection()
+    NutriaMDB = client[DB_NAME]
+    return NutriaMDB[coll]
+
+async def get_highest_id(cursor):
+    agg = [{"$sort":{"_id":-1}},
+        {"$limit":1},
+        {"$project":{"_id":1}}]
+
+    result_highest_id = await cursor.aggregate(agg).to_list(length=1)
+
+    if (len(result_highest_id) >= 1):
+        return result_highest_id[0]["_id"]+1
+    else:
+        return 1
+
+# Alocação de IDs ----------------------------------------------
+
+# Como as corrotinas só trocam de contexto nos await, retirar um ID da lista não precisa de lock
+_ids_reservados: dict[str, list[int]] = {}
+_contadores_iniciados: set[str] = set()
+
+async def _iniciar_contador(cursor):
+    contador = cursor.database[COLLS["contador"]]
+    maior_id = await get_highest_id(cursor) - 1
+    await contador.update_one({"_id":cursor.name}, {"$max":{"iSeq":maior_id}}, upsert=True)
+    _contadores_iniciados.add(cursor.name)
+
+async def reservar_ids(cursor, quantidade:int) -> list[int]:
+    """
+    Versão assíncrona do ``Connection.reservar_ids``, reserva um bloco de IDs consecutivos com um único ``find_one_and_update`` atômico
+    """
+    if (cursor.name not in _contadores_iniciados):
+        await _iniciar_contador(cursor)
+
+    contador = cursor.database[COLLS["contador"]]
+    result = await contador.find_one_and_update({"_id":cursor.name}, {"$inc":{"iSeq":quantidade}}, upsert=True, return_document=ReturnDocument.AFTER)
+
+    ultimo_id = result["iSeq"]
+    return list(range(ultimo_id-quantidade+1, ultimo_id+1))
+
+async def get_next_id(cursor) -> int:
+    reservados = _ids_reservados.setdefault(cursor.name, [])
+
+    if (len(reservados) == 0):
+        # Outras corrotinas podem ter reservado um bloco enquanto esperava, por isso os IDs são apenas adicionados
+        reservados.extend(await reservar_ids(cursor, ID_TAMANHO_BLOCO))
+
+    return reservados.pop(0)
+
+async def get_api_key():
+    from libs.Utils.ChavesApi import pool_chaves
+
+    # Apenas a primeira chamada vai ao banco, por isso o carregamento roda em uma thread
+    if (not pool_chaves.carregado):
+        await asyncio.to_thread(pool_chaves.carregar)
+
+    api = pool_chaves.obter_chave()
+
+    if (api is None):
+        api = os.getenv("GOOGLE_GEMINI_API")
+
+    return api
+
+async def fechar_conexoes():
+    """
+    Fecha todos os clients assíncronos e pools do Redis do registro, deve ser chamado no desligamento da aplicação
+    """
+    for client in _clients.values():
+        client.close()
+    _clients.clear()
+
+    for pool in _redis_pools.values():
+        try:
+            await pool.disconnect()
+        except Exception:
+            # Um pool criado em outro event loop, já encerrado, não consegue mais ser desconectado por aqui
+            pass
+    _redis_pools.clear()
+
+
+# Redis Connection
+
+# Assim como o Motor, o pool asyncio do valkey fica preso ao event loop em que foi criado
+_redis_pools: dict[int, avalkey.ConnectionPool] = {}
+
+async def get_redis():
+    chave = id(asyncio.get_running_loop())
+    pool = _redis_pools.get(chave)
+
+    if (pool is None):
+        valkey_uri = os.getenv("REDIS_URI")
+        pool = avalkey.ConnectionPool.from_url(valkey_uri, max_connections=REDIS_MAX_CONNECTIONS, decode_responses=True)
+        _redis_pools[chave] = pool
+
+    return avalkey.Valkey(connection_pool=pool)
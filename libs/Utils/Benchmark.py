@@ -0,0 +1,261 @@
+"""
+Benchmarks da API, executados pela linha de comando:
+
+    python -m libs.Utils.Benchmark importacao [modulo] [limite_ms]
+    python -m libs.Utils.Benchmark agentes [repeticoes]
+    python -m libs.Utils.Benchmark preclassificador [latencia_llm_ms] [embedding]
+
+Retorna código de saída 1 quando o tempo medido passa do limite (ou quando o pré-classificador responde algum exemplo com o
+rótulo errado), podendo ser usado no pipeline de deploy.
+"""
+import subprocess
+import asyncio
+import time
+import sys
+import os
+from pathlib import Path
+
+# Constantes ---------------------------------------------
+RAIZ_PROJETO = Path(__file__).resolve().parent.parent.parent
+
+# Limite (em milissegundos) do import do main.py, que é o tempo que o container leva até começar a servir requisições
+LIMITE_IMPORTACAO_MS = float(os.getenv("LIMITE_IMPORTACAO_MS", 1500))
+
+# Latência (em milissegundos) das chamadas do guardrail e do roteador somadas, evitadas quando o pré-classificador responde
+LATENCIA_LLM_MS = float(os.getenv("BENCHMARK_LATENCIA_LLM_MS", 2500))
+
+# Perguntas que não fazem parte dos shots nem foram usadas para escrever as regras do pré-classificador. As do domínio
+# usam palavras que também aparecem em assuntos fora do escopo ou em ofensas, e precisam seguir para o guardrail
+PERGUNTAS_VALIDACAO = [
+    ("Qual o melhor filme plástico para embalar queijo?", "encaminhar"),
+    ("Qual a política de boas práticas de fabricação?", "encaminhar"),
+    ("Como fazer pipoca para assistir filme?", "encaminhar"),
+    ("Minha tabela ficou idiota, pode refazer?", "encaminhar"),
+    ("Quais séries de testes microbiológicos são exigidas para laticínios?", "encaminhar"),
+    ("Oi, qual a regra de rotulagem frontal da Anvisa?", "encaminhar"),
+    ("Bom dia! Quanto sódio tem o presunto cadastrado?", "encaminhar"),
+    ("Obrigado, e como eu edito uma tabela no app?", "encaminhar"),
+    ("Conta quantas tabelas eu tenho", "encaminhar"),
+    ("Um produto com traços de leite precisa de alerta de alergênicos?", "encaminhar"),
+    ("Boa noite, Tria!", "small_talk"),
+    ("valeu!!", "small_talk"),
+    ("manda uma piada ai", "small_talk"),
+    ("É inútil?", "encaminhar"),
+    ("que idiota", "encaminhar"),
+    ("um idiota", "encaminhar"),
+    ("É muito inútil essa função de exportar?", "encaminhar"),
+    ("vc é muito idiota", "ofensa"),
+    ("seu inútil", "ofensa"),
+]
+
+
+def medir_importacao(modulo:str = "main") -> dict[str, float]:
+    """
+    # Tempo de import
+    Importa o módulo em um processo novo com ``python -X importtime`` e retorna o tempo acumulado de cada módulo importado
+
+    ## Retorna
+    Um dicionário ``{modulo: tempo_ms}`` com o tempo acumulado (incluindo os sub-imports) de cada módulo
+    """
+    processo = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+        cwd=RAIZ_PROJETO,
+        capture_output=True,
+        text=True
+    )
+
+    if (processo.returncode != 0):
+        raise Exception(f"Não foi possível importar o módulo {modulo}.\nErro: {processo.stderr[-2000:]}")
+
+    tempos = {}
+    # Formato das linhas: "import time: self [us] | cumulative | imported package"
+    for linha in processo.stderr.splitlines():
+        if (not linha.startswith("import time:") or "cumulative" in linha):
+            continue
+
+        _, acumulado, nome = linha.removeprefix("import time:").split("|")
+        tempos[nome.strip()] = int(acumulado)/1000
+
+    return tempos
+
+def verificar_importacao(modulo:str = "main", limite_ms:float = LIMITE_IMPORTACAO_MS, top:int = 10) -> bool:
+    """
+    Mede o import do módulo, mostra os imports mais pesados e verifica se o total ficou dentro do limite
+    """
+    tempos = medir_importacao(modulo)
+    total = tempos.get(modulo, 0)
+
+    print(f"Import de {modulo}: {total:.1f} ms (limite: {limite_ms:.1f} ms)")
+    for nome, tempo in sorted(tempos.items(), key=lambda t: t[1], reverse=True)[:top]:
+        print(f"  {tempo:10.1f} ms  {nome}")
+
+    return total <= limite_ms
+
+
+def medir_construcao_agentes(repeticoes:int = 20) -> dict[str, dict[str, float]]:
+    """
+    # Montagem dos agentes da TrIA
+    Mede o tempo médio para montar cada agente do zero (o custo que era pago em toda pergunta) e para obter o agente
+    já montado pelo ``get_agente``. Nenhuma chamada é feita para a API do Gemini
+
+    ## Retorna
+    Um dicionário ``{agente: {"nConstrucao(ms)", "nReaproveitado(ms)"}}``
+    """
+    import libs.TrIA as tria
+
+    # A montagem não chama a API, então uma chave fictícia evita ir ao MongoDB buscar a chave do pool
+    if (tria.api_key is None):
+        tria.api_key = os.getenv("GOOGLE_GEMINI_API") or "benchmark"
+
+    tria.get_prompts()
+
+    tempos = {}
+    for nome, construtor in tria.CONSTRUTORES.items():
+        inicio = time.perf_counter()
+        for _ in range(repeticoes):
+            construtor()
+        construcao = (time.perf_counter() - inicio)/repeticoes*1000
+
+        tria.get_agente(nome)
+        inicio = time.perf_counter()
+        for _ in range(repeticoes):
+            tria.get_agente(nome)
+        reaproveitado = (time.perf_counter() - inicio)/repeticoes*1000
+
+        tempos[nome] = {"nConstrucao(ms)":construcao, "nReaproveitado(ms)":reaproveitado}
+
+    return tempos
+
+def relatorio_agentes(repeticoes:int = 20):
+    tempos = medir_construcao_agentes(repeticoes)
+
+    print(f"Montagem dos agentes da TrIA (média de {repeticoes} repetições)")
+    print(f"  {'agente':<14}{'construção':>14}{'reaproveitado':>16}")
+    for nome, tempo in tempos.items():
+        print(f"  {nome:<14}{tempo['nConstrucao(ms)']:>11.3f} ms{tempo['nReaproveitado(ms)']:>13.4f} ms")
+
+    # Uma pergunta passa pelo guardrail, roteador, ao menos um especialista, orquestrador e juiz
+    etapas = ["guardrail", "roteador", "orquestrador", "juiz"]
+    por_pergunta = sum(tempos[nome]["nConstrucao(ms)"] for nome in etapas) + max(tempos[nome]["nConstrucao(ms)"] for nome in ["dados", "app", "engenharia"])
+    print(f"Custo de montagem que era pago em cada pergunta: até {por_pergunta:.2f} ms")
+
+
+def avaliar_preclassificador(usar_embedding:bool = None) -> dict:
+    """
+    # Avaliação offline do pré-classificador
+    Classifica os exemplos dos shots do guardrail e do roteador e as perguntas de ``PERGUNTAS_VALIDACAO`` (que não
+    foram usadas para escrever as regras) e compara com o rótulo esperado. Nos shots o vizinho mais próximo é avaliado
+    em leave-one-out (o próprio exemplo não pode ser usado), então nenhuma pergunta é respondida por ser idêntica a um shot
+
+    ## Parâmetros:
+    - ``usar_embedding``: Quando ``False`` apenas as regras de palavras-chave são avaliadas, sem chamar a API de embedding.
+    Por padrão segue o ``PRECLASSIFICADOR_EMBEDDING``
+
+    ## Retorna
+    Um dicionário com a lista ``lResultados`` (conjunto, texto, esperado, previsto, método) e o tempo médio da
+    classificação local e da obtenção do embedding
+    """
+    import libs.TrIA as tria
+    from libs.Utils.PreClassificador import classificar_regras, EMBEDDING_ATIVO
+    from libs.Utils.CacheEmbedding import obter_embedding_async
+
+    if (usar_embedding is None):
+        usar_embedding = EMBEDDING_ATIVO
+
+    classificador = tria.preclassificador
+    exemplos = classificador.exemplos
+
+    # (conjunto, texto, rótulo esperado, posição do exemplo a ignorar no vizinho mais próximo)
+    casos = [("shots", exemplo["cTexto"], exemplo["cRotulo"], i) for i, exemplo in enumerate(exemplos)]
+    casos += [("validacao", texto, rotulo, None) for texto, rotulo in PERGUNTAS_VALIDACAO]
+
+    tempo_embedding = 0.0
+    matriz, vetores = None, None
+    if (usar_embedding):
+        async def embeddings():
+            return [await obter_embedding_async(texto) for _, texto, _, _ in casos]
+
+        inicio = time.perf_counter()
+        vetores = classificador._normalizar_vetores(asyncio.run(embeddings()))
+        tempo_embedding = (time.perf_counter() - inicio)/len(casos)*1000
+        matriz = vetores[:len(exemplos)]
+
+    resultados = []
+    tempo_local = 0.0
+    for i, (conjunto, texto, esperado, ignorar) in enumerate(casos):
+        inicio = time.perf_counter()
+        classificacao = classificar_regras(texto)
+        if (classificacao is None and matriz is not None):
+            classificacao = classificador.classificar_vizinho(vetores[i], matriz, ignorar=ignorar)
+        tempo_local += time.perf_counter() - inicio
+
+        resultados.append({
+            "cConjunto":conjunto,
+            "cTexto":texto,
+            "cEsperado":esperado,
+            "cPrevisto":classificacao["cRotulo"] if classificacao is not None else "encaminhar",
+            "cMetodo":classificacao["cMetodo"] if classificacao is not None else "-",
+        })
+
+    return {
+        "lResultados":resultados,
+        "nLocal(ms)":tempo_local/len(casos)*1000,
+        "nEmbedding(ms)":tempo_embedding,
+        "bEmbedding":usar_embedding,
+    }
+
+def relatorio_preclassificador(latencia_llm_ms:float = LATENCIA_LLM_MS, usar_embedding:bool = None) -> bool:
+    avaliacao = avaliar_preclassificador(usar_embedding)
+    resultados = avaliacao["lResultados"]
+
+    print(f"Pré-classificador ({'regras + embedding' if avaliacao['bEmbedding'] else 'apenas regras'})")
+    for resultado in resultados:
+        marca = "ok  " if resultado["cPrevisto"] == resultado["cEsperado"] else "ERRO"
+        print(f"  {marca} {resultado['cConjunto']:<10}{resultado['cEsperado']:<11}-> {resultado['cPrevisto']:<11}{resultado['cMetodo']:<10}{resultado['cTexto'][:60]}")
+
+    # Toda pergunta paga a classificação local (e o embedding, quando usado), as respondidas deixam de pagar o guardrail e o roteador
+    custo = avaliacao["nLocal(ms)"] + avaliacao["nEmbedding(ms)"]
+    print(f"Custo por pergunta: {avaliacao['nLocal(ms)']:.3f} ms local + {avaliacao['nEmbedding(ms)']:.1f} ms de embedding")
+
+    atalhos_errados = 0
+    for conjunto in ["shots", "validacao"]:
+        do_conjunto = [r for r in resultados if r["cConjunto"] == conjunto]
+        total = len(do_conjunto)
+
+        acertos = sum(1 for r in do_conjunto if r["cPrevisto"] == r["cEsperado"])
+        atalhos = [r for r in do_conjunto if r["cPrevisto"] != "encaminhar"]
+        errados = sum(1 for r in atalhos if r["cPrevisto"] != r["cEsperado"])
+        respondiveis = sum(1 for r in do_conjunto if r["cEsperado"] != "encaminhar")
+        economia = (len(atalhos)*latencia_llm_ms - total*custo)/total
+
+        print(f"[{conjunto}] Acurácia: {acertos/total:.1%} ({acertos}/{total})")
+        print(f"[{conjunto}] Respondidas sem o Gemini: {len(atalhos)}/{total}, sendo {errados} com o rótulo errado")
+        print(f"[{conjunto}] Cobertura do small talk/ofensas: {len(atalhos) - errados}/{respondiveis}")
+        print(f"[{conjunto}] Latência economizada: {economia:.0f} ms por pergunta em média (considerando {latencia_llm_ms:.0f} ms do guardrail + roteador)")
+
+        atalhos_errados += errados
+
+    # Uma pergunta respondida sem o Gemini com o rótulo errado (em qualquer conjunto) falha o benchmark
+    return atalhos_errados == 0
+
+if __name__ == "__main__":
+    argumentos = sys.argv[1:]
+
+    if (len(argumentos) == 0 or argumentos[0] == "importacao"):
+        modulo = argumentos[1] if len(argumentos) > 1 else "main"
+        limite = float(argumentos[2]) if len(argumentos) > 2 else LIMITE_IMPORTACAO_MS
+
+        sys.exit(0 if verificar_importacao(modulo, limite) else 1)
+
+    if (argumentos[0] == "agentes"):
+        relatorio_agentes(int(argumentos[1]) if len(argumentos) > 1 else 20)
+        sys.exit(0)
+
+    if (argumentos[0] == "preclassificador"):
+        latencia = float(argumentos[1]) if len(argumentos) > 1 else LATENCIA_LLM_MS
+        usar_embedding = argumentos[2] == "1" if len(argumentos) > 2 else None
+
+        sys.exit(0 if relatorio_preclassificador(latencia, usar_embedding) else 1)
+
+    print(f"Benchmark desconhecido: {argumentos[0]}")
+    sys.exit(2)
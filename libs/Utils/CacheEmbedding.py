@@ -0,0 +1,155 @@
+"""
+Cache dos embeddings das consultas feitas pelas tools de busca vetorial.
+
+Possui dois níveis: um LRU em memória no processo e, atrás dele, o Redis compartilhado entre os processos (com TTL).
+A chave é o texto normalizado junto do modelo de embedding, então nomes repetidos como "farinha de trigo" só são
+enviados para a API do Gemini uma vez.
+"""
+from collections import OrderedDict
+from libs.Utils.Connection import get_redis
+from libs.Utils import AsyncConnection
+from dotenv import load_dotenv
+import threading
+import hashlib
+import json
+import os
+
+load_dotenv()
+
+# Constantes ---------------------------------------------
+prefixo_embedding = "embedding:"
+
+# Quantidade de embeddings mantidos no LRU em memória
+TAMANHO_LRU = int(os.getenv("EMBEDDING_CACHE_TAMANHO", 2048))
+
+# Tempo (em segundos) que o embedding fica salvo no Redis
+TTL_REDIS = int(os.getenv("EMBEDDING_CACHE_TTL", 60*60*24*7))
+
+_lru: OrderedDict[str, list[float]] = OrderedDict()
+_lock = threading.Lock()
+
+stats = {
+    "iHitsMemoria": 0,
+    "iHitsRedis": 0,
+    "iMisses": 0,
+    "iEvictions": 0,
+    "iErrosRedis": 0,
+}
+
+
+def normalizar(texto:str) -> str:
+    return " ".join(str(texto).lower().split())
+
+def _chave(texto_normalizado:str, modelo:str) -> str:
+    return prefixo_embedding + modelo + ":" + hashlib.sha1(texto_normalizado.encode("utf-8")).hexdigest()
+
+def _somar(chave:str):
+    with _lock:
+        stats[chave] += 1
+
+def _lru_obter(chave:str) -> list[float]:
+    with _lock:
+        embedding = _lru.get(chave)
+        if (embedding is not None):
+            _lru.move_to_end(chave)
+            stats["iHitsMemoria"] += 1
+        return embedding
+
+def _lru_salvar(chave:str, embedding:list[float]):
+    with _lock:
+        _lru[chave] = embedding
+        _lru.move_to_end(chave)
+
+        while (len(_lru) > TAMANHO_LRU):
+            _lru.popitem(last=False)
+            stats["iEvictions"] += 1
+
+def _get_genai():
+    # Importado apenas no uso para não pesar a inicialização da API
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_GEMINI_API"))
+    return genai
+
+
+def obter_embedding(texto:str, modelo:str = "text-embedding-004") -> list[float]:
+    """
+    # Embedding com cache
+    Busca o embedding do texto no LRU em memória, depois no Redis, e só chama a API do Gemini quando nenhum dos dois possui
+
+    ## Parâmetros:
+    - ``texto``: Texto que vai ser transformado em embedding (é normalizado antes)
+    - ``modelo``: Modelo de embedding do Gemini
+    """
+    texto_normalizado = normalizar(texto)
+    chave = _chave(texto_normalizado, modelo)
+
+    embedding = _lru_obter(chave)
+    if (embedding is not None):
+        return embedding
+
+    try:
+        redis = get_redis()
+        salvo = redis.get(chave)
+    except Exception:
+        redis, salvo = None, None
+        _somar("iErrosRedis")
+
+    if (salvo is not None):
+        _somar("iHitsRedis")
+        embedding = json.loads(salvo)
+    else:
+        _somar("iMisses")
+        embedding = _get_genai().embed_content(model=modelo, content=texto_normalizado)["embedding"]
+
+        if (redis is not None):
+            try:
+                redis.set(chave, json.dumps(embedding), ex=TTL_REDIS)
+            except Exception:
+                _somar("iErrosRedis")
+
+    _lru_salvar(chave, embedding)
+    return embedding
+
+async def obter_embedding_async(texto:str, modelo:str = "text-embedding-004") -> list[float]:
+    """
+    Versão assíncrona do ``obter_embedding``, usando o Redis assíncrono e o ``embed_content_async`` do Gemini
+    """
+    texto_normalizado = normalizar(texto)
+    chave = _chave(texto_normalizado, modelo)
+
+    embedding = _lru_obter(chave)
+    if (embedding is not None):
+        return embedding
+
+    try:
+        redis = await AsyncConnection.get_redis()
+        salvo = await redis.get(chave)
+    except Exception:
+        redis, salvo = None, None
+        _somar("iErrosRedis")
+
+    if (salvo is not None):
+        _somar("iHitsRedis")
+        embedding = json.loads(salvo)
+    else:
+        _somar("iMisses")
+        embedding = (await _get_genai().embed_content_async(model=modelo, content=texto_normalizado))["embedding"]
+
+        if (redis is not None):
+            try:
+                await redis.set(chave, json.dumps(embedding), ex=TTL_REDIS)
+            except Exception:
+                _somar("iErrosRedis")
+
+    _lru_salvar(chave, embedding)
+    return embedding
+
+def get_stats_cache() -> dict:
+    with _lock:
+        retorno = dict(stats)
+        retorno["iTamanhoMemoria"] = len(_lru)
+
+    consultas = retorno["iHitsMemoria"] + retorno["iHitsRedis"] + retorno["iMisses"]
+    retorno["nTaxaAcerto"] = (retorno["iHitsMemoria"] + retorno["iHitsRedis"])/consultas if consultas > 0 else 0.0
+
+    return retorno
@@ -0,0 +1,229 @@
+"""
+Cache em memória das sessões de chat (histórico de cada usuário) usadas pela TrIA.
+
+As sessões ficam em um LRU com TTL de inatividade, então a próxima mensagem de um usuário ativo não precisa ler o
+MongoDB. Cada sessão possui um lock, para que duas mensagens do mesmo usuário não misturem o histórico, e as
+alterações são salvas no MongoDB em segundo plano (write-behind) ao invés de no fim de cada resposta.
+
+Quem obtém uma sessão pelo ``obter`` precisa devolver ela com o ``liberar``: enquanto existir alguém usando (ou
+esperando o lock de) uma sessão ela não sai da memória.
+"""
+from collections import OrderedDict
+from dotenv import load_dotenv
+import asyncio
+import time
+import os
+
+load_dotenv()
+
+# Constantes ---------------------------------------------
+# Quantidade de sessões mantidas em memória
+TAMANHO_CACHE = int(os.getenv("SESSAO_CACHE_TAMANHO", 1000))
+
+# Tempo (em segundos) sem mensagens até a sessão sair da memória
+TTL_SESSAO = float(os.getenv("SESSAO_TTL", 60*30))
+
+# Intervalo (em segundos) entre cada envio das sessões alteradas para o MongoDB
+INTERVALO_FLUSH = float(os.getenv("SESSAO_FLUSH_INTERVALO", 5))
+
+
+class Sessao:
+    def __init__(self, historico):
+        self.historico = historico
+        self.lock = asyncio.Lock()
+        self.lock_salvar = asyncio.Lock()
+        self.ultimo_uso = time.monotonic()
+        self.alterada = False
+        # Quantidade de requisições que obtiveram a sessão e ainda não liberaram
+        self.em_uso = 0
+
+
+class CacheSessoes:
+    def __init__(self, carregar, salvar, tamanho:int = TAMANHO_CACHE, ttl:float = TTL_SESSAO, intervalo_flush:float = INTERVALO_FLUSH):
+        """
+        ## Parâmetros:
+        - ``carregar``: Corrotina ``carregar(chave)`` que busca o histórico no MongoDB
+        - ``salvar``: Corrotina ``salvar(chave, historico)`` que grava o histórico no MongoDB. Deve ler as mensagens
+        antes do primeiro ``await``, pois a sessão continua recebendo mensagens enquanto ela é salva
+        """
+        self._carregar = carregar
+        self._salvar = salvar
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self.intervalo_flush = intervalo_flush
+
+        self._sessoes: OrderedDict[object, Sessao] = OrderedDict()
+        self._carregando: dict[object, asyncio.Future] = {}
+        self._tarefa_flush = None
+        self._salvando = set()
+
+        self.stats = {
+            "iHits": 0,
+            "iMisses": 0,
+            "iExpiradas": 0,
+            "iEvictions": 0,
+            "iSalvas": 0,
+            "iErrosSalvar": 0,
+        }
+
+    def _expirada(self, sessao:Sessao) -> bool:
+        return time.monotonic() - sessao.ultimo_uso >= self.ttl
+
+    def _remover(self, chave, sessao:Sessao):
+        del self._sessoes[chave]
+
+        # Uma sessão com alterações pendentes é salva antes de sair da memória
+        if (sessao.alterada):
+            self._agendar_salvar(chave, sessao)
+
+    def _liberar_espaco(self):
+        # Sessões em uso (respondendo ou esperando o lock) nunca são removidas no meio de uma resposta
+        for chave, sessao in list(self._sessoes.items()):
+            if (len(self._sessoes) <= self.tamanho):
+                break
+            if (sessao.em_uso == 0):
+                self._remover(chave, sessao)
+                self.stats["iEvictions"] += 1
+
+    def _usar(self, chave, sessao:Sessao) -> Sessao:
+        sessao.em_uso += 1
+        sessao.ultimo_uso = time.monotonic()
+        self._sessoes.move_to_end(chave)
+        return sessao
+
+    async def obter(self, chave) -> Sessao:
+        """
+        Retorna a sessão do usuário, carregando o histórico do MongoDB apenas quando ela não está em memória ou expirou.
+        A sessão fica marcada como em uso até o ``liberar``
+        """
+        sessao = self._sessoes.get(chave)
+
+        if (sessao is not None and self._expirada(sessao) and sessao.em_uso == 0):
+            self._remover(chave, sessao)
+            self.stats["iExpiradas"] += 1
+            sessao = None
+
+        if (sessao is not None):
+            self.stats["iHits"] += 1
+            return self._usar(chave, sessao)
+
+        # Se outra requisição do mesmo usuário já está carregando, espera o mesmo carregamento
+        carregando = self._carregando.get(chave)
+        if (carregando is not None):
+            sessao = await asyncio.shield(carregando)
+            # Se a sessão saiu da memória antes desta requisição marcar o uso, volta o mesmo objeto (ou usa o que foi carregado no lugar dele)
+            sessao = self._sessoes.setdefault(chave, sessao)
+            return self._usar(chave, sessao)
+
+        self.stats["iMisses"] += 1
+        carregando = asyncio.get_running_loop().create_future()
+        self._carregando[chave] = carregando
+
+        try:
+            sessao = Sessao(await self._carregar(chave))
+            self._sessoes[chave] = sessao
+            # Marcando o uso antes de liberar espaço, a sessão recém carregada não pode ser a removida
+            self._usar(chave, sessao)
+            self._liberar_espaco()
+            carregando.set_result(sessao)
+            return sessao
+        except BaseException as e:
+            carregando.set_exception(e)
+            # Evitando o aviso de exceção nunca lida quando ninguém mais estava esperando
+            carregando.exception()
+            raise
+        finally:
+            del self._carregando[chave]
+
+    def liberar(self, sessao:Sessao):
+        """
+        Devolve uma sessão obtida pelo ``obter``, a partir daqui ela pode sair da memória por TTL ou pelo LRU
+        """
+        sessao.em_uso -= 1
+        sessao.ultimo_uso = time.monotonic()
+
+    def historico(self, chave):
+        """
+        Acesso síncrono ao histórico de uma sessão já carregada pelo ``obter``, usado pelo ``RunnableWithMessageHistory``
+        """
+        sessao = self._sessoes.get(chave)
+        if (sessao is None):
+            raise KeyError(f"A sessão {chave} não foi carregada")
+        return sessao.historico
+
+    def marcar_alterada(self, chave):
+        """
+        Marca a sessão para ser salva no próximo flush, sem esperar a escrita no MongoDB
+        """
+        sessao = self._sessoes.get(chave)
+        if (sessao is None):
+            return
+
+        sessao.alterada = True
+        sessao.ultimo_uso = time.monotonic()
+        self._iniciar_flush()
+
+    def _agendar_salvar(self, chave, sessao:Sessao):
+        tarefa = asyncio.get_running_loop().create_task(self._salvar_sessao(chave, sessao))
+        self._salvando.add(tarefa)
+        tarefa.add_done_callback(self._salvando.discard)
+
+    async def _salvar_sessao(self, chave, sessao:Sessao):
+        # Uma sessão é salva por vez, o flush e a remoção da memória não podem enviar as mesmas mensagens duas vezes
+        async with sessao.lock_salvar:
+            if (not sessao.alterada):
+                return
+
+            # A marcação é limpa antes da escrita, alterações feitas durante ela entram no próximo flush
+            sessao.alterada = False
+
+            try:
+                await self._salvar(chave, sessao.historico)
+                self.stats["iSalvas"] += 1
+            except Exception as e:
+                sessao.alterada = True
+                self.stats["iErrosSalvar"] += 1
+                print(f"Não foi possível salvar a sessão {chave}: {e}")
+
+    async def flush(self):
+        """
+        Salva todas as sessões alteradas e remove as que expiraram
+        """
+        for chave, sessao in list(self._sessoes.items()):
+            if (sessao.alterada):
+                await self._salvar_sessao(chave, sessao)
+
+            if (self._expirada(sessao) and sessao.em_uso == 0 and not sessao.alterada and self._sessoes.get(chave) is sessao):
+                del self._sessoes[chave]
+                self.stats["iExpiradas"] += 1
+
+    def _iniciar_flush(self):
+        if (self._tarefa_flush is None or self._tarefa_flush.done()):
+            self._tarefa_flush = asyncio.get_running_loop().create_task(self._loop_flush())
+
+    async def _loop_flush(self):
+        while (len(self._sessoes) > 0):
+            await asyncio.sleep(self.intervalo_flush)
+            await self.flush()
+
+    async def fechar(self):
+        """
+        Salva as alterações pendentes, chamado no desligamento da API
+        """
+        if (self._tarefa_flush is not None):
+            self._tarefa_flush.cancel()
+            self._tarefa_flush = None
+
+        await asyncio.gather(*self._salvando, return_exceptions=True)
+        await self.flush()
+
+    def get_stats(self) -> dict:
+        retorno = dict(self.stats)
+        retorno["iSessoes"] = len(self._sessoes)
+        retorno["iAlteradas"] = sum(1 for sessao in self._sessoes.values() if sessao.alterada)
+        retorno["iEmUso"] = sum(1 for sessao in self._sessoes.values() if sessao.em_uso > 0)
+
+        consultas = retorno["iHits"] + retorno["iMisses"]
+        retorno["nTaxaAcerto"] = retorno["iHits"]/consultas if consultas > 0 else 0.0
+
+        return retorno
@@ -0,0 +1,163 @@
+"""
+Pool em memória das chaves da API do Gemini cadastradas na collection ``api``.
+
+As chaves são carregadas uma única vez e distribuídas a partir da memória, a contagem de usos (``iUsos``) é acumulada
+localmente e enviada ao MongoDB em lotes periódicos por uma thread em segundo plano.
+"""
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+import threading
+import time
+import os
+from libs.Utils.Connection import get_coll, COLLS
+
+load_dotenv()
+
+# Constantes ---------------------------------------------
+# Estratégia de escolha da chave: "menor_uso" ou "rodizio"
+ESTRATEGIA = os.getenv("API_KEY_ESTRATEGIA", "menor_uso")
+
+# Tempo (em segundos) que uma chave fica fora do rodízio após um erro de quota
+COOLDOWN_QUOTA = float(os.getenv("API_KEY_COOLDOWN", 900))
+
+# Intervalo (em segundos) entre cada envio dos usos acumulados para o MongoDB
+INTERVALO_FLUSH = float(os.getenv("API_KEY_FLUSH_INTERVALO", 30))
+
+
+class PoolChavesApi:
+    def __init__(self, estrategia:str = ESTRATEGIA, cooldown:float = COOLDOWN_QUOTA, intervalo_flush:float = INTERVALO_FLUSH):
+        self.estrategia = estrategia
+        self.cooldown = cooldown
+        self.intervalo_flush = intervalo_flush
+
+        self._lock = threading.Lock()
+        self._chaves: list[dict] = []
+        self._usos_pendentes: dict[int, int] = {}
+        self._carregado = False
+        self._proxima = 0
+        self._parar = threading.Event()
+        self._thread_flush = None
+
+    @property
+    def carregado(self) -> bool:
+        return self._carregado
+
+    def carregar(self):
+        """
+        Carrega as chaves da collection ``api`` (uma única ida ao banco) e inicia a thread que envia os usos em lote.
+        As chaves do .env entram no final do pool como reserva
+        """
+        with self._lock:
+            if (self._carregado):
+                return
+
+            cursor = get_coll(COLLS["api"])
+            chaves = [{"_id":doc["_id"], "cChave":doc["cChave"], "iUsos":doc.get("iUsos", 0), "nBloqueadaAte":0.0, "iErrosQuota":0}
+                      for doc in cursor.find({}, {"cChave":1, "iUsos":1})]
+
+            # Chaves do .env, sem _id porque não possuem contador no banco
+            for env in ("GOOGLE_GEMINI_API", "GOOGLE_GEMINI_API_RESERVA"):
+                chave_env = os.getenv(env)
+                if (chave_env and all(c["cChave"] != chave_env for c in chaves)):
+                    chaves.append({"_id":None, "cChave":chave_env, "iUsos":0, "nBloqueadaAte":0.0, "iErrosQuota":0})
+
+            self._chaves = chaves
+            self._carregado = True
+
+        self._iniciar_flush()
+
+    def _disponiveis(self) -> list[dict]:
+        agora = time.monotonic()
+        return [c for c in self._chaves if c["nBloqueadaAte"] <= agora]
+
+    def obter_chave(self) -> str:
+        """
+        Retorna uma chave sem ir ao banco, pulando as chaves que estão em cooldown por erro de quota
+        """
+        if (not self._carregado):
+            self.carregar()
+
+        with self._lock:
+            disponiveis = self._disponiveis()
+
+            # Caso todas estejam bloqueadas, usa a que será liberada primeiro
+            if (len(disponiveis) == 0):
+                disponiveis = sorted(self._chaves, key=lambda c: c["nBloqueadaAte"])[:1]
+
+            if (len(disponiveis) == 0):
+                return None
+
+            if (self.estrategia == "rodizio"):
+                chave = disponiveis[self._proxima % len(disponiveis)]
+                self._proxima += 1
+            else:
+                chave = min(disponiveis, key=lambda c: c["iUsos"])
+
+            chave["iUsos"] += 1
+            if (chave["_id"] is not None):
+                self._usos_pendentes[chave["_id"]] = self._usos_pendentes.get(chave["_id"], 0) + 1
+
+            return chave["cChave"]
+
+    def registrar_erro_quota(self, chave:str):
+        """
+        Tira a chave do rodízio pelo tempo de cooldown após ela estourar a quota
+        """
+        with self._lock:
+            for c in self._chaves:
+                if (c["cChave"] == chave):
+                    c["iErrosQuota"] += 1
+                    c["nBloqueadaAte"] = time.monotonic() + self.cooldown
+
+    def quantidade(self) -> int:
+        if (not self._carregado):
+            self.carregar()
+        return len(self._chaves)
+
+    def descarregar_usos(self):
+        """
+        Envia os usos acumulados para o MongoDB com um único ``bulk_write``
+        """
+        with self._lock:
+            pendentes = self._usos_pendentes
+            self._usos_pendentes = {}
+
+        if (len(pendentes) == 0):
+            return
+
+        try:
+            cursor = get_coll(COLLS["api"])
+            cursor.bulk_write([UpdateOne({"_id":_id}, {"$inc":{"iUsos":usos}}) for _id, usos in pendentes.items()], ordered=False)
+        except Exception as e:
+            # Devolvendo os usos para tentar novamente no próximo ciclo
+            with self._lock:
+                for _id, usos in pendentes.items():
+                    self._usos_pendentes[_id] = self._usos_pendentes.get(_id, 0) + usos
+            print(f"Não foi possível salvar os usos das chaves da API. Erro: {e}")
+
+    def _iniciar_flush(self):
+        if (self._thread_flush is not None):
+            return
+
+        def loop():
+            while not self._parar.wait(self.intervalo_flush):
+                self.descarregar_usos()
+
+        self._thread_flush = threading.Thread(target=loop, name="flush-chaves-api", daemon=True)
+        self._thread_flush.start()
+
+    def fechar(self):
+        """
+        Para a thread de flush e envia os últimos usos, deve ser chamado no desligamento da aplicação
+        """
+        self._parar.set()
+        self.descarregar_usos()
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            agora = time.monotonic()
+            return [{"_id":c["_id"], "iUsos":c["iUsos"], "iErrosQuota":c["iErrosQuota"], "bBloqueada":c["nBloqueadaAte"] > agora}
+                    for c in self._chaves]
+
+
+pool_chaves = PoolChavesApi()
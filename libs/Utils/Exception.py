@@ -1,5 +1,6 @@
 class Http_Exception(Exception):
-    def __init__(self, codigo, mensagem):
+    def __init__(self, codigo, mensagem, headers:dict = None):
         self.codigo = codigo
         self.mensagem = mensagem
-        super().__init__(f"[{codigo}] {mensagem}")
\ No newline at end of file
+        self.headers = headers
+        super().__init__(f"[{codigo}] {mensagem}")
@@ -0,0 +1,323 @@
+"""
+Fila de jobs em segundo plano guardada no Redis.
+
+A API apenas registra o job e devolve o seu id, quem executa é o ``worker.py``, que pode ser escalado em quantos
+processos forem necessários. O status e o resultado ficam no hash ``job:<id>`` e podem ser consultados em ``GET /jobs/{id}``.
+
+Cada worker move o job da fila para a sua lista ``processando:<worker>`` (``BLMOVE``) e mantém a chave ``worker:<worker>``
+viva enquanto está rodando. Quando um worker para sem finalizar os seus jobs, outro worker os devolve para a fila (ou
+marca como erro depois de ``JOB_MAX_TENTATIVAS``) no ``recuperar_jobs_orfaos``.
+"""
+from libs.Utils.AsyncConnection import get_redis
+from libs.Utils.Exception import Http_Exception
+from valkey.exceptions import WatchError
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import socket
+import time
+import uuid
+import json
+import os
+
+# Constantes ---------------------------------------------
+prefixo_job = "job:"
+prefixo_fila = "fila_jobs:"
+prefixo_processando = "processando:"
+prefixo_worker = "worker:"
+
+TIPOS_JOB = ["tablecreator", "tablecreator_lote", "comentario", "reclassificacao", "embedding", "scanner"]
+
+# Status possíveis de um job
+PENDENTE = "pendente"
+EXECUTANDO = "executando"
+CONCLUIDO = "concluido"
+ERRO = "erro"
+
+# Tempo (em segundos) que o job fica salvo no Redis depois de finalizado
+JOB_TTL = int(os.getenv("JOB_TTL", 60*60*24))
+
+# Tempo (em segundos) máximo que um job não finalizado fica salvo no Redis, renovado quando um worker começa a executá-lo
+JOB_TTL_PENDENTE = int(os.getenv("JOB_TTL_PENDENTE", 60*60*24*7))
+
+# Quantidade de vezes que um job é devolvido para a fila depois que o seu worker parou, antes de ser marcado como erro
+JOB_MAX_TENTATIVAS = int(os.getenv("JOB_MAX_TENTATIVAS", 3))
+
+# Tempo (em segundos) sem sinal de vida até o worker ser considerado parado e ter os seus jobs recuperados
+WORKER_TTL = int(os.getenv("WORKER_TTL", 30))
+
+# Tempo (em segundos) máximo de cada espera bloqueante (BLMOVE) em uma fila, antes de verificar as outras filas do worker
+INTERVALO_BLOQUEIO = float(os.getenv("FILA_JOBS_INTERVALO_BLOQUEIO", 1))
+
+# Quantidade máxima de jobs esperando em cada fila antes de recusar novos com 429
+FILA_MAX = int(os.getenv("FILA_JOBS_MAX", 1000))
+
+
+def _agora() -> str:
+    return datetime.now(ZoneInfo("America/Sao_Paulo")).isoformat()
+
+async def enfileirar_job(tipo:str, payload:dict) -> str:
+    """
+    # Enfileirar job
+    Registra um novo job no Redis e coloca ele na fila do seu tipo, retornando o id do job imediatamente
+
+    ## Parâmetros:
+    - ``tipo``: Tipo do job, um dos valores de ``TIPOS_JOB``
+    - ``payload``: Dicionário serializável em JSON com os parâmetros que o worker vai usar para executar o job
+    """
+    return (await enfileirar_jobs(tipo, [payload]))[0]
+
+async def enfileirar_jobs(tipo:str, payloads:list[dict]) -> list[str]:
+    """
+    # Enfileirar jobs em lote
+    Versão em lote do ``enfileirar_job``: todos os jobs são registrados em uma única transação (uma ida ao Redis),
+    e são recusados juntos com 429 quando não cabem na fila
+
+    ## Retorna
+    Os ids dos jobs, na mesma ordem dos ``payloads``
+    """
+    if (tipo not in TIPOS_JOB):
+        raise Http_Exception(400, f"Tipo de job desconhecido: {tipo}")
+
+    if (len(payloads) == 0):
+        return []
+
+    redis = await get_redis()
+    jobs_ids = [uuid.uuid4().hex for _ in payloads]
+    fila = prefixo_fila+tipo
+    criacao = _agora()
+
+    # O tamanho da fila é verificado e os jobs inseridos em uma transação com WATCH, para que envios ao mesmo tempo não
+    # passem do FILA_MAX. Se a fila mudar entre a verificação e o EXEC, a transação é refeita
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(fila)
+
+                if (await pipe.llen(fila) + len(payloads) > FILA_MAX):
+                    raise Http_Exception(429, f"A fila de {tipo} está cheia, tente novamente mais tarde", headers={"Retry-After":"30"})
+
+                pipe.multi()
+                for job_id, payload in zip(jobs_ids, payloads):
+                    pipe.hset(prefixo_job+job_id, mapping={
+                        "cTipo":tipo,
+                        "cStatus":PENDENTE,
+                        "jPayload":json.dumps(payload),
+                        "dCriacao":criacao,
+                    })
+                    # Um job que nunca for executado não fica para sempre no Redis
+                    pipe.expire(prefixo_job+job_id, JOB_TTL_PENDENTE)
+                pipe.rpush(fila, *jobs_ids)
+                await pipe.execute()
+                break
+            except WatchError:
+                continue
+
+    return jobs_ids
+
+async def obter_job(job_id:str) -> dict:
+    """
+    Retorna o status do job, junto com o resultado ou o erro quando ele já foi finalizado
+    """
+    redis = await get_redis()
+    job = await redis.hgetall(prefixo_job+job_id)
+
+    if (len(job) == 0):
+        raise Http_Exception(404, f"O job {job_id} não existe ou já expirou")
+
+    retorno = {"cId":job_id}
+    for chave, valor in job.items():
+        # O payload pode conter dados grandes (como a imagem do scanner), então não é devolvido
+        if (chave == "jPayload"):
+            continue
+        retorno[chave] = json.loads(valor) if chave.startswith("j") else valor
+
+    return retorno
+
+async def atualizar_progresso(job_id:str, progresso:dict):
+    """
+    Salva o progresso parcial de um job em execução, para jobs longos como o embedding em massa
+    """
+    redis = await get_redis()
+    await redis.hset(prefixo_job+job_id, "jProgresso", json.dumps(progresso))
+
+async def tamanhos_filas() -> dict[str, int]:
+    redis = await get_redis()
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for tipo in TIPOS_JOB:
+            pipe.llen(prefixo_fila+tipo)
+        tamanhos = await pipe.execute()
+
+    return dict(zip(TIPOS_JOB, tamanhos))
+
+
+# Funções usadas pelo worker ------------------------------
+
+def gerar_id_worker() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def registrar_worker(worker:str):
+    """
+    Sinal de vida do worker, deve ser chamado com intervalo menor que ``WORKER_TTL``
+    """
+    redis = await get_redis()
+    await redis.set(prefixo_worker+worker, _agora(), ex=WORKER_TTL)
+
+async def remover_worker(worker:str):
+    redis = await get_redis()
+    await redis.delete(prefixo_worker+worker)
+
+async def _reivindicar(redis, job_id:str, worker:str):
+    job = prefixo_job+job_id
+
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hget(job, "cTipo")
+        pipe.hget(job, "jPayload")
+        pipe.hset(job, mapping={"cStatus":EXECUTANDO, "dInicio":_agora(), "cWorker":worker})
+        pipe.expire(job, JOB_TTL_PENDENTE)
+        tipo, payload, _, _ = await pipe.execute()
+
+    if (tipo is None):
+        # O hash do job expirou enquanto ele esperava na fila
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(job)
+            pipe.lrem(prefixo_processando+worker, 1, job_id)
+            await pipe.execute()
+        return None
+
+    return job_id, tipo, json.loads(payload) if payload else {}
+
+async def proximo_job(tipos:list[str], worker:str, timeout:float = 5) -> tuple[str, str, dict]:
+    """
+    Espera (até ``timeout`` segundos) o próximo job de um dos tipos, move ele para a lista ``processando:<worker>`` e
+    marca ele como em execução. Retorna ``(job_id, tipo, payload)`` ou ``None`` quando nenhum job chegou
+    """
+    redis = await get_redis()
+    processando = prefixo_processando+worker
+    fim = time.monotonic() + timeout
+    volta = 0
+
+    while True:
+        # Verificando todas as filas sem bloquear, na ordem de prioridade dos tipos
+        for tipo in tipos:
+            job_id = await redis.lmove(prefixo_fila+tipo, processando, "LEFT", "RIGHT")
+            if (job_id is not None):
+                job = await _reivindicar(redis, job_id, worker)
+                if (job is not None):
+                    return job
+
+        restante = fim - time.monotonic()
+        if (restante <= 0):
+            return None
+
+        # O BLMOVE só espera uma fila, então o worker alterna entre elas com esperas curtas
+        tipo = tipos[volta % len(tipos)]
+        volta += 1
+
+        job_id = await redis.blmove(prefixo_fila+tipo, processando, min(INTERVALO_BLOQUEIO, restante), "LEFT", "RIGHT")
+        if (job_id is not None):
+            job = await _reivindicar(redis, job_id, worker)
+            if (job is not None):
+                return job
+
+async def finalizar_job(job_id:str, resultado=None, erro:str = None, worker:str = None):
+    redis = await get_redis()
+
+    campos = {"cStatus":ERRO if erro is not None else CONCLUIDO, "dFim":_agora()}
+    if (erro is not None):
+        campos["cErro"] = erro
+    else:
+        campos["jResultado"] = json.dumps(resultado, default=str)
+
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(prefixo_job+job_id, mapping=campos)
+        # O payload não é mais necessário depois que o job termina
+        pipe.hdel(prefixo_job+job_id, "jPayload")
+        pipe.expire(prefixo_job+job_id, JOB_TTL)
+        if (worker is not None):
+            pipe.lrem(prefixo_processando+worker, 1, job_id)
+        await pipe.execute()
+
+async def devolver_jobs_nao_iniciados(worker:str, em_execucao:set[str]) -> int:
+    """
+    Devolve para a fila os jobs da lista ``processando:<worker>`` que o próprio worker não está executando. Acontece quando
+    o Redis falha entre o LMOVE e o fim do ``proximo_job``: o job fica na lista de um worker vivo e o ``recuperar_jobs_orfaos``
+    nunca pegaria ele. Retorna a quantidade de jobs devolvidos
+
+    ## Parâmetros:
+    - ``worker``: Id do worker dono da lista
+    - ``em_execucao``: Ids dos jobs que o worker está executando, que continuam na lista
+    """
+    redis = await get_redis()
+    processando = prefixo_processando+worker
+    devolvidos = 0
+
+    for job_id in await redis.lrange(processando, 0, -1):
+        if (job_id in em_execucao):
+            continue
+
+        tipo = await redis.hget(prefixo_job+job_id, "cTipo")
+
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(processando, 1, job_id)
+            if (tipo is not None):
+                # O job não chegou a ser executado, então não conta como uma tentativa
+                pipe.hset(prefixo_job+job_id, "cStatus", PENDENTE)
+                pipe.hdel(prefixo_job+job_id, "dInicio", "cWorker")
+                pipe.lpush(prefixo_fila+tipo, job_id)
+            await pipe.execute()
+
+        if (tipo is not None):
+            devolvidos += 1
+
+    return devolvidos
+
+async def recuperar_jobs_orfaos(worker:str) -> dict[str, int]:
+    """
+    # Recuperação de jobs órfãos
+    Procura as listas ``processando:<worker>`` de workers que pararam (sem a chave ``worker:<worker>``) e devolve os
+    seus jobs para a fila, ou marca como erro os que já foram tentados ``JOB_MAX_TENTATIVAS`` vezes
+
+    ## Parâmetros:
+    - ``worker``: Id do worker que está recuperando. Cada job passa pela lista dele antes de voltar para a fila,
+    então um job não se perde se este worker também parar no meio da recuperação
+
+    ## Retorna
+    A quantidade de jobs devolvidos para a fila (``iReenfileirados``) e marcados como erro (``iFalhos``)
+    """
+    redis = await get_redis()
+    processando = prefixo_processando+worker
+    resultado = {"iReenfileirados":0, "iFalhos":0}
+
+    async for lista in redis.scan_iter(match=prefixo_processando+"*"):
+        dono = lista.removeprefix(prefixo_processando)
+        if (dono == worker or await redis.exists(prefixo_worker+dono)):
+            continue
+
+        while True:
+            # O LMOVE garante que apenas um worker recupera cada job
+            job_id = await redis.lmove(lista, processando, "LEFT", "RIGHT")
+            if (job_id is None):
+                break
+
+            tipo, tentativas = await redis.hmget(prefixo_job+job_id, ["cTipo", "iTentativas"])
+            if (tipo is None):
+                await redis.lrem(processando, 1, job_id)
+                continue
+
+            tentativas = int(tentativas or 0) + 1
+            if (tentativas > JOB_MAX_TENTATIVAS):
+                await finalizar_job(job_id, erro=f"O job foi interrompido {tentativas} vezes pela parada do worker", worker=worker)
+                resultado["iFalhos"] += 1
+                continue
+
+            # Volta para o fim da fila mesmo que ela esteja cheia, o job já tinha sido aceito
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(prefixo_job+job_id, mapping={"cStatus":PENDENTE, "iTentativas":tentativas})
+                pipe.hdel(prefixo_job+job_id, "dInicio", "cWorker")
+                pipe.lrem(processando, 1, job_id)
+                pipe.rpush(prefixo_fila+tipo, job_id)
+                await pipe.execute()
+            resultado["iReenfileirados"] += 1
+
+    return resultado
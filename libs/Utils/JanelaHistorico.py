@@ -0,0 +1,175 @@
+"""
+Janela do histórico de chat enviada para cada agente da TrIA.
+
+O histórico completo (incluindo os JSONs trocados entre os agentes) continua salvo na sessão, mas cada agente recebe
+apenas a conversa visível com o usuário: as últimas ``N`` trocas dentro de um orçamento de tokens do seu papel,
+precedidas de um resumo das mensagens mais antigas quando o resumo está ativado.
+"""
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from dotenv import load_dotenv
+import json
+import os
+
+load_dotenv()
+
+# Constantes ---------------------------------------------
+# Política padrão de cada papel: quantidade de trocas (pergunta + resposta) e orçamento de tokens do histórico.
+# Podem ser alteradas pelo .env (HISTORICO_<PAPEL>_TURNOS e HISTORICO_<PAPEL>_TOKENS)
+POLITICAS_PADRAO = {
+    "guardrail": {"iTurnos":3, "iTokens":800},
+    "roteador": {"iTurnos":4, "iTokens":1500},
+    "especialista": {"iTurnos":6, "iTokens":3000},
+    "orquestrador": {"iTurnos":2, "iTokens":800},
+    "juiz": {"iTurnos":2, "iTokens":800},
+}
+
+POLITICAS = {
+    papel: {
+        "iTurnos":int(os.getenv(f"HISTORICO_{papel.upper()}_TURNOS", politica["iTurnos"])),
+        "iTokens":int(os.getenv(f"HISTORICO_{papel.upper()}_TOKENS", politica["iTokens"])),
+    }
+    for papel, politica in POLITICAS_PADRAO.items()
+}
+
+# Resumo das mensagens que saíram da janela, guardado junto do chat. Desligado por padrão, pois gera uma chamada extra
+# do llm_fast a cada RESUMO_A_CADA trocas de cada usuário (ligar com HISTORICO_RESUMO=1)
+RESUMO_ATIVO = os.getenv("HISTORICO_RESUMO", "0") == "1"
+
+# Quantidade de trocas fora da maior janela acumuladas antes de gerar um novo resumo
+RESUMO_A_CADA = int(os.getenv("HISTORICO_RESUMO_A_CADA", 4))
+
+
+def estimar_tokens(texto:str) -> int:
+    # Aproximação de ~4 caracteres por token, evitando uma chamada na API só para contar
+    return len(texto)//4 + 1
+
+def texto_visivel(tipo:str, conteudo:str):
+    """
+    Retorna o texto da mensagem como o usuário viu, ou ``None`` quando é uma mensagem trocada entre os agentes
+    (saídas em JSON do guardrail, roteador, especialistas e orquestrador)
+    """
+    conteudo = str(conteudo)
+
+    if (tipo == "human"):
+        # Regra para adicionar quando for apenas texto
+        if ((not conteudo.startswith("{\"route\":")) and (not "\"dominio\":" in conteudo) and (not conteudo.startswith("{\"legal\":")) and (not conteudo.startswith("{\"pergunta_original\":"))):
+            return conteudo
+
+    elif (tipo == "ai"):
+        # Regra para evitar as memórias das conversas entre os agentes
+        if (not "\"dominio\":" in conteudo and (not "\"resposta_small_talk\":null" in conteudo) and (not conteudo.startswith("{\"legal\":")) and (not "\"resposta_final\":" in conteudo)):
+            # Verificando se é small talk ou orquestrador
+            if ("\"resposta_small_talk\":" in conteudo):
+                return json.loads(conteudo).get("resposta_small_talk", "")
+            return conteudo
+
+    return None
+
+def mensagens_visiveis(mensagens:list[BaseMessage]) -> list[BaseMessage]:
+    visiveis = []
+
+    for mensagem in mensagens:
+        texto = texto_visivel(mensagem.type, mensagem.content)
+        if (texto is None):
+            continue
+
+        visiveis.append(HumanMessage(texto) if mensagem.type == "human" else AIMessage(texto))
+
+    return visiveis
+
+def separar_turnos(mensagens:list[BaseMessage]) -> list[list[BaseMessage]]:
+    # Uma troca começa em cada mensagem do usuário e vai até a próxima
+    turnos = []
+    for mensagem in mensagens:
+        if (mensagem.type == "human" or len(turnos) == 0):
+            turnos.append([])
+        turnos[-1].append(mensagem)
+
+    return turnos
+
+def aplicar_janela(mensagens:list[BaseMessage], turnos:int, tokens:int) -> list[BaseMessage]:
+    """
+    Mantém as últimas ``turnos`` trocas e remove as mais antigas até o histórico caber em ``tokens``
+    """
+    janela = separar_turnos(mensagens)[-turnos:] if turnos > 0 else []
+
+    while (len(janela) > 0 and sum(estimar_tokens(m.content) for turno in janela for m in turno) > tokens):
+        janela.pop(0)
+
+    return [mensagem for turno in janela for mensagem in turno]
+
+
+class HistoricoJanela(BaseChatMessageHistory):
+    """
+    Visão do histórico da sessão para um papel: a leitura devolve apenas a janela do papel e as mensagens novas são
+    adicionadas no histórico completo da sessão
+    """
+    def __init__(self, historico, papel:str):
+        self.historico = historico
+        self.politica = POLITICAS[papel]
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        inicio = getattr(self.historico, "iResumidas", 0) if RESUMO_ATIVO else 0
+        janela = aplicar_janela(mensagens_visiveis(self.historico.messages[inicio:]), self.politica["iTurnos"], self.politica["iTokens"])
+
+        resumo = getattr(self.historico, "cResumo", "") if RESUMO_ATIVO else ""
+        if (resumo):
+            return [SystemMessage(f"Resumo da conversa anterior: {resumo}")] + janela
+
+        return janela
+
+    def add_messages(self, messages:list[BaseMessage]):
+        self.historico.add_messages(messages)
+
+    def clear(self):
+        self.historico.clear()
+
+
+def mensagens_para_resumir(historico) -> tuple[list[BaseMessage], int]:
+    """
+    Retorna as mensagens visíveis que já saíram da maior janela e ainda não foram resumidas, junto da posição (no
+    histórico completo) até onde o resumo vai cobrir. Retorna uma lista vazia enquanto não acumular ``RESUMO_A_CADA`` trocas
+    """
+    inicio = getattr(historico, "iResumidas", 0)
+    mensagens = historico.messages[inicio:]
+
+    maior_janela = max(politica["iTurnos"] for politica in POLITICAS.values())
+
+    # Posição de cada troca no histórico completo, para saber até onde o resumo cobre
+    posicoes = [i for i, mensagem in enumerate(mensagens) if mensagem.type == "human" and texto_visivel("human", mensagem.content) is not None]
+
+    fora_da_janela = len(posicoes) - maior_janela
+    if (fora_da_janela < RESUMO_A_CADA):
+        return [], inicio
+
+    corte = posicoes[fora_da_janela]
+    return mensagens_visiveis(mensagens[:corte]), inicio + corte
+
+
+class ContadorTokens(AsyncCallbackHandler):
+    """
+    Soma os tokens de entrada enviados em cada etapa do pipeline (``metadata["etapa"]`` do config). Usa o
+    ``usage_metadata`` retornado pelo Gemini e, quando ele não vem, a estimativa das mensagens enviadas
+    """
+    def __init__(self):
+        self.tokens: dict[str, int] = {}
+        self._estimativas = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        estimativa = sum(estimar_tokens(str(mensagem.content)) for lista in messages for mensagem in lista)
+        self._estimativas[run_id] = ((metadata or {}).get("etapa", "desconhecida"), estimativa)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        etapa, tokens = self._estimativas.pop(run_id, ("desconhecida", 0))
+
+        try:
+            uso = response.generations[0][0].message.usage_metadata
+            if (uso and uso.get("input_tokens")):
+                tokens = uso["input_tokens"]
+        except (AttributeError, IndexError):
+            pass
+
+        self.tokens[etapa] = self.tokens.get(etapa, 0) + tokens
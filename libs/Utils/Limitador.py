@@ -0,0 +1,166 @@
+"""
+Limites de concorrência por endpoint, com fila de tamanho máximo e backpressure.
+
+Cada classe de endpoint possui o próprio limitador: as corrotinas do endpoint rodam no event loop controladas por um
+semáforo (o trabalho síncrono e pesado roda nos workers da fila de jobs, ver ``FilaJobs``). Quando a fila está cheia a requisição é recusada com 429 e
+``Retry-After`` ao invés de acumular trabalho até estourar a quota do Gemini ou a memória.
+"""
+from libs.Utils.Exception import Http_Exception
+import threading
+import asyncio
+import inspect
+import math
+import time
+import os
+
+
+class LimitadorEndpoint:
+    def __init__(self, nome:str, max_concorrencia:int, max_fila:int):
+        self.nome = nome
+        self.max_concorrencia = int(os.getenv(f"LIMITE_{nome.upper()}_CONCORRENCIA", max_concorrencia))
+        self.max_fila = int(os.getenv(f"LIMITE_{nome.upper()}_FILA", max_fila))
+
+        self._semaforo = None
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "iEmExecucao": 0,
+            "iNaFila": 0,
+            "iConcluidas": 0,
+            "iErros": 0,
+            "iRejeitadas": 0,
+            "nEsperaTotal(s)": 0.0,
+            "nEsperaMax(s)": 0.0,
+            "nExecucaoTotal(s)": 0.0,
+        }
+
+    def _get_semaforo(self) -> asyncio.Semaphore:
+        if (self._semaforo is None):
+            self._semaforo = asyncio.Semaphore(self.max_concorrencia)
+        return self._semaforo
+
+    def _retry_after(self) -> int:
+        # Estimativa de quando uma vaga vai abrir, a partir do tempo médio de execução
+        concluidas = self.stats["iConcluidas"] + self.stats["iErros"]
+        media = self.stats["nExecucaoTotal(s)"]/concluidas if concluidas > 0 else 1.0
+        return max(1, math.ceil(media * (self.stats["iNaFila"]+1) / self.max_concorrencia))
+
+    def _recusar_se_cheio(self):
+        # Deve ser chamado com o lock adquirido
+        ocupados = self.stats["iEmExecucao"] + self.stats["iNaFila"]
+
+        if (ocupados >= self.max_concorrencia + self.max_fila):
+            self.stats["iRejeitadas"] += 1
+            retry_after = self._retry_after()
+            raise Http_Exception(429, f"O servidor está ocupado processando outras requisições de {self.nome}, tente novamente em {retry_after} segundos", headers={"Retry-After":str(retry_after)})
+
+    def _entrar(self):
+        with self._lock:
+            self._recusar_se_cheio()
+            self.stats["iNaFila"] += 1
+
+        return time.monotonic()
+
+    def _iniciar(self, entrada:float) -> float:
+        espera = time.monotonic() - entrada
+
+        with self._lock:
+            self.stats["iNaFila"] -= 1
+            self.stats["iEmExecucao"] += 1
+            self.stats["nEsperaTotal(s)"] += espera
+            self.stats["nEsperaMax(s)"] = max(self.stats["nEsperaMax(s)"], espera)
+
+        return time.monotonic()
+
+    def _finalizar(self, inicio:float, erro:bool):
+        with self._lock:
+            self.stats["iEmExecucao"] -= 1
+            self.stats["nExecucaoTotal(s)"] += time.monotonic() - inicio
+            self.stats["iErros" if erro else "iConcluidas"] += 1
+
+    async def executar(self, funcao, *args, **kwargs):
+        """
+        # Execução limitada
+        Executa a corrotina respeitando o limite de concorrência do endpoint, recusando com 429 quando a fila está cheia
+
+        ## Parâmetros:
+        - ``funcao``: Função assíncrona, roda no event loop limitada pelo semáforo
+        - ``args``/``kwargs``: Parâmetros repassados para a função
+        """
+        if (not inspect.iscoroutinefunction(funcao)):
+            raise TypeError(f"O limitador {self.nome} executa apenas corrotinas, funções síncronas devem ir para a fila de jobs")
+
+        entrada = self._entrar()
+
+        try:
+            await self._get_semaforo().acquire()
+        except BaseException:
+            with self._lock:
+                self.stats["iNaFila"] -= 1
+            raise
+
+        inicio = self._iniciar(entrada)
+        erro = True
+        try:
+            resultado = await funcao(*args, **kwargs)
+            erro = False
+            return resultado
+        finally:
+            self._finalizar(inicio, erro)
+            self._get_semaforo().release()
+
+    def verificar(self):
+        """
+        Recusa com 429 quando a fila está cheia, sem ocupar uma vaga. Usado antes de começar uma resposta em streaming,
+        que depois de iniciada não pode mais mudar o status HTTP
+        """
+        with self._lock:
+            self._recusar_se_cheio()
+
+    async def executar_stream(self, gerador, *args, **kwargs):
+        """
+        # Streaming limitado
+        Versão do ``executar`` para geradores assíncronos: a vaga fica ocupada enquanto o gerador estiver sendo consumido
+
+        ## Parâmetros:
+        - ``gerador``: Função geradora assíncrona
+        - ``args``/``kwargs``: Parâmetros repassados para o gerador
+        """
+        entrada = self._entrar()
+
+        try:
+            await self._get_semaforo().acquire()
+        except BaseException:
+            with self._lock:
+                self.stats["iNaFila"] -= 1
+            raise
+
+        inicio = self._iniciar(entrada)
+        erro = True
+        try:
+            async for item in gerador(*args, **kwargs):
+                yield item
+            erro = False
+        finally:
+            self._finalizar(inicio, erro)
+            self._get_semaforo().release()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+
+        iniciadas = stats["iConcluidas"] + stats["iErros"] + stats["iEmExecucao"]
+        stats["nEsperaMedia(s)"] = stats["nEsperaTotal(s)"]/iniciadas if iniciadas > 0 else 0.0
+        stats["iMaxConcorrencia"] = self.max_concorrencia
+        stats["iMaxFila"] = self.max_fila
+
+        return stats
+
+
+# Limitadores de cada classe de endpoint, os limites podem ser alterados pelo .env (LIMITE_<NOME>_CONCORRENCIA e LIMITE_<NOME>_FILA)
+LIMITADORES = {
+    "chatbot": LimitadorEndpoint("chatbot", max_concorrencia=16, max_fila=64),
+}
+
+def get_metricas_limitadores() -> dict:
+    return {nome: limitador.metricas() for nome, limitador in LIMITADORES.items()}
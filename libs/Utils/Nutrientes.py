@@ -0,0 +1,82 @@
+# Constantes dos nutrientes usados nas tabelas nutricionais, na mesma ordem dos campos da collection de ingredientes
+
+# Nome de cada nutriente em PT-BR, como aparece na tabela nutricional
+nome_ptbr = {
+    "nCaloria(kcal)":"Valor Calórico (kcal)",
+    "nProteina(g)":"Proteína (g)",
+    "nCarboidrato(g)":"Carboidrato (g)",
+    "nAcucar(g)":"Açúcar Total (g)",
+    "nFibra(g)":"Fibra Alimentar (g)",
+    "nGorduraTotal(g)":"Gordura Total (g)",
+    "nGorduraSaturada(g)":"Gordura Saturada (g)",
+    "nGorduraMonoinsaturada(g)":"Gordura Monoinsaturada (g)",
+    "nGorduraPoliinsaturada(g)":"Gordura Poli-Insaturada (g)",
+    "nColesterol(mg)":"Colesterol (mg)",
+    "nRetinol(mcg)":"Retinol/Vitamina A (μg)",
+    "nTiamina(mg)":"Tiamina (mg)",
+    "nRiboflavina(mg)":"Riboflavina (mg)",
+    "nNiacina(mg)":"Niacina (mg)",
+    "nVitB6(mg)":"Vitamina B-6 (mg)",
+    "nFolato(mcg)":"Ácido Fólico (μg)",
+    "nColina(mg)":"Colina (mg)",
+    "nVitB12(mcg)":"Vitamina B-12 (μg)",
+    "nVitC(mg)":"Vitamina C (mg)",
+    "nVitD(mcg)":"Vitamina D (μg)",
+    "nVitE(mg)":"Vitamina E (mg)",
+    "nVitK(mcg)":"Vitamina K (μg)",
+    "nCalcio(mg)":"Cálcio (mg)",
+    "nFosforo(mg)":"Fósforo (mg)",
+    "nMagnesio(mg)":"Magnésio (mg)",
+    "nFerro(mg)":"Ferro (mg)",
+    "nZinco(mg)":"Zinco (mg)",
+    "nCobre(mg)":"Cobre (mg)",
+    "nSelenio(mcg)":"Selênio (μg)",
+    "nPotassio(mg)":"Potássio (mg)",
+    "nSodio(mg)":"Sódio (mg)",
+    "nCafeina(mg)":"Cafeína (mg)",
+    "nTeobromina(mg)":"Teobromina (mg)",
+    "nAlcool(g)":"Álcool (g)",
+    "nAgua(g)":"Água (g)",
+}
+
+# Valor diário de referência de cada nutriente (0 quando não possui VD)
+vd_referencia = {
+    "nCaloria(kcal)":2000,
+    "nProteina(g)":50,
+    "nCarboidrato(g)":300,
+    "nAcucar(g)":50,
+    "nFibra(g)":25,
+    "nGorduraTotal(g)":65,
+    "nGorduraSaturada(g)":20,
+    "nGorduraMonoinsaturada(g)":20,
+    "nGorduraPoliinsaturada(g)":20,
+    "nColesterol(mg)":300,
+    "nRetinol(mcg)":800,
+    "nTiamina(mg)":1.2,
+    "nRiboflavina(mg)":1.2,
+    "nNiacina(mg)":15,
+    "nVitB6(mg)":1.3,
+    "nFolato(mcg)":400,
+    "nColina(mg)":550,
+    "nVitB12(mcg)":2.4,
+    "nVitC(mg)":100,
+    "nVitD(mcg)":15,
+    "nVitE(mg)":15,
+    "nVitK(mcg)":120,
+    "nCalcio(mg)":1000,
+    "nFosforo(mg)":700,
+    "nMagnesio(mg)":120,
+    "nFerro(mg)":14,
+    "nZinco(mg)":11,
+    "nCobre(mg)":0.9,
+    "nSelenio(mcg)":60,
+    "nPotassio(mg)":3500,
+    "nSodio(mg)":2000,
+    "nCafeina(mg)":0,
+    "nTeobromina(mg)":0,
+    "nAlcool(g)":0,
+    "nAgua(g)":0,
+}
+
+# Ordem fixa dos nutrientes, usada como colunas da matriz de nutrientes e nas listas da tabela nutricional
+NUTRIENTES = list(nome_ptbr.keys())
@@ -0,0 +1,237 @@
+"""
+Pré-classificador local das perguntas do chatbot, executado antes do guardrail e do roteador.
+
+Saudações, agradecimentos, ofensas diretas e pedidos claramente fora do escopo são respondidos sem chamar o Gemini:
+primeiro por regras de palavras-chave e, quando elas não decidem, pelo exemplo mais parecido (similaridade de cosseno
+dos embeddings) entre os shots do guardrail e do roteador. Qualquer caso sem confiança suficiente segue para o
+pipeline normal da TrIA.
+"""
+from libs.Utils.CacheEmbedding import obter_embedding_async
+from dotenv import load_dotenv
+import numpy as np
+import unicodedata
+import asyncio
+import json
+import re
+import os
+
+load_dotenv()
+
+# Constantes ---------------------------------------------
+# Liga/desliga o pré-classificador
+PRECLASSIFICADOR_ATIVO = os.getenv("PRECLASSIFICADOR", "1") == "1"
+
+# Usa o vizinho mais próximo por embedding quando as regras não decidem. Desligado por padrão, pois adiciona uma
+# chamada de embedding antes de toda pergunta que segue para o guardrail (a maior parte do tráfego)
+EMBEDDING_ATIVO = os.getenv("PRECLASSIFICADOR_EMBEDDING", "0") == "1"
+
+# Similaridade mínima com o exemplo mais próximo para responder sem o Gemini
+LIMIAR_SIMILARIDADE = float(os.getenv("PRECLASSIFICADOR_LIMIAR", 0.85))
+
+# Diferença mínima entre o exemplo mais próximo e o mais próximo de outro rótulo
+MARGEM_SIMILARIDADE = float(os.getenv("PRECLASSIFICADOR_MARGEM", 0.05))
+
+# Rótulos: apenas "small_talk" e "ofensa" são respondidos direto, "encaminhar" segue para o guardrail e roteador
+ROTULOS_RESPONDIDOS = ("small_talk", "ofensa")
+
+SAUDACOES = r"oi+e*|ola|opa|eae|e ai|hey|hello|bom dia|boa tarde|boa noite|tudo (?:bem|bom|certo|joia)|td bem|como vai|como (?:voce|vc) esta|beleza|blz|tria|nutria"
+AGRADECIMENTOS = r"(?:muito )?(?:obrigad[oa]|brigad[oa])|obg|valeu|vlw|tchau|ate (?:mais|logo)"
+
+# A mensagem inteira precisa ser formada apenas por saudações/agradecimentos
+REGEX_SAUDACAO = re.compile(rf"^(?:(?:{SAUDACOES})(?: |$))+$")
+REGEX_AGRADECIMENTO = re.compile(rf"^(?:(?:{SAUDACOES}|{AGRADECIMENTOS})(?: |$))+$")
+REGEX_TEM_AGRADECIMENTO = re.compile(rf"\b(?:{AGRADECIMENTOS})\b")
+
+# Ofensas. Só são respondidas aqui quando a mensagem inteira é a ofensa e ela é dirigida à Tria em segunda pessoa
+# ("vc é idiota", "seu inútil", "idiota vc"), ou é um xingamento que já é um imperativo ("vai se foder"). Sem o alvo,
+# frases curtas como "é inútil?", "que idiota" ou "um idiota" podem falar de outra coisa (a tabela, um produto) e,
+# assim como mensagens com outro conteúdo e casos que dependem de contexto (como o racismo dos shots), ficam com o guardrail
+IMPERATIVOS = r"(?:vai )?tomar no (?:seu )?cu|vai se f[ou]der"
+XINGAMENTOS = r"filho da puta|fdp|arrombad[oa]s?|otari[oa]s?|idiota|imbecil|desgracad[oa]|vagabund[oa]|inutil"
+ALVOS = r"tria|nutria|voce|vc|tu|seu|sua|bot|robo"
+# Palavras que podem ligar o alvo ao xingamento, apenas depois do alvo ("vc é um idiota", "tu es muito inútil")
+LIGACOES = r"e|eh|es|um|uma|muito|mt|mo|mais"
+REGEX_OFENSA = re.compile(
+    rf"^(?:(?:{ALVOS}) )?(?:{IMPERATIVOS})(?: (?:{ALVOS}))?$"
+    rf"|^(?:{ALVOS})(?: (?:{LIGACOES}))* (?:{XINGAMENTOS})(?: (?:{XINGAMENTOS}|{LIGACOES}))*$"
+    rf"|^(?:{XINGAMENTOS})(?: (?:{XINGAMENTOS}))* (?:{ALVOS})$"
+)
+
+# Pedidos fora do escopo, apenas quando a mensagem inteira é o pedido. Palavras como "filme" ou "política" são comuns
+# em perguntas do domínio ("filme plástico", "política de boas práticas") e por isso não são procuradas no meio do texto
+PEDIDOS_FORA_ESCOPO = r"(?:me )?(?:conta|conte|manda|fala|diz|diga)(?: ai)?(?: (?:uma|um|outra|outro|mais uma))? (?:piada|charada)s?(?: ai)?|(?:qual (?:e )?)?(?:o )?(?:meu )?horoscopo(?: de hoje)?"
+REGEX_FORA_ESCOPO = re.compile(rf"^(?:(?:{SAUDACOES}) )*(?:{PEDIDOS_FORA_ESCOPO})$")
+
+RESPOSTA_SAUDACAO = "Oiee! Como posso te ajudar no mundo da alimentação? 😊"
+RESPOSTA_AGRADECIMENTO = "Por nada! 😊 Se precisar de algo sobre alimentos, tabelas nutricionais ou o Nutria, é só chamar!"
+RESPOSTA_FORA_ESCOPO = "Perdão! 😓 Consigo ajudar apenas com engenharia de alimentos, dúvidas sobre o Nutria e ajudar com as tabelas nutricionais. Gostaria de mais alguma coisa?"
+RESPOSTA_OFENSA = "Sinto muito que esteja com raiva, vamos manter o tom harmonioso e tranquilo da conversa. :) Se precisar de um tempo para se acalmar estarei aqui quando voltar."
+
+
+def normalizar_texto(texto:str) -> str:
+    # Minúsculo, sem acentos e sem pontuação, com apenas um espaço entre as palavras
+    texto = unicodedata.normalize("NFKD", str(texto).lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w\s]", " ", texto).split())
+
+def exemplos_dos_shots(guardrail_shots:list[dict], roteador_shots:list[dict]) -> list[dict]:
+    """
+    Transforma os shots do guardrail e do roteador em exemplos rotulados ``{cTexto, cRotulo, cResposta}``
+    """
+    exemplos = []
+
+    for shot in guardrail_shots:
+        saida = json.loads(shot["ai"])
+        if (saida.get("legal")):
+            exemplos.append({"cTexto":shot["human"], "cRotulo":"encaminhar", "cResposta":None})
+        else:
+            exemplos.append({"cTexto":shot["human"], "cRotulo":"ofensa", "cResposta":saida.get("resposta")})
+
+    for shot in roteador_shots:
+        saida = json.loads(shot["ai"])
+        if (saida.get("route") == "small_talk"):
+            exemplos.append({"cTexto":shot["human"], "cRotulo":"small_talk", "cResposta":saida.get("resposta_small_talk")})
+        else:
+            exemplos.append({"cTexto":shot["human"], "cRotulo":"encaminhar", "cResposta":None})
+
+    return exemplos
+
+
+def classificar_regras(pergunta:str) -> dict:
+    """
+    # Regras de palavras-chave
+    Retorna a classificação ``{cRotulo, cResposta, nConfianca, cMetodo}`` quando alguma regra decide, senão ``None``
+    """
+    texto = normalizar_texto(pergunta)
+    if (texto == ""):
+        return None
+
+    if (REGEX_OFENSA.match(texto)):
+        return {"cRotulo":"ofensa", "cResposta":RESPOSTA_OFENSA, "nConfianca":1.0, "cMetodo":"regra"}
+
+    if (REGEX_SAUDACAO.match(texto)):
+        return {"cRotulo":"small_talk", "cResposta":RESPOSTA_SAUDACAO, "nConfianca":1.0, "cMetodo":"regra"}
+
+    if (REGEX_AGRADECIMENTO.match(texto) and REGEX_TEM_AGRADECIMENTO.search(texto)):
+        return {"cRotulo":"small_talk", "cResposta":RESPOSTA_AGRADECIMENTO, "nConfianca":1.0, "cMetodo":"regra"}
+
+    if (REGEX_FORA_ESCOPO.match(texto)):
+        return {"cRotulo":"small_talk", "cResposta":RESPOSTA_FORA_ESCOPO, "nConfianca":0.9, "cMetodo":"regra"}
+
+    return None
+
+
+class PreClassificador:
+    def __init__(self, exemplos:list[dict], limiar:float = LIMIAR_SIMILARIDADE, margem:float = MARGEM_SIMILARIDADE, usar_embedding:bool = EMBEDDING_ATIVO):
+        """
+        ## Parâmetros:
+        - ``exemplos``: Exemplos rotulados (ver ``exemplos_dos_shots``) usados no vizinho mais próximo
+        - ``limiar``: Similaridade mínima com o exemplo mais próximo para responder sem o Gemini
+        - ``margem``: Diferença mínima para o exemplo mais próximo de outro rótulo
+        - ``usar_embedding``: Quando ``False`` apenas as regras de palavras-chave são usadas
+        """
+        self.exemplos = exemplos
+        self.limiar = limiar
+        self.margem = margem
+        self.usar_embedding = usar_embedding
+
+        # Embeddings normalizados dos exemplos (exemplos x dimensões), calculados no primeiro uso
+        self._matriz = None
+        self._lock = None
+
+        self.stats = {
+            "iPerguntas": 0,
+            "iRegras": 0,
+            "iEmbedding": 0,
+            "iEncaminhadas": 0,
+            "iErrosEmbedding": 0,
+        }
+
+    @staticmethod
+    def _normalizar_vetores(vetores) -> np.ndarray:
+        vetores = np.atleast_2d(np.asarray(vetores, dtype=np.float64))
+        normas = np.linalg.norm(vetores, axis=1, keepdims=True)
+        return vetores/np.where(normas == 0, 1, normas)
+
+    def _get_lock(self) -> asyncio.Lock:
+        if (self._lock is None):
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _get_matriz(self) -> np.ndarray:
+        if (self._matriz is None):
+            async with self._get_lock():
+                # Outra corrotina pode ter calculado enquanto esperava o lock
+                if (self._matriz is None):
+                    embeddings = await asyncio.gather(*[obter_embedding_async(exemplo["cTexto"]) for exemplo in self.exemplos])
+                    self._matriz = self._normalizar_vetores(embeddings)
+
+        return self._matriz
+
+    def classificar_vizinho(self, embedding, matriz:np.ndarray = None, ignorar:int = None) -> dict:
+        """
+        # Vizinho mais próximo
+        Compara o embedding da pergunta com o dos exemplos e retorna a classificação do mais parecido quando ele passa
+        do limiar e da margem, senão ``None``
+
+        ## Parâmetros:
+        - ``embedding``: Embedding da pergunta
+        - ``matriz``: Embeddings normalizados dos exemplos, por padrão os já calculados
+        - ``ignorar``: Posição de um exemplo que não deve ser considerado (usado na avaliação leave-one-out)
+        """
+        matriz = self._matriz if matriz is None else matriz
+        similaridades = matriz @ self._normalizar_vetores(embedding)[0]
+
+        if (ignorar is not None):
+            similaridades[ignorar] = -np.inf
+
+        melhor = int(np.argmax(similaridades))
+        rotulo = self.exemplos[melhor]["cRotulo"]
+
+        outros = [similaridade for i, similaridade in enumerate(similaridades) if self.exemplos[i]["cRotulo"] != rotulo]
+        segundo = max(outros) if len(outros) > 0 else -1.0
+
+        if (rotulo not in ROTULOS_RESPONDIDOS or similaridades[melhor] < self.limiar or similaridades[melhor] - segundo < self.margem):
+            return None
+
+        return {"cRotulo":rotulo, "cResposta":self.exemplos[melhor]["cResposta"], "nConfianca":float(similaridades[melhor]), "cMetodo":"embedding"}
+
+    async def classificar(self, pergunta:str) -> dict:
+        """
+        # Pré-classificação
+        Tenta responder a pergunta localmente
+
+        ## Retorna
+        ``{cRotulo, cResposta, nConfianca, cMetodo}`` quando a pergunta é small talk ou ofensa com confiança, ou ``None``
+        quando ela deve seguir para o guardrail e o roteador
+        """
+        self.stats["iPerguntas"] += 1
+
+        classificacao = classificar_regras(pergunta)
+        if (classificacao is not None):
+            self.stats["iRegras"] += 1
+            return classificacao
+
+        if (self.usar_embedding):
+            try:
+                matriz = await self._get_matriz()
+                classificacao = self.classificar_vizinho(await obter_embedding_async(pergunta), matriz)
+            except Exception as e:
+                # Sem embedding a pergunta apenas segue o caminho normal
+                self.stats["iErrosEmbedding"] += 1
+                print(f"Não foi possível pré-classificar a pergunta por embedding: {e}")
+                classificacao = None
+
+            if (classificacao is not None):
+                self.stats["iEmbedding"] += 1
+                return classificacao
+
+        self.stats["iEncaminhadas"] += 1
+        return None
+
+    def get_stats(self) -> dict:
+        retorno = dict(self.stats)
+        respondidas = retorno["iRegras"] + retorno["iEmbedding"]
+        retorno["nTaxaAtalho"] = respondidas/retorno["iPerguntas"] if retorno["iPerguntas"] > 0 else 0.0
+
+        return retorno
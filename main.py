@@ -1,15 +1,68 @@
 from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from libs.TableCreator import criar_tabela_nutricional
-from libs.TrIA import Tria
-from libs.AutomaticEmbedding import criar_embedding
 from libs.Utils.Exception import Http_Exception
-from libs.TableScanner import processar_imagem
+from libs.Utils.FilaJobs import enfileirar_job, obter_job, tamanhos_filas
+from libs.Utils.Connection import get_pool_stats, fechar_conexoes
+from libs.Utils import AsyncConnection
+from libs.Utils.ChavesApi import pool_chaves
+from libs.Utils.Limitador import LIMITADORES, get_metricas_limitadores
+from libs.Utils.CacheEmbedding import get_stats_cache
+from libs.DescreveAvaliacaoTabela import get_stats_cache as get_stats_cache_comentario
+from contextlib import asynccontextmanager
 from PIL import Image
+import asyncio
+import base64
+import json
+import sys
+import os
 import io
 
-api = FastAPI()
+# Quantidade máxima de receitas em uma única requisição de criação em lote
+LOTE_MAX_RECEITAS = int(os.getenv("LOTE_MAX_RECEITAS", 500))
+
+def _aquecer_chatbot():
+    # O TrIA importa o langchain e monta todos os prompts e agentes, por isso é carregado fora do caminho da inicialização
+    from libs.TrIA import get_prompts, aquecer_agentes
+    get_prompts()
+    aquecer_agentes()
+
+def _aquecimento_terminou(tarefa:asyncio.Task):
+    # Sem este callback um erro no aquecimento nunca seria visto, o chatbot apenas carregaria na primeira pergunta
+    if (tarefa.cancelled()):
+        return
+    if (tarefa.exception() is not None):
+        print(f"Não foi possível aquecer o chatbot na inicialização: {tarefa.exception()}")
+
+def _sessoes_chat():
+    # O TrIA só está carregado quando o chatbot já foi usado ou aquecido, e não precisa ser importado só para isso
+    tria = sys.modules.get("libs.TrIA")
+    return getattr(tria, "sessoes", None)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Aquecendo o chatbot em segundo plano, a API já começa a responder enquanto ele carrega
+    # A referência fica no app.state para a tarefa não ser coletada pelo garbage collector antes de terminar
+    app.state.aquecimento = None
+    if (os.getenv("AQUECER_NA_INICIALIZACAO", "1") == "1"):
+        app.state.aquecimento = asyncio.create_task(asyncio.to_thread(_aquecer_chatbot))
+        app.state.aquecimento.add_done_callback(_aquecimento_terminou)
+
+    yield
+    if (app.state.aquecimento is not None and not app.state.aquecimento.done()):
+        app.state.aquecimento.cancel()
+
+    # Salvando as sessões de chat e os usos pendentes das chaves da API antes de fechar as conexões
+    sessoes = _sessoes_chat()
+    if (sessoes is not None):
+        await sessoes.fechar()
+    pool_chaves.fechar()
+
+    # Fechando os pools de conexão no desligamento da API
+    fechar_conexoes()
+    await AsyncConnection.fechar_conexoes()
+
+api = FastAPI(lifespan=lifespan)
 
 # Defina as origens permitidas
 origins = [
@@ -31,13 +84,97 @@ api.add_middleware(
 async def index():
     return JSONResponse(content={"message":"Bem-vindo ao FastTria! Para acessar a documentação da API entre no swagger no endpoint: /docs#/"}, status_code=200)
 
+@api.get("/metrics/")
+async def metrics():
+    # Importado aqui porque carrega o numpy, que não é necessário na inicialização
+    from libs.MatrizNutrientes import matriz_nutrientes
+
+    metricas = {
+        "mongo":get_pool_stats(),
+        "chaves_api":pool_chaves.stats(),
+        "endpoints":get_metricas_limitadores(),
+        "filas":await tamanhos_filas(),
+        "cache_embedding":get_stats_cache(),
+        "matriz_nutrientes":matriz_nutrientes.stats(),
+        "cache_comentario":await get_stats_cache_comentario(),
+    }
+
+    tria = sys.modules.get("libs.TrIA")
+    metricas["sessoes_chat"] = tria.sessoes.get_stats() if tria is not None else None
+    metricas["tokens_chat"] = tria.get_stats_tokens() if tria is not None else None
+    metricas["preclassificador_chat"] = tria.preclassificador.get_stats() if tria is not None else None
+
+    return JSONResponse(content=metricas, status_code=200)
+
+@api.post("/tablecreator/lote/")
+async def create_tables_batch(body: dict):
+    try:
+        receitas = body.get("lReceitas")
+
+        if (not isinstance(receitas, list) or len(receitas) == 0):
+            raise Http_Exception(400, "O campo lReceitas deve ser uma lista com ao menos uma receita")
+        if (len(receitas) > LOTE_MAX_RECEITAS):
+            raise Http_Exception(413, f"O lote pode ter no máximo {LOTE_MAX_RECEITAS} receitas")
+
+        # As tabelas são calculadas e inseridas juntas pelo worker, o resultado de cada receita fica no job
+        job_id = await enfileirar_job("tablecreator_lote", {"receitas":receitas})
+        return JSONResponse(content={"message":f"{len(receitas)} tabelas nutricionais foram colocadas na fila", "job_id":job_id}, status_code=202)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
+@api.post("/tablecreator/reclassificar/")
+async def rescore_tables():
+    try:
+        # Recalcula o Nutri-Score de todas as tabelas, usado depois de mudar os critérios de classificação
+        job_id = await enfileirar_job("reclassificacao", {})
+        return JSONResponse(content={"message":"A reclassificação das tabelas nutricionais foi colocada na fila", "job_id":job_id}, status_code=202)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
 @api.post("/tablecreator/{cod_user}")
 async def create_table(cod_user:int):
     try:
-        retorno = criar_tabela_nutricional(cod_user)
-        return JSONResponse(content={"message":retorno}, status_code=200)
+        # A tabela é criada pelo worker, aqui apenas é registrado o job
+        job_id = await enfileirar_job("tablecreator", {"cod_user":cod_user})
+        return JSONResponse(content={"message":f"A tabela nutricional do usuário {cod_user} foi colocada na fila", "job_id":job_id}, status_code=202)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
+
+@api.get("/tablecreator/tabela/{cod_tabela}/comentario")
+async def table_comment(cod_tabela:int):
+    try:
+        from libs.TableCreator import obter_comentario_tabela
+
+        # O comentário da IA é gerado depois da tabela ser criada, aqui é consultado se ele já ficou pronto
+        comentario = await obter_comentario_tabela(cod_tabela)
+        return JSONResponse(content=comentario, status_code=200)
     except Http_Exception as http:
-        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo)
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
+
+@api.patch("/tablecreator/tabela/{cod_tabela}")
+async def update_table(cod_tabela:int, body: dict):
+    try:
+        from libs.TableCreator import atualizar_tabela_nutricional
+
+        ingredientes = body.get("lIngredientes", [])
+        if (not isinstance(ingredientes, list)):
+            raise Http_Exception(400, "O campo lIngredientes deve ser uma lista de {nCdIngrediente, iQuantidade}")
+
+        porcao = body.get("nPorcao")
+        resultado = await atualizar_tabela_nutricional(cod_tabela, ingredientes, float(porcao) if porcao is not None else None)
+        return JSONResponse(content=resultado, status_code=200)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
     except Exception as e:
         return JSONResponse(content={"message":e}, status_code=500)
 
@@ -45,11 +182,43 @@ async def create_table(cod_user:int):
 @api.post("/chatbot/")
 async def chat_NutrIA(body: dict):
     try:
+        # Importado apenas no uso (ou no aquecimento) para não pesar a inicialização da API
+        from libs.TrIA import Tria
+
         pergunta = body["cPrompt"]
-        resposta = Tria(pergunta,body["nCdUser"])
+        resposta = await LIMITADORES["chatbot"].executar(Tria, pergunta, body["nCdUser"])
         return JSONResponse(content={"Pergunta": pergunta, "Resposta":resposta}, status_code=200)
     except Http_Exception as http:
-        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo)
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
+
+@api.post("/chatbot/stream/")
+async def chat_NutrIA_stream(body: dict):
+    try:
+        from libs.TrIA import Tria_stream
+
+        pergunta = body["cPrompt"]
+        cod_user = body["nCdUser"]
+
+        # Depois que o streaming começa o status não pode mais ser 429, então a fila é verificada antes
+        LIMITADORES["chatbot"].verificar()
+
+        async def eventos():
+            # Server-Sent Events: cada etapa do pipeline e cada pedaço da resposta final é enviado assim que fica pronto
+            # Primeiro evento enviado imediatamente, antes de qualquer chamada ao Gemini
+            yield f"event: etapa\ndata: {json.dumps({'cTipo':'etapa', 'cEtapa':'inicio'})}\n\n"
+
+            try:
+                async for evento in LIMITADORES["chatbot"].executar_stream(Tria_stream, pergunta, cod_user):
+                    yield f"event: {evento['cTipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+            except Http_Exception as http:
+                yield f"event: erro\ndata: {json.dumps({'cTipo':'erro', 'cMensagem':http.mensagem}, ensure_ascii=False)}\n\n"
+
+        return StreamingResponse(eventos(), media_type="text/event-stream", headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
     except Exception as e:
         return JSONResponse(content={"message":e}, status_code=500)
 
@@ -57,10 +226,10 @@ async def chat_NutrIA(body: dict):
 @api.post("/embedding/")
 async def embedding():
     try:
-        criar_embedding()
-        return JSONResponse(content={"message":"Os produtos e ingredientes tiveram o embedding realizado com sucesso"}, status_code=200)
+        job_id = await enfileirar_job("embedding", {})
+        return JSONResponse(content={"message":"O embedding dos produtos e ingredientes foi colocado na fila", "job_id":job_id}, status_code=202)
     except Http_Exception as http:
-        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo)
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
     except Exception as e:
         return JSONResponse(content={"message":e}, status_code=500)
     
@@ -71,12 +240,27 @@ async def scanner_tabela(nome_ingrediente:str, file: UploadFile = File(...)):
         # Lê os bytes do arquivo enviado
         contents = await file.read()
 
-        # Converte os bytes em uma imagem PIL
-        image = Image.open(io.BytesIO(contents))
-        
-        id_novo = processar_imagem(image, nome_ingrediente)
-       
-        # Envia a imagem como resposta HTTP
-        return JSONResponse(content={"message":f"O ingrediente {nome_ingrediente} foi scanneado e salvo com sucesso", "id_novo":id_novo}, status_code=200)
+        # Validando que o arquivo é uma imagem antes de colocar na fila
+        try:
+            Image.open(io.BytesIO(contents)).verify()
+        except Exception:
+            raise Http_Exception(400, "O arquivo enviado não é uma imagem válida")
+
+        job_id = await enfileirar_job("scanner", {"nome_ingrediente":nome_ingrediente, "imagem":base64.b64encode(contents).decode("ascii")})
+
+        return JSONResponse(content={"message":f"O ingrediente {nome_ingrediente} foi colocado na fila para ser scanneado", "job_id":job_id}, status_code=202)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
+    except Exception as e:
+        return JSONResponse(content={"message":e}, status_code=500)
+
+
+@api.get("/jobs/{job_id}")
+async def status_job(job_id:str):
+    try:
+        job = await obter_job(job_id)
+        return JSONResponse(content=job, status_code=200)
+    except Http_Exception as http:
+        return JSONResponse(content={"message":http.mensagem}, status_code=http.codigo, headers=http.headers)
     except Exception as e:
         return JSONResponse(content={"message":e}, status_code=500)
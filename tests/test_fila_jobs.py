@@ -0,0 +1,244 @@
+"""
+Testes da fila de jobs (libs/Utils/FilaJobs.py) com o fakeredis no lugar do Redis.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+
+import pytest
+
+# O Connection lê as credenciais do MongoDB no import, os testes não se conectam a ele
+os.environ.setdefault("MONGO_USER", "teste")
+os.environ.setdefault("MONGO_PWD", "teste")
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("valkey")
+
+from libs.Utils import FilaJobs
+from libs.Utils.Exception import Http_Exception
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    servidor = fakeredis.FakeServer()
+
+    # Cada get_redis devolve um client novo (como o pool real), todos ligados ao mesmo servidor
+    async def get_redis():
+        return fakeredis.FakeAsyncValkey(server=servidor, decode_responses=True)
+
+    monkeypatch.setattr(FilaJobs, "get_redis", get_redis)
+    return get_redis
+
+
+def executar(corrotina):
+    return asyncio.run(corrotina)
+
+
+def test_enfileirar_job(redis):
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("tablecreator", {"cod_user":1})
+        cliente = await redis()
+
+        assert await cliente.lrange(FilaJobs.prefixo_fila+"tablecreator", 0, -1) == [job_id]
+        assert await cliente.hget(FilaJobs.prefixo_job+job_id, "cStatus") == FilaJobs.PENDENTE
+        # Um job pendente também expira, caso nunca seja executado
+        assert 0 < await cliente.ttl(FilaJobs.prefixo_job+job_id) <= FilaJobs.JOB_TTL_PENDENTE
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cTipo"] == "tablecreator"
+        assert "jPayload" not in job
+
+    executar(cenario())
+
+
+def test_enfileirar_job_tipo_desconhecido(redis):
+    with pytest.raises(Http_Exception) as erro:
+        executar(FilaJobs.enfileirar_job("desconhecido", {}))
+
+    assert erro.value.codigo == 400
+
+
+def test_enfileirar_job_fila_cheia(redis, monkeypatch):
+    monkeypatch.setattr(FilaJobs, "FILA_MAX", 3)
+
+    async def cenario():
+        # Envios ao mesmo tempo não podem passar do FILA_MAX
+        resultados = await asyncio.gather(*[FilaJobs.enfileirar_job("scanner", {"i":i}) for i in range(10)], return_exceptions=True)
+
+        aceitos = [r for r in resultados if isinstance(r, str)]
+        recusados = [r for r in resultados if isinstance(r, Http_Exception)]
+
+        assert len(aceitos) == 3
+        assert len(recusados) == 7
+        assert all(r.codigo == 429 for r in recusados)
+        assert (await FilaJobs.tamanhos_filas())["scanner"] == 3
+
+    executar(cenario())
+
+
+def test_enfileirar_jobs(redis):
+    async def cenario():
+        jobs_ids = await FilaJobs.enfileirar_jobs("comentario", [{"nCdTabela":i} for i in range(3)])
+        cliente = await redis()
+
+        # A ordem dos ids segue a ordem dos payloads
+        assert await cliente.lrange(FilaJobs.prefixo_fila+"comentario", 0, -1) == jobs_ids
+        for job_id in jobs_ids:
+            assert 0 < await cliente.ttl(FilaJobs.prefixo_job+job_id) <= FilaJobs.JOB_TTL_PENDENTE
+
+        assert await FilaJobs.enfileirar_jobs("comentario", []) == []
+
+    executar(cenario())
+
+
+def test_enfileirar_jobs_fila_cheia(redis, monkeypatch):
+    monkeypatch.setattr(FilaJobs, "FILA_MAX", 3)
+
+    async def cenario():
+        await FilaJobs.enfileirar_job("comentario", {"nCdTabela":0})
+
+        # O lote é recusado inteiro quando não cabe na fila
+        with pytest.raises(Http_Exception) as erro:
+            await FilaJobs.enfileirar_jobs("comentario", [{"nCdTabela":i} for i in range(3)])
+
+        assert erro.value.codigo == 429
+        assert (await FilaJobs.tamanhos_filas())["comentario"] == 1
+
+    executar(cenario())
+
+
+def test_proximo_job(redis):
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("embedding", {"lote":5})
+
+        assert await FilaJobs.proximo_job(["scanner", "embedding"], "worker-1", timeout=1) == (job_id, "embedding", {"lote":5})
+
+        cliente = await redis()
+        # O job sai da fila e fica na lista do worker até ser finalizado
+        assert await cliente.llen(FilaJobs.prefixo_fila+"embedding") == 0
+        assert await cliente.lrange(FilaJobs.prefixo_processando+"worker-1", 0, -1) == [job_id]
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cStatus"] == FilaJobs.EXECUTANDO
+        assert job["cWorker"] == "worker-1"
+
+    executar(cenario())
+
+
+def test_proximo_job_sem_jobs(redis, monkeypatch):
+    monkeypatch.setattr(FilaJobs, "INTERVALO_BLOQUEIO", 0.05)
+
+    assert executar(FilaJobs.proximo_job(["scanner", "embedding"], "worker-1", timeout=0.2)) is None
+
+
+def test_finalizar_job(redis):
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("comentario", {"nCdTabela":7})
+        await FilaJobs.proximo_job(["comentario"], "worker-1", timeout=1)
+
+        await FilaJobs.finalizar_job(job_id, resultado={"nCdTabela":7}, worker="worker-1")
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cStatus"] == FilaJobs.CONCLUIDO
+        assert job["jResultado"] == {"nCdTabela":7}
+
+        cliente = await redis()
+        assert await cliente.llen(FilaJobs.prefixo_processando+"worker-1") == 0
+        assert await cliente.hget(FilaJobs.prefixo_job+job_id, "jPayload") is None
+        assert 0 < await cliente.ttl(FilaJobs.prefixo_job+job_id) <= FilaJobs.JOB_TTL
+
+    executar(cenario())
+
+
+def test_finalizar_job_com_erro(redis):
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("scanner", {})
+        await FilaJobs.proximo_job(["scanner"], "worker-1", timeout=1)
+
+        await FilaJobs.finalizar_job(job_id, erro="imagem inválida", worker="worker-1")
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cStatus"] == FilaJobs.ERRO
+        assert job["cErro"] == "imagem inválida"
+        assert "jResultado" not in job
+
+    executar(cenario())
+
+
+def test_obter_job_inexistente(redis):
+    with pytest.raises(Http_Exception) as erro:
+        executar(FilaJobs.obter_job("naoexiste"))
+
+    assert erro.value.codigo == 404
+
+
+def test_recuperar_jobs_orfaos(redis):
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("tablecreator", {"cod_user":1})
+
+        # O worker-1 pegou o job e parou sem sinal de vida, o worker-2 está vivo
+        await FilaJobs.proximo_job(["tablecreator"], "worker-1", timeout=1)
+        await FilaJobs.registrar_worker("worker-2")
+
+        assert await FilaJobs.recuperar_jobs_orfaos("worker-2") == {"iReenfileirados":1, "iFalhos":0}
+
+        cliente = await redis()
+        assert await cliente.lrange(FilaJobs.prefixo_fila+"tablecreator", 0, -1) == [job_id]
+        assert await cliente.llen(FilaJobs.prefixo_processando+"worker-1") == 0
+        assert await cliente.llen(FilaJobs.prefixo_processando+"worker-2") == 0
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cStatus"] == FilaJobs.PENDENTE
+        assert job["iTentativas"] == "1"
+
+    executar(cenario())
+
+
+def test_recuperar_jobs_orfaos_worker_vivo(redis):
+    async def cenario():
+        await FilaJobs.enfileirar_job("tablecreator", {"cod_user":1})
+        await FilaJobs.registrar_worker("worker-1")
+        await FilaJobs.proximo_job(["tablecreator"], "worker-1", timeout=1)
+
+        assert await FilaJobs.recuperar_jobs_orfaos("worker-2") == {"iReenfileirados":0, "iFalhos":0}
+
+    executar(cenario())
+
+
+def test_recuperar_jobs_orfaos_sem_tentativas(redis, monkeypatch):
+    monkeypatch.setattr(FilaJobs, "JOB_MAX_TENTATIVAS", 0)
+
+    async def cenario():
+        job_id = await FilaJobs.enfileirar_job("tablecreator", {"cod_user":1})
+        await FilaJobs.proximo_job(["tablecreator"], "worker-1", timeout=1)
+
+        assert await FilaJobs.recuperar_jobs_orfaos("worker-2") == {"iReenfileirados":0, "iFalhos":1}
+
+        job = await FilaJobs.obter_job(job_id)
+        assert job["cStatus"] == FilaJobs.ERRO
+
+        cliente = await redis()
+        assert await cliente.llen(FilaJobs.prefixo_fila+"tablecreator") == 0
+        assert await cliente.llen(FilaJobs.prefixo_processando+"worker-2") == 0
+
+    executar(cenario())
+
+
+def test_devolver_jobs_nao_iniciados(redis):
+    async def cenario():
+        iniciado = await FilaJobs.enfileirar_job("scanner", {"i":1})
+        nao_iniciado = await FilaJobs.enfileirar_job("scanner", {"i":2})
+
+        # O segundo job foi movido para a lista do worker, mas o Redis falhou antes do worker receber ele
+        await FilaJobs.proximo_job(["scanner"], "worker-1", timeout=1)
+        cliente = await redis()
+        await cliente.lmove(FilaJobs.prefixo_fila+"scanner", FilaJobs.prefixo_processando+"worker-1", "LEFT", "RIGHT")
+
+        assert await FilaJobs.devolver_jobs_nao_iniciados("worker-1", {iniciado}) == 1
+
+        assert await cliente.lrange(FilaJobs.prefixo_processando+"worker-1", 0, -1) == [iniciado]
+        assert await cliente.lrange(FilaJobs.prefixo_fila+"scanner", 0, -1) == [nao_iniciado]
+        assert (await FilaJobs.obter_job(nao_iniciado))["cStatus"] == FilaJobs.PENDENTE
+
+    executar(cenario())
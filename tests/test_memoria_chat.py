@@ -0,0 +1,53 @@
+"""
+Testes da memória do chat (libs/ToolsNutr_IA.py) com uma collection falsa no lugar do MongoDB.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+
+import pytest
+
+# O Connection lê as credenciais do MongoDB no import, os testes não se conectam a ele
+os.environ.setdefault("MONGO_USER", "teste")
+os.environ.setdefault("MONGO_PWD", "teste")
+
+pytest.importorskip("langchain")
+pytest.importorskip("motor")
+
+from libs import ToolsNutr_IA
+
+
+class CollFalsa:
+    def __init__(self):
+        self.atualizacoes = []
+
+    async def update_one(self, filtro, atualizacao, upsert=False):
+        self.atualizacoes.append(atualizacao)
+
+
+def test_set_history_depois_de_mensagem_ignorada(monkeypatch):
+    coll = CollFalsa()
+
+    async def get_coll(nome):
+        return coll
+
+    monkeypatch.setattr(ToolsNutr_IA.AsyncConnection, "get_coll", get_coll)
+    monkeypatch.setattr(ToolsNutr_IA, "_indice_memoria_criado", True)
+
+    # A mensagem "tool" está salva, mas não é adicionada ao histórico
+    historico = ToolsNutr_IA.create_ChatMessageHistory([
+        {"type":"human", "content":"oi"},
+        {"type":"tool", "content":"resultado"},
+        {"type":"ai", "content":"olá"},
+    ])
+    assert historico.iPersistidas == len(historico.messages) == 2
+
+    historico.add_user_message("quanto sódio tem o presunto?")
+    historico.add_ai_message("800 mg a cada 100 g")
+    asyncio.run(ToolsNutr_IA.set_history(1, historico))
+
+    # As duas mensagens do turno novo são enviadas, sem repetir nem perder nenhuma
+    enviadas = coll.atualizacoes[0]["$push"]["lMemoria"]["$each"]
+    assert [mensagem["content"] for mensagem in enviadas] == ["quanto sódio tem o presunto?", "800 mg a cada 100 g"]
+    assert historico.iPersistidas == 4
@@ -0,0 +1,81 @@
+"""
+Testes do cálculo da tabela nutricional (libs/TableCreator.py) com a matriz de nutrientes montada em memória.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import time
+
+import pytest
+
+# O Connection lê as credenciais do MongoDB no import, os testes não se conectam a ele
+os.environ.setdefault("MONGO_USER", "teste")
+os.environ.setdefault("MONGO_PWD", "teste")
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("motor")
+
+from libs import TableCreator
+from libs.MatrizNutrientes import matriz_nutrientes
+from libs.Utils.Nutrientes import NUTRIENTES
+
+# As funções privadas do módulo não passam por name mangling fora de uma classe
+gerar_tabela_nutricional = getattr(TableCreator, "__gerar_tabela_nutricional")
+
+
+@pytest.fixture
+def matriz(monkeypatch):
+    # Dois ingredientes: o 1 com 10 de cada nutriente a cada 100g e o 2 com 1
+    monkeypatch.setattr(matriz_nutrientes, "matriz", np.array([[10.0]*len(NUTRIENTES), [1.0]*len(NUTRIENTES)]))
+    monkeypatch.setattr(matriz_nutrientes, "indice", {1:0, 2:1})
+    monkeypatch.setattr(matriz_nutrientes, "carregada_em", time.monotonic())
+    monkeypatch.setattr(matriz_nutrientes, "ttl", 3600)
+
+
+def test_soma_por_100g_sem_ponderar_pela_quantidade(matriz):
+    tabela, total = asyncio.run(gerar_tabela_nutricional([
+        {"nCdIngrediente":1, "iQuantidade":250},
+        {"nCdIngrediente":2, "iQuantidade":50},
+    ], 100))
+
+    assert total == 300
+    assert tabela["lTotal"][0] == 11.0
+
+
+def test_ingrediente_repetido_conta_uma_vez_por_ocorrencia(matriz):
+    tabela, total = asyncio.run(gerar_tabela_nutricional([
+        {"nCdIngrediente":1, "iQuantidade":100},
+        {"nCdIngrediente":2, "iQuantidade":50},
+        {"nCdIngrediente":1, "iQuantidade":30},
+    ], 100))
+
+    # Como no cálculo original, a linha do ingrediente 1 entra duas vezes no total
+    assert total == 180
+    assert tabela["lTotal"][0] == 21.0
+    assert tabela["jContribuicoes"]["1"][0] == 20.0
+    assert tabela["jContribuicoes"]["2"][0] == 1.0
+
+
+class CollFalsa:
+    def __init__(self):
+        self.atualizacoes = []
+
+    async def update_many(self, filtro, atualizacao):
+        self.atualizacoes.append((filtro, atualizacao))
+
+    async def bulk_write(self, operacoes, ordered=True):
+        self.atualizacoes.extend(operacoes)
+
+
+def test_fila_de_comentarios_cheia_nao_falha_a_criacao(monkeypatch):
+    async def fila_cheia(tipo, payloads):
+        raise TableCreator.Http_Exception(429, "A fila de comentario está cheia")
+
+    monkeypatch.setattr(TableCreator, "enfileirar_jobs", fila_cheia)
+    coll = CollFalsa()
+
+    # As tabelas já inseridas ficam com o comentário em erro, ao invés de pendentes para sempre
+    asyncio.run(getattr(TableCreator, "__enfileirar_comentarios")(coll, [7, 8]))
+
+    assert coll.atualizacoes == [({"_id":{"$in":[7, 8]}}, {"$set":{"jAvaliacao.cStatusComentario":TableCreator.COMENTARIO_ERRO}})]
@@ -0,0 +1,206 @@
+"""
+Worker que executa os jobs da fila do Redis (tabela nutricional, comentário da avaliação, embedding e scanner).
+
+Para subir um worker que executa todos os tipos de job:
+    python worker.py
+
+Ou apenas alguns tipos, para escalar cada fila separadamente:
+    python worker.py tablecreator scanner
+
+Os comentários da IA dependem da quota do Gemini, então podem ter um worker próprio:
+    python worker.py comentario
+"""
+from libs.Utils.FilaJobs import (TIPOS_JOB, WORKER_TTL, proximo_job, finalizar_job, atualizar_progresso,
+    gerar_id_worker, registrar_worker, remover_worker, recuperar_jobs_orfaos, devolver_jobs_nao_iniciados)
+from libs.Utils.Exception import Http_Exception
+from libs.Utils import AsyncConnection
+from libs.Utils.Connection import fechar_conexoes
+from libs.Utils.ChavesApi import pool_chaves
+from PIL import Image
+import asyncio
+import base64
+import sys
+import os
+import io
+
+# Quantidade de jobs executados ao mesmo tempo por processo
+WORKER_CONCORRENCIA = int(os.getenv("WORKER_CONCORRENCIA", 4))
+
+# Intervalo (em segundos) entre cada busca por jobs de workers que pararam
+INTERVALO_RECUPERACAO = float(os.getenv("WORKER_INTERVALO_RECUPERACAO", 60))
+
+# Espera (em segundos) depois de uma falha do Redis ao buscar jobs, dobrada a cada falha seguida até o máximo
+ESPERA_ERRO_REDIS = float(os.getenv("WORKER_ESPERA_ERRO_REDIS", 1))
+ESPERA_ERRO_REDIS_MAX = float(os.getenv("WORKER_ESPERA_ERRO_REDIS_MAX", 30))
+
+# Id deste processo, usado na lista de jobs em execução e no sinal de vida
+WORKER_ID = gerar_id_worker()
+
+
+# Executores de cada tipo de job --------------------------
+
+async def executar_tablecreator(job_id:str, payload:dict):
+    from libs.TableCreator import criar_tabela_nutricional
+    return await criar_tabela_nutricional(payload["cod_user"])
+
+async def executar_tablecreator_lote(job_id:str, payload:dict):
+    from libs.TableCreator import criar_tabelas_nutricionais_lote
+
+    resultados = await criar_tabelas_nutricionais_lote(payload["receitas"])
+    inseridas = sum(1 for resultado in resultados if resultado["cStatus"] == "ok")
+    return {"message":f"{inseridas} de {len(resultados)} tabelas nutricionais foram inseridas no MongoDB", "resultados":resultados}
+
+async def executar_comentario(job_id:str, payload:dict):
+    from libs.TableCreator import gerar_comentario_tabela
+
+    cod_tabela = payload["nCdTabela"]
+    await gerar_comentario_tabela(cod_tabela)
+    return {"message":f"O comentário da avaliação da tabela {cod_tabela} foi gerado com sucesso", "nCdTabela":cod_tabela}
+
+async def executar_reclassificacao(job_id:str, payload:dict):
+    from libs.AvaliadorNutricional import reclassificar_tabelas
+
+    async def reportar(progresso:dict):
+        await atualizar_progresso(job_id, progresso)
+
+    progresso = await reclassificar_tabelas(reportar)
+    return {"message":f"{progresso['iAtualizados']} de {progresso['iProcessados']} tabelas nutricionais tiveram a classificação alterada", "progresso":progresso}
+
+async def executar_embedding(job_id:str, payload:dict):
+    from libs.AutomaticEmbedding import criar_embedding
+
+    loop = asyncio.get_running_loop()
+
+    def reportar(progresso:dict):
+        # Chamado pela thread do embedding, por isso o progresso é salvo no loop do worker
+        copia = {nome: dict(valores) for nome, valores in progresso.items()}
+        asyncio.run_coroutine_threadsafe(atualizar_progresso(job_id, copia), loop)
+
+    # O embedding em massa é síncrono, então roda em uma thread para não travar os outros jobs do worker
+    progresso = await asyncio.to_thread(criar_embedding, reportar)
+    return {"message":"Os produtos e ingredientes tiveram o embedding realizado com sucesso", "progresso":progresso}
+
+async def executar_scanner(job_id:str, payload:dict):
+    from libs.TableScanner import processar_imagem
+
+    imagem = Image.open(io.BytesIO(base64.b64decode(payload["imagem"])))
+    nome_ingrediente = payload["nome_ingrediente"]
+
+    id_novo = await processar_imagem(imagem, nome_ingrediente)
+    return {"message":f"O ingrediente {nome_ingrediente} foi scanneado e salvo com sucesso", "id_novo":id_novo}
+
+EXECUTORES = {
+    "tablecreator": executar_tablecreator,
+    "tablecreator_lote": executar_tablecreator_lote,
+    "comentario": executar_comentario,
+    "reclassificacao": executar_reclassificacao,
+    "embedding": executar_embedding,
+    "scanner": executar_scanner,
+}
+
+
+# Loop do worker ------------------------------------------
+
+async def executar_job(job_id:str, tipo:str, payload:dict):
+    try:
+        resultado = await EXECUTORES[tipo](job_id, payload)
+        await finalizar_job(job_id, resultado=resultado, worker=WORKER_ID)
+        print(f"Job {job_id} ({tipo}) concluído")
+
+    except Http_Exception as http:
+        await finalizar_job(job_id, erro=str(http.mensagem), worker=WORKER_ID)
+        print(f"Job {job_id} ({tipo}) falhou: {http.mensagem}")
+
+    except Exception as e:
+        await finalizar_job(job_id, erro=str(e), worker=WORKER_ID)
+        print(f"Job {job_id} ({tipo}) falhou: {e}")
+
+async def manter_vivo():
+    """
+    Renova o sinal de vida do worker e, de tempos em tempos, devolve para a fila os jobs de workers que pararam
+    """
+    ultima_recuperacao = 0.0
+
+    while True:
+        try:
+            await registrar_worker(WORKER_ID)
+
+            agora = asyncio.get_running_loop().time()
+            if (agora - ultima_recuperacao >= INTERVALO_RECUPERACAO):
+                ultima_recuperacao = agora
+                recuperados = await recuperar_jobs_orfaos(WORKER_ID)
+                if (recuperados["iReenfileirados"] > 0 or recuperados["iFalhos"] > 0):
+                    print(f"Jobs de workers parados: {recuperados['iReenfileirados']} devolvidos para a fila e {recuperados['iFalhos']} com erro")
+        except Exception as e:
+            print(f"Não foi possível renovar o sinal de vida do worker: {e}")
+
+        await asyncio.sleep(WORKER_TTL/3)
+
+async def main(tipos:list[str]):
+    semaforo = asyncio.Semaphore(WORKER_CONCORRENCIA)
+    tarefas = set()
+    em_execucao = set()
+    falhas = 0
+
+    print(f"Worker {WORKER_ID} iniciado para as filas: {', '.join(tipos)}")
+
+    await registrar_worker(WORKER_ID)
+    vida = asyncio.create_task(manter_vivo())
+
+    try:
+        while True:
+            # Só busca um novo job quando existe vaga, deixando os demais na fila para outros workers
+            await semaforo.acquire()
+
+            try:
+                # Depois de uma falha, um job pode ter ficado na lista deste worker sem ter sido iniciado
+                if (falhas > 0):
+                    devolvidos = await devolver_jobs_nao_iniciados(WORKER_ID, em_execucao)
+                    if (devolvidos > 0):
+                        print(f"{devolvidos} job(s) não iniciados devolvidos para a fila")
+
+                job = await proximo_job(tipos, WORKER_ID)
+                falhas = 0
+
+            except Exception as e:
+                # Uma falha do Redis (conexão perdida, timeout) não pode derrubar o worker, os jobs em execução continuam
+                semaforo.release()
+                falhas += 1
+                espera = min(ESPERA_ERRO_REDIS * 2**(falhas-1), ESPERA_ERRO_REDIS_MAX)
+                print(f"Não foi possível buscar o próximo job ({falhas} falha(s) seguida(s)), tentando novamente em {espera:g}s: {e}")
+                await asyncio.sleep(espera)
+                continue
+
+            if (job is None):
+                semaforo.release()
+                continue
+
+            job_id = job[0]
+            em_execucao.add(job_id)
+
+            tarefa = asyncio.create_task(executar_job(*job))
+            tarefas.add(tarefa)
+            tarefa.add_done_callback(lambda t, job_id=job_id: (tarefas.discard(t), em_execucao.discard(job_id), semaforo.release()))
+
+    finally:
+        await asyncio.gather(*tarefas, return_exceptions=True)
+
+        # Jobs que não terminaram continuam na lista do worker e são recuperados pelos outros quando o sinal de vida expira
+        vida.cancel()
+        try:
+            await remover_worker(WORKER_ID)
+        except Exception:
+            pass
+
+        pool_chaves.fechar()
+        fechar_conexoes()
+        await AsyncConnection.fechar_conexoes()
+
+if __name__ == "__main__":
+    tipos = sys.argv[1:] or TIPOS_JOB
+
+    for tipo in tipos:
+        if (tipo not in EXECUTORES):
+            sys.exit(f"Tipo de job desconhecido: {tipo}")
+
+    asyncio.run(main(tipos))